@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import pickle
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TEMPLATE_DIR = os.path.join(ROOT_DIR, 'experiment', 'template')
+# experiments are written to <root>/experiment/<EVOLVER_DIR>/, the layout the
+# graphing views expect
+EVOLVER_DIR = 'bench'
+# algorithm -> columns of the pump_log rows after time, pump time, OD
+PUMP_LOG_STATES = {'timed_morbidostat': 2}
+MORBIDOSTATS = ['morbidostat', 'old_morbidostat', 'timed_morbidostat']
+# turbidostat-like growth curves between these ODs
+LOWER_OD = 0.2
+UPPER_OD = 0.4
+TEMPERATURE = 30
+
+
+def per_vial(coefficients, vials):
+    # calibration coefficients for any number of vials (repeated)
+    return [coefficients[x % len(coefficients)] for x in range(vials)]
+
+
+def experiment_name(algo):
+    # names must contain 'expt' to be graphed
+    return 'expt_bench_{0}'.format(algo)
+
+
+def format_rows(*columns):
+    return ''.join('{0},{1}\n'.format(*row) if len(row) == 2 else
+                   ','.join(str(value) for value in row) + '\n'
+                   for row in zip(*columns))
+
+
+class Dataset(object):
+    """
+    Generated experiment directories of one eVOLVER, as written by the DPU
+    after 'days' of broadcasts every 'interval' seconds: each vial grows
+    from LOWER_OD to UPPER_OD and is diluted back, with noise. Every
+    algorithm gets its own experiment directory (the OD, temperature and
+    raw files are the same, the algorithm logs differ).
+
+        dataset = Dataset(root, vials=16, days=14)
+        dataset.generate(['turbidostat', 'chemostat'])
+    """
+
+    def __init__(self, root, vials=16, days=14, interval=20, seed=0):
+        self.root = root
+        self.vials = vials
+        self.days = days
+        self.interval = interval
+        self.rows = int(days * 24 * 3600 / interval)
+        self.evolver_dir = os.path.join(root, 'experiment', EVOLVER_DIR)
+        self.rng = np.random.RandomState(seed)
+        self.fits = {}
+        self.times = None
+        self._files = None
+
+    def exp_dir(self, algo):
+        return os.path.join(self.evolver_dir, experiment_name(algo))
+
+    def generate(self, algos):
+        if not os.path.isdir(self.evolver_dir):
+            os.makedirs(self.evolver_dir)
+        self.write_calibrations()
+        if self.times is None:
+            self.simulate()
+            self._files = self.shared_files()
+        for algo in algos:
+            self.write_experiment(algo)
+
+    def write_calibrations(self):
+        # template calibrations, repeated for any number of vials
+        for file_name, calibration_type in [('od_cal.json', 'od'),
+                                            ('temp_cal.json', 'temperature')]:
+            with open(os.path.join(TEMPLATE_DIR, file_name)) as f:
+                fit = json.load(f)
+            fit['coefficients'] = per_vial(fit['coefficients'], self.vials)
+            fit['active'] = True
+            self.fits[calibration_type] = fit
+            with open(os.path.join(self.evolver_dir, file_name), 'w') as f:
+                json.dump(fit, f)
+        pump_cal = np.loadtxt(os.path.join(TEMPLATE_DIR, 'pump_cal.txt'),
+                              ndmin=2)
+        pump_cal = np.array([per_vial(row, self.vials) for row in pump_cal])
+        np.savetxt(os.path.join(self.evolver_dir, 'pump_cal.txt'), pump_cal,
+                   delimiter='\t', fmt='%g')
+
+    def active_calibrations(self):
+        # activecalibrations event data
+        return [{'calibrationType': calibration_type, 'fits': [fit]}
+                for calibration_type, fit in self.fits.items()]
+
+    def raw_od(self, od):
+        a, b, c, d = np.array(self.fits['od']['coefficients']).T
+        return (a + (b - a) / (1 + 10 ** ((c - od) * d))).astype(int)
+
+    def raw_temp(self, temp):
+        a, b = np.array(self.fits['temperature']['coefficients']).T
+        return ((temp - b) / a).astype(int)
+
+    def broadcast(self, od=None, temp=TEMPERATURE):
+        # broadcast data of the eVOLVER for the given OD and temperature
+        if od is None:
+            od = self.rng.uniform(LOWER_OD, UPPER_OD, self.vials)
+        od_param = self.fits['od']['params'][0]
+        temp_param = self.fits['temperature']['params'][0]
+        temp_raw = [str(raw) for raw in self.raw_temp(np.full(self.vials,
+                                                              temp))]
+        return {'data': {od_param: [str(raw) for raw in self.raw_od(od)],
+                         temp_param: temp_raw},
+                'config': {'temp': {'value': temp_raw},
+                           'pump': {'value': ['--'] * (3 * self.vials)}},
+                'timestamp': time.time()}
+
+    def simulate(self):
+        """
+        Row times (hours), per-vial OD (rows x vials), growth rates and
+        dilutions (indexes of the rows where the OD went over UPPER_OD).
+        """
+        self.times = np.round(np.arange(1, self.rows + 1) * self.interval /
+                              3600, 4)
+        self.rate = 0.5 * (1 + 0.2 * self.rng.uniform(-1, 1, self.vials))
+        period = np.log(UPPER_OD / LOWER_OD) / self.rate
+        phase = self.rng.uniform(0, 1, self.vials) * period
+        cycle = (self.times[:, None] + phase) / period
+        self.od = LOWER_OD * np.exp(self.rate * (cycle % 1) * period)
+        self.od += self.rng.normal(0, 0.005, self.od.shape)
+        self.dilutions = [np.flatnonzero(np.diff(np.floor(cycle[:, x])) > 0)
+                          + 1 for x in range(self.vials)]
+
+    def shared_files(self):
+        # (directory, param) -> per-vial file contents, without header
+        times, od = self.times, self.od
+        temp = TEMPERATURE + self.rng.normal(0, 0.05, od.shape)
+        od_raw = self.raw_od(od)
+        temp_raw = self.raw_temp(temp)
+        files = {}
+        files['OD', 'OD'] = [format_rows(times, od[:, x])
+                             for x in range(self.vials)]
+        files['temp', 'temp'] = [format_rows(times, temp[:, x])
+                                 for x in range(self.vials)]
+        for param, values in [(self.fits['od']['params'][0], od_raw),
+                              (self.fits['temperature']['params'][0],
+                               temp_raw)]:
+            files[param + '_raw', param + '_raw'] = [
+                format_rows(times, values[:, x]) for x in range(self.vials)]
+        return files
+
+    def write_experiment(self, algo):
+        exp_dir = self.exp_dir(algo)
+        exp_str = 'Experiment: {0} vial {{0}}, {1}'.format(
+            experiment_name(algo), time.strftime('%c'))
+        times = self.times
+        for (directory, param), contents in self._files.items():
+            # the temperature files have no header
+            header = directory != 'temp'
+            self.write_files(exp_dir, directory, param, contents,
+                             exp_str if header else None)
+        for directory, param, contents in self.algorithm_files(algo):
+            self.write_files(exp_dir, directory, param, contents, exp_str)
+        self.write_files(exp_dir, 'temp_config', 'temp_config',
+                         ['0,{0}\n'.format(TEMPERATURE)] * self.vials,
+                         exp_str)
+        # resumed experiments continue after the last row
+        start_time = time.time() - times[-1] * 3600
+        with open(os.path.join(exp_dir, experiment_name(algo) + '.pickle'),
+                  'wb') as f:
+            pickle.dump([start_time, np.zeros(self.vials)], f)
+
+    def algorithm_files(self, algo):
+        # (directory, param, per-vial contents) of the algorithm logs
+        times = self.times
+        pump_log, odset, gr = [], [], []
+        morbido_log, chemo_config = [], []
+        for x in range(self.vials):
+            rows = self.dilutions[x]
+            dilution_times = times[rows]
+            pump_time = np.round(np.log(UPPER_OD / LOWER_OD) * 25, 2)
+            columns = [dilution_times, np.full(len(rows), pump_time),
+                       self.od[rows - 1, x]]
+            columns += [np.zeros(len(rows))] * PUMP_LOG_STATES.get(algo, 0)
+            pump_log.append('0,' * (len(columns) - 1) + '0\n' +
+                            format_rows(*columns))
+            # upper threshold at the start of a curve, lower at its end
+            odset_times = np.sort(np.concatenate(
+                [dilution_times, times[np.minimum(rows + 1,
+                                                  len(times) - 1)]]))
+            odset_values = np.tile([LOWER_OD, UPPER_OD], len(rows))
+            odset.append('0,0\n' + format_rows(odset_times, odset_values))
+            gr.append('0,0\n' + format_rows(
+                dilution_times,
+                self.rate[x] + self.rng.normal(0, 0.02, len(rows))))
+            if algo in MORBIDOSTATS:
+                p = self.rng.normal(0, 0.05, len(rows))
+                morbido_log.append('0,0,0,0,0,0,0,I\n' + format_rows(
+                    dilution_times, p, p, np.zeros(len(rows)), p,
+                    np.zeros(len(rows)), np.zeros(len(rows)),
+                    ['I'] * len(rows)))
+            if algo == 'chemostat':
+                chemo_config.append('0,0,0\n0,0,0\n{0},1,36.0\n'.format(
+                    times[0]))
+        files = [('pump_log', 'pump_log', pump_log),
+                 ('ODset', 'ODset', odset),
+                 ('growthrate', 'gr', gr)]
+        if morbido_log:
+            files.append(('morbido_log', 'morbido_log', morbido_log))
+        if chemo_config:
+            files.append(('chemo_config', 'chemo_config', chemo_config))
+        return files
+
+    def write_files(self, exp_dir, directory, param, contents, header=None):
+        path = os.path.join(exp_dir, directory)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for x, content in enumerate(contents):
+            file_name = 'vial{0}_{1}.txt'.format(x, param)
+            with open(os.path.join(path, file_name), 'w') as f:
+                if header is not None:
+                    f.write(header.format(x) + '\n')
+                f.write(content)
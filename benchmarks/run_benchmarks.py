@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import timeit
+import logging
+import platform
+import argparse
+import tempfile
+import itertools
+import contextlib
+import subprocess
+import numpy as np
+
+from datasets import Dataset, ROOT_DIR, TEMPLATE_DIR, experiment_name
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+GRAPHING_DIR = os.path.join(ROOT_DIR, 'graphing', 'src')
+ALGOS = ['chemostat', 'turbidostat', 'morbidostat', 'old_morbidostat',
+         'timed_morbidostat']
+# eVOLVER.py arguments of each algorithm
+COMMON_ARGS = ['--vial_volume', '25', '--to_avg', '7', '--stir_initial', '8',
+               '--temp_initial', '30', '--always-yes', '--quiet']
+ALGO_ARGS = {
+    'chemostat': ['--start_od', '0', '--start_time', '0',
+                  '--rate_config', '0.5', '--bolus', '0.5'],
+    'turbidostat': ['--lower_threshold', '0.2', '--upper_threshold', '0.4',
+                    '--time_out', '5', '--pump_wait', '3',
+                    '--pump_for_max', '20'],
+    'morbidostat': ['--lower_threshold', '0.2', '--upper_threshold', '0.4',
+                    '--middle_threshold', '0.3', '--pump_wait', '3',
+                    '--time_out', '5', '--pump_for_max', '20',
+                    '--a_conc', '10', '--b_conc', '20',
+                    # type=bool: only an empty string is False
+                    '--same_drug', '',
+                    '--pump_a_for', '5', '--pump_b_for', '5',
+                    '--pump_media_for', '5', '--suction_for', '10'],
+    'timed_morbidostat': ['--freq_a', '1', '--freq_b', '1',
+                          '--init_a', '0.2', '--init_b', '0.2',
+                          '--times_a', '2', '--times_b', '2',
+                          '--use_b', '1']}
+ALGO_ARGS['old_morbidostat'] = ALGO_ARGS['morbidostat']
+ALGO_ARGS['timed_morbidostat'] = ALGO_ARGS['morbidostat'] + \
+    ALGO_ARGS['timed_morbidostat']
+# sweep of --scale
+SCALE_DAYS = [1, 7, 28]
+SCALE_VIALS = [4, 16, 64]
+
+# benchmark name -> function(context) returning the function to time
+BENCHMARKS = {}
+
+
+def register_benchmark(name, algos=False):
+    """
+    Registers a benchmark. The decorated function gets a Context and returns
+    the function to time (or raises Skip). With algos=True it also gets the
+    algorithm and is run once per algorithm, as name[algo].
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, algos)
+        return func
+    return decorator
+
+
+class Skip(Exception):
+    pass
+
+
+class Context(object):
+    """
+    A generated dataset and the DPU (eVOLVER.py of the template) running
+    experiments on it, one EvolverNamespace per algorithm.
+    """
+
+    def __init__(self, dataset, evolver, replay):
+        self.dataset = dataset
+        self.vials = list(range(dataset.vials))
+        self.evolver = evolver
+        self.replay = replay
+        self.namespaces = {}
+
+    def namespace(self, algo, journal=False):
+        # resumes the experiment of the algorithm, offline (with journal, a
+        # new experiment writing a journal)
+        key = (algo, journal)
+        if key in self.namespaces:
+            return self.namespaces[key]
+        evolver = self.evolver
+        evolver.SAVE_PATH = self.dataset.evolver_dir
+        evolver.VIALS = self.vials
+        exp_name = experiment_name(algo)
+        extra_args = []
+        if journal:
+            exp_name += '_journal'
+            extra_args = ['--journal']
+        options = evolver.get_options(
+            ['--algo', algo, '--exp_name', exp_name] +
+            COMMON_ARGS + ALGO_ARGS[algo] + extra_args)
+        commands = self.replay.CommandLog(time.time)
+        commands.open(os.devnull)
+        namespace = evolver.EvolverNamespace(commands, evolver.NAMESPACE)
+        namespace.configure(options,
+                            calibration_dir=self.dataset.evolver_dir)
+        with quiet(TEMPLATE_DIR):
+            namespace.start_time = namespace.initialize_exp(self.vials, True)
+            namespace.on_activecalibrations(
+                self.dataset.active_calibrations())
+        self.namespaces[key] = namespace
+        return namespace
+
+    def calibrations(self, namespace):
+        return (self.evolver.CALIBRATIONS.get(namespace.calibration_keys['od']),
+                self.evolver.CALIBRATIONS.get(
+                    namespace.calibration_keys['temperature']))
+
+    def elapsed_time(self, namespace):
+        return round((time.time() - namespace.start_time) / 3600, 4)
+
+    def close(self):
+        for namespace in self.namespaces.values():
+            namespace.writer.close()
+
+
+@contextlib.contextmanager
+def quiet(directory=None):
+    # no output from the DPU, optionally from another working directory
+    cwd = os.getcwd()
+    if directory is not None:
+        os.chdir(directory)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.chdir(cwd)
+
+
+@register_benchmark('tail_to_np')
+def bench_tail_to_np(context):
+    # last to_avg rows of every OD file
+    paths = [os.path.join(context.dataset.exp_dir('turbidostat'), 'OD',
+                          'vial{0}_OD.txt'.format(x)) for x in context.vials]
+    tail_to_np = context.evolver.data_files.tail_to_np
+
+    def run():
+        for path in paths:
+            tail_to_np(path, 7)
+    return run
+
+
+@register_benchmark('read_series')
+def bench_read_series(context):
+    # whole OD series of every vial, from the text files
+    reader = context.evolver.SeriesReader(
+        context.dataset.exp_dir('turbidostat'),
+        context.evolver.DataWriter(series_format='text'))
+
+    def run():
+        for x in context.vials:
+            reader.read('OD', x)[:, 1].max()
+    return run
+
+
+@register_benchmark('read_series_binary')
+def bench_read_series_binary(context):
+    # the same from binary copies of the files (--series-format binary)
+    exp_dir = os.path.join(context.dataset.root, 'binary_series')
+    os.makedirs(os.path.join(exp_dir, 'OD'), exist_ok=True)
+    writer = context.evolver.DataWriter(series_format='binary')
+    for x in context.vials:
+        name = os.path.join('OD', 'vial{0}_OD.txt'.format(x))
+        shutil.copy(os.path.join(context.dataset.exp_dir('turbidostat'), name),
+                    os.path.join(exp_dir, name))
+        writer.create_series(os.path.join(exp_dir, name))
+    reader = context.evolver.SeriesReader(exp_dir, writer)
+
+    def run():
+        for x in context.vials:
+            reader.read('OD', x)[:, 1].max()
+    return run
+
+
+@register_benchmark('read_range')
+def bench_read_range(context):
+    # last day of OD of every vial (graphing views with ?hours=24), through
+    # the time index of the files
+    namespace = context.namespace('turbidostat')
+    index_od_files(context, namespace)
+
+    def run():
+        for x in context.vials:
+            last = namespace.series.tail('OD', x, 1)
+            namespace.series.read_range('OD', x, last[-1][0] - 24)
+    return run
+
+
+@register_benchmark('transform_data')
+def bench_transform_data(context):
+    namespace = context.namespace('turbidostat')
+    od_cal, temp_cal = context.calibrations(namespace)
+    data = context.dataset.broadcast()
+
+    def run():
+        namespace.transform_data(data, context.vials, od_cal, temp_cal)
+    return run
+
+
+@register_benchmark('save_data')
+def bench_save_data(context):
+    # OD of every vial, written through to the files
+    namespace = context.namespace('turbidostat')
+    od = np.random.uniform(0.2, 0.4, len(context.vials))
+
+    def run():
+        namespace.save_data(od, context.elapsed_time(namespace),
+                            context.vials, 'OD')
+        namespace.writer.end_broadcast()
+    return run
+
+
+@register_benchmark('calc_growth_rate')
+def bench_calc_growth_rate(context):
+    namespace = context.namespace('turbidostat')
+    gr_start = namespace.growth_rate.start.copy()
+
+    def run():
+        elapsed_time = context.elapsed_time(namespace)
+        for x in context.vials:
+            namespace.calc_growth_rate(x, gr_start[x], elapsed_time)
+    return run
+
+
+def index_od_files(context, namespace):
+    # the generated files have no time index yet, the DPU completes it with
+    # the next row
+    namespace.save_data(np.full(len(context.vials), 0.3),
+                        context.elapsed_time(namespace), context.vials, 'OD')
+    namespace.writer.end_broadcast()
+
+
+@register_benchmark('calc_growth_rate_from_file')
+def bench_calc_growth_rate_from_file(context):
+    # growth rates of every vial from the OD files (--verify-growth-rate)
+    namespace = context.namespace('turbidostat')
+    index_od_files(context, namespace)
+    gr_start = namespace.growth_rate.start.copy()
+
+    def run():
+        for x in context.vials:
+            namespace.calc_growth_rate_from_file(x, gr_start[x])
+    return run
+
+
+@register_benchmark('od_filter')
+def bench_od_filter(context):
+    # median, MAD and outliers of a large smoothing window (500 OD values)
+    # as a new OD value of every vial arrives
+    od_filter = context.evolver.RollingMedian(len(context.vials), 500)
+    for x in context.vials:
+        od_filter.load(x, np.random.uniform(0.2, 0.4, 500))
+
+    def run():
+        od_filter.append(context.vials,
+                         np.random.uniform(0.2, 0.4, len(context.vials)))
+        od_filter.median()
+        od_filter.outliers()
+    return run
+
+
+@register_benchmark('initialize_exp')
+def bench_initialize_exp(context):
+    # resuming the experiment from its checkpoint
+    namespace = context.namespace('turbidostat')
+
+    def run():
+        with quiet(TEMPLATE_DIR):
+            namespace.initialize_exp(context.vials, True)
+    return run
+
+
+@register_benchmark('initialize_exp_from_logs')
+def bench_initialize_exp_from_logs(context):
+    # resuming the experiment without checkpoint: state rebuilt from the files
+    namespace = context.namespace('turbidostat')
+
+    def run():
+        os.remove(namespace.checkpoint.path)
+        with quiet(TEMPLATE_DIR):
+            namespace.initialize_exp(context.vials, True)
+    return run
+
+
+@register_benchmark('custom_functions', algos=True)
+def bench_custom_functions(context, algo):
+    # the control algorithm alone, on a transformed broadcast
+    namespace = context.namespace(algo)
+    od_cal, temp_cal = context.calibrations(namespace)
+    data = namespace.transform_data(context.dataset.broadcast(),
+                                    context.vials, od_cal, temp_cal)
+
+    def run():
+        with quiet():
+            namespace.custom_functions(data, context.vials,
+                                       context.elapsed_time(namespace))
+    return run
+
+
+@register_benchmark('broadcast', algos=True)
+def bench_broadcast(context, algo):
+    # everything the DPU does with a broadcast
+    namespace = context.namespace(algo)
+    data = context.dataset.broadcast()
+
+    def run():
+        with quiet():
+            namespace.on_broadcast(dict(data, timestamp=time.time()))
+    return run
+
+
+@register_benchmark('broadcast_journal')
+def bench_broadcast_journal(context):
+    # the same with --journal (turbidostat): one record per broadcast
+    namespace = context.namespace('turbidostat', journal=True)
+    data = context.dataset.broadcast()
+
+    def run():
+        with quiet():
+            namespace.on_broadcast(dict(data, timestamp=time.time()))
+    return run
+
+
+def graphing_views(context):
+    # views of the graphing tool, reading the dataset
+    if context.dataset.vials != 16:
+        raise Skip('the graphing views assume 16 vials')
+    if GRAPHING_DIR not in sys.path:
+        sys.path.insert(0, GRAPHING_DIR)
+    try:
+        from cloudevolution import views
+    except ImportError as e:
+        raise Skip('graphing dependencies missing: %s' % e)
+    # the views find experiments relative to their file, and only the data
+    # loading and plotting is timed (no template rendering)
+    views.__file__ = os.path.join(context.dataset.root, 'graphing', 'src',
+                                  'cloudevolution', 'views.py')
+    views.render = lambda request, template, context: context
+    return views
+
+
+@register_benchmark('view_vial_num')
+def bench_view_vial_num(context):
+    views = graphing_views(context)
+
+    def run():
+        views.vial_num(None, experiment_name('turbidostat'), 0)
+    return run
+
+
+@register_benchmark('view_dilutions')
+def bench_view_dilutions(context):
+    views = graphing_views(context)
+
+    def run():
+        views.dilutions(None, experiment_name('turbidostat'))
+    return run
+
+
+def time_benchmark(func, repeat):
+    # per-call seconds, with enough calls per repeat to take >= 0.2 s
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    timings = [t / number for t in timer.repeat(repeat, number)]
+    return {'number': number,
+            'repeat': repeat,
+            'min_s': min(timings),
+            'median_s': float(np.median(timings)),
+            'mean_s': float(np.mean(timings))}
+
+
+def run_benchmarks(context, names, repeat):
+    results = []
+    for name in names:
+        func, algos = BENCHMARKS[name]
+        runs = [(name + '[' + algo + ']', (algo,)) for algo in ALGOS] \
+            if algos else [(name, ())]
+        for full_name, args in runs:
+            result = {'benchmark': full_name,
+                      'vials': context.dataset.vials,
+                      'days': context.dataset.days,
+                      'rows': context.dataset.rows}
+            try:
+                result.update(time_benchmark(func(context, *args), repeat))
+            except Skip as e:
+                result['skipped'] = str(e)
+            except Exception as e:
+                result['error'] = '%s: %s' % (type(e).__name__, e)
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    name = '{0} ({1} vials, {2} days)'.format(result['benchmark'],
+                                               result['vials'],
+                                               result['days'])
+    if 'min_s' in result:
+        print('{0:<55} {1:>10.3f} ms  (median {2:.3f} ms, {3} x {4})'.format(
+            name, result['min_s'] * 1000, result['median_s'] * 1000,
+            result['repeat'], result['number']))
+    else:
+        print('{0:<55} {1}'.format(
+            name, result.get('skipped') or 'ERROR ' + result['error']))
+    sys.stdout.flush()
+
+
+def previous_results(path):
+    # (benchmark, vials, days) -> result of the last run that had it
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for result in json.loads(line)['results']:
+                if 'min_s' in result:
+                    key = (result['benchmark'], result['vials'],
+                           result['days'])
+                    previous[key] = result
+    return previous
+
+
+def print_comparison(results, previous):
+    print('compared to the previous run:')
+    for result in results:
+        old = previous.get((result['benchmark'], result['vials'],
+                            result['days']))
+        if old is None or 'min_s' not in result:
+            continue
+        print('{0:<55} {1:>8.2f} x'.format(
+            '{0} ({1} vials, {2} days)'.format(result['benchmark'],
+                                                result['vials'],
+                                                result['days']),
+            result['min_s'] / old['min_s']))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_options():
+    description = ('Times the DPU hot paths on generated experiments of '
+                   'realistic size. Results are appended as one JSON line '
+                   'per run to the output file.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--vials', type=int, nargs='+', default=None,
+                        help='Vial counts (default: 16)')
+    parser.add_argument('--days', type=float, nargs='+', default=None,
+                        help='Experiment lengths in days (default: 14)')
+    parser.add_argument('--interval', type=float, default=20,
+                        help='Seconds between broadcasts in the generated '
+                             'data (default: %(default)s)')
+    parser.add_argument('--scale', action='store_true', default=False,
+                        help='Sweep experiment lengths and vial counts '
+                             '(days ' + ', '.join(map(str, SCALE_DAYS)) +
+                             ', vials ' + ', '.join(map(str, SCALE_VIALS)) +
+                             ' unless given)')
+    parser.add_argument('--only', nargs='+', default=None,
+                        choices=sorted(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timings per benchmark (default: %(default)s)')
+    parser.add_argument('--output',
+                        default=os.path.join(os.path.dirname(
+                            os.path.realpath(__file__)), 'results.jsonl'),
+                        help='JSON lines file the results are appended to '
+                             '(default: benchmarks/results.jsonl)')
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help='Print the time ratios to the previous results '
+                             'in the output file')
+    parser.add_argument('--data-dir', default=None,
+                        help='Where to generate the experiments (default: '
+                             'a temporary directory, removed afterwards)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the generated data '
+                             '(default: %(default)s)')
+    options = parser.parse_args()
+    if options.vials is None:
+        options.vials = SCALE_VIALS if options.scale else [16]
+    if options.days is None:
+        options.days = SCALE_DAYS if options.scale else [14]
+    return options
+
+
+if __name__ == '__main__':
+    options = get_options()
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, TEMPLATE_DIR)
+    import eVOLVER as evolver
+    import replay
+
+    names = options.only or sorted(BENCHMARKS)
+    data_dir = options.data_dir or tempfile.mkdtemp(prefix='evolver_bench_')
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'interval': options.interval,
+              'results': []}
+    try:
+        for vials, days in itertools.product(options.vials, options.days):
+            root = os.path.join(data_dir, '{0}_vials_{1}_days'.format(vials,
+                                                                     days))
+            dataset = Dataset(root, vials, days, options.interval,
+                              options.seed)
+            started = time.time()
+            dataset.generate(ALGOS)
+            print('generated {0} vials x {1} rows in {2:.1f} s'.format(
+                vials, dataset.rows, time.time() - started))
+            context = Context(dataset, evolver, replay)
+            try:
+                record['results'] += run_benchmarks(context, names,
+                                                    options.repeat)
+            finally:
+                context.close()
+    finally:
+        if options.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    if options.compare:
+        print_comparison(record['results'], previous_results(options.output))
+    with open(options.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print('results appended to {0}'.format(options.output))
@@ -1,25 +1,25 @@
+import os
 import sys
 import time
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit, leastsq
-from socketIO_client import SocketIO, BaseNamespace
+from socketIO_client import BaseNamespace
 from scipy.linalg import lstsq
 import scipy, scipy.optimize
 import asyncio
-from threading import Thread
 import json
 import optparse
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 from matplotlib.ticker import LinearLocator, FormatStrFormatter
 
-VALID_FIT_TYPES = ['sigmoid', 'linear', 'constant', '3d']
+# the connection layer is shared with the experiment template
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'experiment', 'template'))
+from connection import EvolverConnection
 
-data_received = False
-calibration = None
-input_data = None
-dpu_evolver_ns = None
+VALID_FIT_TYPES = ['sigmoid', 'linear', 'constant', '3d']
 
 class EvolverNamespace(BaseNamespace):
     def on_connect(self, *args):
@@ -38,17 +38,6 @@ class EvolverNamespace(BaseNamespace):
         connected = True
         stop_waiting = True
 
-    def on_calibration(self, data):
-        global data_received, calibration, input_data
-        calibration = data
-        data_received = True
-
-    def on_calibrationnames(self, data):
-        global data_received
-        for calibration_name in data:
-            print(calibration_name)
-        data_received = True
-
 def sigmoid(x, a, b, c, d):
     return a + (b - a)/(1 + (10**((c-x)*d)))
 
@@ -225,16 +214,6 @@ def process_vial_data(calibration, param = None):
 def create_fit(coefficients, fit_name, fit_type, time_fit, params):
     return {"name": fit_name, "coefficients": coefficients, "type": fit_type, "timeFit": time_fit, "active": False, "params": params}
 
-def start_background_loop(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-
-def run(evolver_ip, evolver_port):
-    global dpu_evolver_ns
-    socketIO = SocketIO(evolver_ip, evolver_port)
-    dpu_evolver_ns = socketIO.define(EvolverNamespace, '/dpu-evolver')
-    socketIO.wait()
-
 if __name__ == '__main__':
     parser = optparse.OptionParser()
     parser.add_option('-n', '--calibration-name', action = 'store', dest = 'calname', help = "Name of the calibration.")
@@ -259,39 +238,33 @@ if __name__ == '__main__':
 
     ip_address = 'http://' + options.ipaddress
 
-    new_loop = asyncio.new_event_loop()
-    t = Thread(target = start_background_loop, args = (new_loop,))
-    t.daemon = True
-    t.start()
-    new_loop.call_soon_threadsafe(run, ip_address, 8081)
-
-    if dpu_evolver_ns is None:
-        print("Waiting for evolver connection...")
-
-    while dpu_evolver_ns is None:
-        pass
-
-    if get_names:
-        print("Getting calibration names...")
-        dpu_evolver_ns.emit('getcalibrationnames', [], namespace = '/dpu-evolver')
-    if cal_name:
-        if fit_name is None:
-            print("Please input a name for the fit!")
-            parser.print_help()
-            sys.exit(2)
-        if fit_type not in VALID_FIT_TYPES:
-            print("Invalid fit type!")
-            parser.print_help()
-            sys.exit(2)
-        if params is None:
-            print("Must provide at least 1 parameter!")
-            parser.print_help()
-            sys.exit(2)
-        dpu_evolver_ns.emit('getcalibration', {'name':cal_name}, namespace='/dpu-evolver')
-        params = params.strip().split(',')
-
-    while not data_received:
-        pass
+    print("Waiting for evolver connection...")
+    connection = EvolverConnection(ip_address, 8081)
+    connection.connect(EvolverNamespace)
+
+    try:
+        if get_names:
+            print("Getting calibration names...")
+            for calibration_name in connection.run(connection.get_calibration_names()):
+                print(calibration_name)
+        if cal_name:
+            if fit_name is None:
+                print("Please input a name for the fit!")
+                parser.print_help()
+                sys.exit(2)
+            if fit_type not in VALID_FIT_TYPES:
+                print("Invalid fit type!")
+                parser.print_help()
+                sys.exit(2)
+            if params is None:
+                print("Must provide at least 1 parameter!")
+                parser.print_help()
+                sys.exit(2)
+            calibration = connection.run(connection.get_calibration(cal_name))
+            params = params.strip().split(',')
+    except asyncio.TimeoutError:
+        print("No answer from eVOLVER, try again.")
+        sys.exit(1)
 
     if cal_name is not None and not get_names:
         if fit_type == "sigmoid":
@@ -305,4 +278,4 @@ if __name__ == '__main__':
 
         update_cal = input('Update eVOLVER with calibration? (y/n): ')
         if update_cal == 'y':
-            dpu_evolver_ns.emit('setfitcalibration', {'name': cal_name, 'fit': fit}, namespace = '/dpu-evolver')
+            connection.emit('setfitcalibration', {'name': cal_name, 'fit': fit})
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import struct
+import asyncio
+import hashlib
+import logging
+import argparse
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'template')
+NAMESPACE = '/dpu-evolver'
+# websocket handshake (RFC 6455)
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# engine.io ping interval and timeout (ms), sent in the handshake
+PING_INTERVAL = 25000
+PING_TIMEOUT = 60000
+# pump racks of a fluid command: media, drug A, drug B
+PUMP_RACKS = 3
+# socket.io event packet from the DPU, ex. 42/dpu-evolver,["command",{...}]
+EVENT_PACKET = re.compile(r'42(?:/[^,\[]*,)?\d*(\[.*)', re.DOTALL)
+
+
+def sigmoid_raw(coefficients, od):
+    # sigmoid fit, OD -> raw photodiode reading
+    a, b, c, d = coefficients.T
+    return a + (b - a) / (1 + 10 ** ((c - od) * d))
+
+
+def linear_raw(coefficients, value):
+    # inverse of the linear fit, value -> raw reading
+    a, b = coefficients.T
+    return (value - b) / a
+
+
+# fit type -> function(coefficients, value) giving the raw reading
+RAW_READINGS = {'sigmoid': sigmoid_raw, 'linear': linear_raw}
+
+
+def per_vial(coefficients, vials):
+    # calibration coefficients for any number of vials (repeated)
+    coefficients = list(coefficients)
+    return [coefficients[x % len(coefficients)] for x in range(vials)]
+
+
+class GrowthModel(object):
+    """
+    Cultures of all vials of a simulated eVOLVER, as numpy arrays. OD grows
+    logistically, slowed down by the drug concentration:
+
+        dOD/dt = rate / (1 + drug / ic50) * OD * (1 - OD / capacity)
+
+    Pumping t seconds into a vial exchanges t * flow_rate mL of the culture
+    with the rack's medium (the efflux keeps the volume constant), diluting
+    it by exp(-t * flow_rate / volume). Temperatures move exponentially to
+    their setpoints. Times are simulated seconds since the start of the
+    simulation, which runs --speed times faster than the wall clock.
+    """
+
+    def __init__(self, options, vials, rng):
+        self.vials = vials
+        self.rng = rng
+        spread = 1 + options.growth_spread * rng.uniform(-1, 1, vials)
+        # per hour
+        self.growth_rate = options.growth_rate * spread
+        self.capacity = np.full(vials, options.capacity)
+        self.ic50 = options.ic50
+        self.volume = options.volume
+        self.od = np.full(vials, options.od_initial)
+        self.drug = np.zeros(vials)
+        self.temp = np.full(vials, options.temp_initial)
+        self.temp_setpoint = np.full(vials, options.temp_initial)
+        self.temp_tau = options.temp_tau
+        self.noise = options.noise
+        # drug concentration of each pump rack's medium
+        self.rack_drug = np.array([0, options.drug_a, options.drug_b])
+        # mL/s, (racks x vials)
+        self.flow_rate = np.ones((PUMP_RACKS, vials))
+        # recurring pump commands: (racks x vials) bolus (s) and period (s)
+        self.bolus = np.zeros((PUMP_RACKS, vials))
+        self.period = np.zeros((PUMP_RACKS, vials))
+        self.next_dose = np.full((PUMP_RACKS, vials), np.inf)
+        self.time = 0.0
+        self.pumped = 0.0
+
+    def load_pump_calibration(self, path):
+        # rows of pump_cal.txt are racks, empty racks use the media rates
+        rates = np.loadtxt(path, ndmin=2)
+        for rack in range(PUMP_RACKS):
+            row = rates[rack] if rack < len(rates) and rates[rack].any() \
+                else rates[0]
+            self.flow_rate[rack] = per_vial(row, self.vials)
+
+    def advance(self, now):
+        # grows the cultures up to now, dosing the recurring pumps on time
+        while True:
+            dose_time = self.next_dose.min()
+            if dose_time > now:
+                break
+            self._grow(dose_time)
+            doses = self.next_dose == dose_time
+            seconds = np.where(doses, self.bolus, 0)
+            self.next_dose[doses] += self.period[doses]
+            self.pump(seconds)
+        self._grow(now)
+
+    def _grow(self, now):
+        dt = now - self.time
+        if dt <= 0:
+            return
+        self.time = now
+        rate = self.growth_rate / (1 + self.drug / self.ic50) * dt / 3600
+        # exact solution of the logistic equation over dt
+        self.od = self.capacity / (
+            1 + (self.capacity / self.od - 1) * np.exp(-rate))
+        self.temp = self.temp_setpoint + (self.temp - self.temp_setpoint) * \
+            np.exp(-dt / self.temp_tau)
+
+    def pump(self, seconds):
+        # seconds: (racks x vials) pumping times, NaN or 0 for none
+        seconds = np.nan_to_num(seconds)
+        added = seconds * self.flow_rate
+        total = added.sum(axis=0)
+        if not total.any():
+            return
+        self.pumped += total.sum()
+        # influx and efflux run together: the culture is exchanged
+        # continuously with the incoming media
+        fraction = np.exp(-total / self.volume)
+        with np.errstate(invalid='ignore'):
+            drug_in = np.nan_to_num(
+                (added * self.rack_drug[:, None]).sum(axis=0) / total)
+        self.od = self.od * fraction
+        self.drug = drug_in + (self.drug - drug_in) * fraction
+
+    def set_recurring(self, rack, vial, bolus, period):
+        if self.bolus[rack, vial] == bolus and \
+                self.period[rack, vial] == period:
+            # already scheduled
+            return
+        self.bolus[rack, vial] = bolus
+        self.period[rack, vial] = period
+        self.next_dose[rack, vial] = self.time + period if period > 0 \
+            else np.inf
+
+    def readings(self):
+        # measured OD and temperature, with noise
+        od = self.od + self.rng.normal(0, self.noise, self.vials)
+        temp = self.temp + self.rng.normal(0, 0.05, self.vials)
+        return od, temp
+
+
+class SimulatedEvolver(object):
+    """
+    Stand-in for the eVOLVER server on one port: speaks engine.io v3 /
+    socket.io 1.x over a websocket (the transport socketIO_client upgrades
+    to) on the /dpu-evolver namespace, broadcasts raw readings of a
+    GrowthModel and applies the pump and temperature commands it receives.
+    Calibrations are served from fit files, and used to turn the model's OD
+    and temperatures into raw readings.
+    """
+
+    def __init__(self, options, port, rng):
+        self.options = options
+        self.port = port
+        self.vials = options.vials
+        self.clients = []
+        self.model = GrowthModel(options, self.vials, rng)
+        self.model.load_pump_calibration(options.pump_cal)
+        # calibration name -> calibration
+        self.calibrations = {}
+        self.od_fit = self.load_calibration(options.od_cal, 'od')
+        self.temp_fit = self.load_calibration(options.temp_cal,
+                                              'temperature')
+        for fit in (self.od_fit, self.temp_fit):
+            if fit['type'] not in RAW_READINGS:
+                raise ValueError('cannot simulate %s readings of a %s fit' %
+                                 (fit['params'][0], fit['type']))
+        # as reported in the broadcast config
+        self.stir = ['8'] * self.vials
+        self.temp_config = [str(int(raw)) for raw in self.raw(
+            self.temp_fit, self.model.temp_setpoint)]
+        self.pump_config = ['--'] * (PUMP_RACKS * self.vials)
+        self.started = time.time()
+        self.broadcasts = 0
+        self.commands = 0
+
+    def load_calibration(self, path, calibration_type):
+        with open(path) as f:
+            fit = json.load(f)
+        fit['active'] = True
+        fit['coefficients'] = per_vial(fit['coefficients'], self.vials)
+        self.calibrations[fit['name']] = {
+            'name': fit['name'], 'calibrationType': calibration_type,
+            'timeCollected': fit.get('timeFit'), 'measuredData': [],
+            'raw': [], 'fits': [fit]}
+        return fit
+
+    def raw(self, fit, values):
+        coefficients = np.array(fit['coefficients'], dtype=np.float64)
+        return RAW_READINGS[fit['type']](coefficients, values)
+
+    def now(self):
+        # simulated seconds since the start
+        return (time.time() - self.started) * self.options.speed
+
+    def timestamp(self):
+        # simulated time, the DPU follows it with --simulator-clock
+        return self.started + self.now()
+
+    def broadcast_data(self):
+        self.model.advance(self.now())
+        od, temp = self.model.readings()
+        od_raw = self.raw(self.od_fit, od)
+        temp_raw = self.raw(self.temp_fit, temp)
+        return {'data': {self.od_fit['params'][0]:
+                         [str(int(raw)) for raw in od_raw],
+                         self.temp_fit['params'][0]:
+                         [str(int(raw)) for raw in temp_raw]},
+                'config': {'stir': {'value': self.stir},
+                           'temp': {'value': self.temp_config},
+                           'pump': {'value': self.pump_config}},
+                'ip': '127.0.0.1:%d' % self.port,
+                'timestamp': self.timestamp()}
+
+    def on_event(self, client, event, args):
+        data = args[0] if args else {}
+        if event == 'command':
+            self.commands += 1
+            self.on_command(data)
+        elif event == 'getactivecal':
+            client.emit('activecalibrations', [
+                {'calibrationType': calibration['calibrationType'],
+                 'fits': calibration['fits']}
+                for calibration in self.calibrations.values()])
+        elif event == 'getcalibrationnames':
+            client.emit('calibrationnames', [
+                {'name': name,
+                 'calibrationType': calibration['calibrationType']}
+                for name, calibration in self.calibrations.items()])
+        elif event == 'getcalibration':
+            client.emit('calibration',
+                        self.calibrations.get(data.get('name')))
+        elif event == 'setfitcalibration':
+            calibration = self.calibrations.get(data.get('name'))
+            if calibration is not None:
+                calibration['fits'].append(data['fit'])
+        else:
+            logger.info('ignoring %s event' % event)
+
+    def on_command(self, command):
+        param = command.get('param')
+        values = command.get('value', [])
+        if not isinstance(values, list):
+            # one value for all vials
+            values = [values] * self.vials
+        self.model.advance(self.now())
+        if param == 'pump':
+            self.on_pump(values, command.get('recurring', False))
+        elif param == 'temp':
+            for x, value in enumerate(values[:self.vials]):
+                self.temp_config[x] = str(value)
+            raw = np.array(self.temp_config, dtype=np.float64)
+            coefficients = np.array(self.temp_fit['coefficients'])
+            self.model.temp_setpoint = raw * coefficients[:, 0] + \
+                coefficients[:, 1]
+        elif param == 'stir':
+            for x, value in enumerate(values[:self.vials]):
+                self.stir[x] = str(value)
+        logger.debug('%s command: %s' % (param, values))
+
+    def on_pump(self, values, recurring):
+        # values: racks x vials, the last one is the suction pump (which only
+        # keeps the volume constant)
+        if recurring:
+            # reported back as is in the broadcast config
+            self.pump_config = [str(value) for value in values]
+        seconds = np.full(PUMP_RACKS * self.vials, np.nan)
+        for index, value in enumerate(values[:-1]):
+            value = str(value)
+            rack, vial = divmod(index, self.vials)
+            if value == '--':
+                continue
+            if '|' in value:
+                # bolus (s) every period (s)
+                bolus, period = value.split('|')
+                self.model.set_recurring(rack, vial, float(bolus),
+                                         float(period))
+            elif not recurring:
+                seconds[index] = float(value)
+                if seconds[index] == 0:
+                    # stops recurring doses too
+                    self.model.set_recurring(rack, vial, 0, 0)
+        self.model.pump(seconds.reshape(PUMP_RACKS, self.vials))
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            writer.close()
+            return
+        lines = request.decode('latin-1').split('\r\n')
+        method = lines[0].split(' ')[0]
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        if headers.get('upgrade', '').lower() == 'websocket':
+            await self.websocket(reader, writer, headers)
+            return
+        if method == 'POST':
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            body = b'ok'
+            content_type = 'text/plain'
+        else:
+            # engine.io handshake, binary payload (0, length digits, 255)
+            packet = ('0' + json.dumps({'sid': uuid.uuid4().hex,
+                                        'upgrades': ['websocket'],
+                                        'pingInterval': PING_INTERVAL,
+                                        'pingTimeout': PING_TIMEOUT})).encode()
+            body = bytes([0] + [int(c) for c in str(len(packet))] + [255]) + \
+                packet
+            content_type = 'application/octet-stream'
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: %s\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+                      (content_type, len(body))).encode() + body)
+        await writer.drain()
+        writer.close()
+
+    async def websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + WEBSOCKET_GUID).encode()
+        ).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: %s\r\n\r\n' % accept).encode())
+        client = Client(writer)
+        try:
+            while True:
+                opcode, data = await read_frame(reader)
+                if opcode == 8:
+                    break
+                if opcode == 9:
+                    client.send(data, 10)
+                    continue
+                self.on_packet(client, data.decode())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        if client in self.clients:
+            self.clients.remove(client)
+            logger.info('port %d: client disconnected' % self.port)
+        writer.close()
+
+    def on_packet(self, client, text):
+        if text == '2probe':
+            client.send_text('3probe')
+        elif text.startswith('2'):
+            # engine.io ping
+            client.send_text('3')
+        elif text.startswith('40'):
+            client.send_text('40' + NAMESPACE)
+            if client not in self.clients:
+                self.clients.append(client)
+                logger.info('port %d: client connected' % self.port)
+        elif text.startswith('42'):
+            match = EVENT_PACKET.match(text)
+            if match is None:
+                logger.warning('bad event packet: %s' % text[:100])
+                return
+            event = json.loads(match.group(1))
+            try:
+                self.on_event(client, event[0], event[1:])
+            except Exception:
+                # a bad command does not close the connection
+                logger.exception('cannot handle %s event' % event[0])
+
+    async def broadcast(self):
+        interval = self.options.interval / self.options.speed
+        next_time = time.time() + interval
+        while True:
+            await asyncio.sleep(max(0, next_time - time.time()))
+            next_time += interval
+            data = self.broadcast_data()
+            self.broadcasts += 1
+            for client in list(self.clients):
+                client.emit('broadcast', data)
+
+    def summary(self):
+        return ('port {0}: {1} broadcasts, {2} commands, {3:.1f} simulated '
+                'hours, {4:.1f} mL pumped, OD {5}'.format(
+                    self.port, self.broadcasts, self.commands,
+                    self.model.time / 3600, self.model.pumped,
+                    np.round(self.model.od, 3).tolist()))
+
+
+class Client(object):
+    # websocket of a connected DPU
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data, opcode=1):
+        # unmasked frame, server to client
+        if self.writer.transport.is_closing():
+            return
+        header = bytearray([0x80 | opcode])
+        if len(data) < 126:
+            header.append(len(data))
+        elif len(data) < 65536:
+            header.append(126)
+            header += struct.pack('>H', len(data))
+        else:
+            header.append(127)
+            header += struct.pack('>Q', len(data))
+        self.writer.write(bytes(header) + data)
+
+    def send_text(self, text):
+        self.send(text.encode())
+
+    def emit(self, event, data):
+        self.send_text('42' + NAMESPACE + ',' + json.dumps([event, data]))
+
+
+async def read_frame(reader):
+    # (opcode, payload) of a websocket frame, client frames are masked
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    data = await reader.readexactly(length)
+    if mask is not None:
+        data = (np.frombuffer(data, dtype=np.uint8) ^
+                np.resize(np.frombuffer(mask, dtype=np.uint8),
+                          length)).tobytes()
+    return first & 0x0f, data
+
+
+def get_options():
+    description = ('Simulates one or more eVOLVERs locally, with a growth '
+                   'model of the cultures responding to the pump commands, '
+                   'to test the DPU without hardware.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8081,
+                        help='Port of the first eVOLVER (default: 8081)')
+    parser.add_argument('--servers', type=int, default=1,
+                        help='Number of eVOLVERs, on consecutive ports '
+                             '(default: 1)')
+    parser.add_argument('--vials', type=int, default=16,
+                        help='Vials per eVOLVER (default: 16)')
+    parser.add_argument('--interval', type=float, default=20,
+                        help='Simulated seconds between broadcasts '
+                             '(default: 20)')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='Simulated seconds per second, ex. 60 to '
+                             'broadcast every 20/60 s and grow cultures 60 '
+                             'times faster. Run the DPU with '
+                             '--simulator-clock to time the experiment on '
+                             'the simulated time (default: 1)')
+    parser.add_argument('--od-cal', default=os.path.join(TEMPLATE_DIR,
+                                                         'od_cal.json'),
+                        help='OD fit (sigmoid or linear) served and used '
+                             'for the raw readings')
+    parser.add_argument('--temp-cal', default=os.path.join(TEMPLATE_DIR,
+                                                           'temp_cal.json'),
+                        help='Temperature fit served and used for the raw '
+                             'readings')
+    parser.add_argument('--pump-cal', default=os.path.join(TEMPLATE_DIR,
+                                                           'pump_cal.txt'),
+                        help='Pump flow rates (mL/s)')
+    parser.add_argument('--growth-rate', type=float, default=0.5,
+                        help='Growth rate (1/h) without drug (default: 0.5)')
+    parser.add_argument('--growth-spread', type=float, default=0.2,
+                        help='Random per-vial variation of the growth rate, '
+                             'as a fraction (default: 0.2)')
+    parser.add_argument('--capacity', type=float, default=2.0,
+                        help='Carrying capacity (OD) (default: 2.0)')
+    parser.add_argument('--od-initial', type=float, default=0.05,
+                        help='OD at the start (default: 0.05)')
+    parser.add_argument('--volume', type=float, default=25,
+                        help='Culture volume (mL) (default: 25)')
+    parser.add_argument('--drug-a', type=float, default=1.0,
+                        help='Drug concentration of the drug A pump medium '
+                             '(default: 1.0)')
+    parser.add_argument('--drug-b', type=float, default=0.0,
+                        help='Drug concentration of the drug B pump medium '
+                             '(default: 0.0)')
+    parser.add_argument('--ic50', type=float, default=0.1,
+                        help='Drug concentration halving the growth rate '
+                             '(default: 0.1)')
+    parser.add_argument('--temp-initial', type=float, default=25,
+                        help='Temperature (C) at the start (default: 25)')
+    parser.add_argument('--temp-tau', type=float, default=600,
+                        help='Time constant (simulated s) of the '
+                             'temperature control (default: 600)')
+    parser.add_argument('--noise', type=float, default=0.002,
+                        help='Standard deviation of the OD readings '
+                             '(default: 0.002)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default: 0)')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
+                        '- %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if options.verbose
+                        else logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    evolvers = []
+    servers = []
+    for i in range(options.servers):
+        evolver = SimulatedEvolver(options, options.port + i,
+                                   np.random.RandomState(options.seed + i))
+        servers.append(loop.run_until_complete(asyncio.start_server(
+            evolver.handle, options.host, evolver.port)))
+        asyncio.ensure_future(evolver.broadcast())
+        evolvers.append(evolver)
+        logger.info('simulated eVOLVER on %s:%d' % (options.host,
+                                                    evolver.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.close()
+    for evolver in evolvers:
+        print(evolver.summary())
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+import os
+import logging
+import numpy as np
+
+from data_files import vial_file_path, tail_lines, tail_to_np
+from series_store import SeriesReader
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+
+def same_shape(a, b):
+    # whether a checkpointed value fits an attribute (arrays, lists, dicts)
+    if isinstance(a, dict):
+        return (isinstance(b, dict) and a.keys() == b.keys() and
+                all(same_shape(a[key], b[key]) for key in a))
+    return np.shape(a) == np.shape(b)
+
+
+class AlgorithmState(object):
+    """
+    Per-vial algorithm state that can be checkpointed: snapshot() returns the
+    CHECKPOINTED attributes (not copies), restore() sets them back. LOG_FILES
+    are the (directory, param) of the files load() reads the state from.
+    """
+
+    CHECKPOINTED = []
+    LOG_FILES = []
+
+    def log_paths(self, vial):
+        return [self.series.path(directory, vial, param)
+                for directory, param in self.LOG_FILES]
+
+    def snapshot(self):
+        return dict((name, getattr(self, name)) for name in self.CHECKPOINTED)
+
+    def restore(self, snapshot):
+        # False (and nothing restored) when the snapshot does not fit, e.g.
+        # it was taken with another number of vials
+        if sorted(snapshot) != sorted(self.CHECKPOINTED) or \
+                not all(same_shape(snapshot[name], getattr(self, name))
+                        for name in self.CHECKPOINTED):
+            return False
+        for name in self.CHECKPOINTED:
+            value = snapshot[name]
+            if isinstance(value, dict):
+                value = dict((key, np.array(v)) for key, v in value.items())
+            elif isinstance(value, list):
+                value = list(value)
+            else:
+                value = np.array(value)
+            setattr(self, name, value)
+        return True
+
+
+class ChemostatState(AlgorithmState):
+    """
+    Per-vial chemostat configuration kept in memory: when the last command
+    was set, the chemostat phase and the dilution period. New commands are
+    written through to the chemo_config files, which are only read on resume.
+    """
+
+    CHECKPOINTED = ['chemoset', 'chemophase', 'chemorate']
+    LOG_FILES = [('chemo_config', None)]
+
+    def __init__(self, writer, exp_dir, vial_count):
+        self.writer = writer
+        self.exp_dir = exp_dir
+        self.series = SeriesReader(exp_dir, writer)
+        # initial row of the chemo_config files: 0,0,0
+        self.chemoset = np.zeros(vial_count)
+        self.chemophase = np.zeros(vial_count)
+        self.chemorate = np.zeros(vial_count)
+
+    def load(self, vials):
+        # rehydrate from the last row of the chemo_config files
+        for x in vials:
+            path = vial_file_path(self.exp_dir, 'chemo_config', x)
+            data = tail_to_np(path, 1)
+            if data.size != 0:
+                self.chemoset[x] = data[-1][0]
+                self.chemophase[x] = data[-1][1]
+                self.chemorate[x] = data[-1][2]
+        logger.debug('chemostat periods: %s' % self.chemorate)
+
+    def record(self, vial, elapsed_time, period):
+        # note that this changes chemophase
+        phase = self.chemophase[vial] + 1
+        self.writer.write(vial_file_path(self.exp_dir, 'chemo_config', vial),
+                          "{0},{1},{2}\n".format(elapsed_time, phase, period))
+        self.chemoset[vial] = elapsed_time
+        self.chemophase[vial] = phase
+        self.chemorate[vial] = period
+
+
+class TurbidostatState(AlgorithmState):
+    """
+    Per-vial turbidostat state kept in memory: current OD setpoint, when it
+    was set, number of growth curves and last pump time. Changes are written
+    through to the ODset and pump_log files, which are only read on resume.
+    """
+
+    CHECKPOINTED = ['ODset', 'ODsettime', 'num_curves', 'last_pump']
+    LOG_FILES = [('ODset', None), ('pump_log', None)]
+
+    def __init__(self, writer, exp_dir, vial_count):
+        self.writer = writer
+        self.exp_dir = exp_dir
+        self.series = SeriesReader(exp_dir, writer)
+        self.ODset = np.zeros(vial_count)
+        self.ODsettime = np.zeros(vial_count)
+        # half the number of rows of the ODset file (header included)
+        self.num_curves = np.ones(vial_count)
+        self.last_pump = np.zeros(vial_count)
+
+    def load(self, vials):
+        # rehydrate from the last row of the log files
+        for x in vials:
+            data = self.series.tail('ODset', x, 1)
+            if data.size != 0:
+                self.ODsettime[x] = data[-1][0]
+                self.ODset[x] = data[-1][1]
+            # header line included
+            self.num_curves[x] = (self.series.count('ODset', x) + 1) / 2
+            data = self.series.tail('pump_log', x, 1)
+            if data.size != 0:
+                self.last_pump[x] = data[-1][0]
+        logger.debug('turbidostat setpoints: %s' % self.ODset)
+
+    def set_odset(self, vial, elapsed_time, odset):
+        self.writer.write_row(vial_file_path(self.exp_dir, 'ODset', vial),
+                              [elapsed_time, odset])
+        self.ODset[vial] = odset
+        self.ODsettime[vial] = elapsed_time
+        self.num_curves[vial] += 0.5
+
+    def record_pump(self, vial, elapsed_time, time_in, average_OD):
+        self.writer.write_row(vial_file_path(self.exp_dir, 'pump_log', vial),
+                              [elapsed_time, time_in, average_OD])
+        self.last_pump[vial] = elapsed_time
+
+
+class MorbidostatState(AlgorithmState):
+    """
+    Per-vial morbidostat PID state kept in memory: the P values of the last
+    cycles (integral window), drug concentrations, phase, last pump time and
+    last average OD. Every cycle is appended to the morbido_log and pump_log
+    files, which are only read on resume.
+    """
+
+    CHECKPOINTED = ['p_values', 'drug_a_conc', 'drug_b_conc', 'phase',
+                    'last_pump', 'last_average_OD']
+    LOG_FILES = [('morbido_log', None), ('pump_log', None)]
+
+    def __init__(self, writer, exp_dir, vial_count, integral_window=5):
+        self.writer = writer
+        self.exp_dir = exp_dir
+        self.series = SeriesReader(exp_dir, writer)
+        self.integral_window = integral_window
+        # P values of the last cycles, oldest first, zero-padded.
+        # initial row of the morbido_log files: 0,0,0,0,0,0,0,I
+        self.p_values = np.zeros((vial_count, integral_window))
+        self.drug_a_conc = np.zeros(vial_count)
+        self.drug_b_conc = np.zeros(vial_count)
+        self.phase = ['I'] * vial_count
+        # initial row of the pump_log files: 0,0,0
+        self.last_pump = np.zeros(vial_count)
+        self.last_average_OD = np.zeros(vial_count)
+
+    def load(self, vials):
+        # rehydrate from the last rows of the log files
+        for x in vials:
+            path = vial_file_path(self.exp_dir, 'morbido_log', x)
+            # time, p, i, d, pid, drug a conc., drug b conc., phase
+            rows = [line.split(',') for line in
+                    tail_lines(path, self.integral_window) if line]
+            if rows:
+                self.p_values[x] = 0.0
+                self.p_values[x, -len(rows):] = [float(row[1])
+                                                 for row in rows]
+                self.drug_a_conc[x] = float(rows[-1][5])
+                self.drug_b_conc[x] = float(rows[-1][6])
+                self.phase[x] = rows[-1][7]
+            for row in self.series.tail('pump_log', x, 1):
+                self._load_pump(x, row)
+        logger.debug('morbidostat phases: %s' % self.phase)
+
+    def _load_pump(self, vial, row):
+        self.last_pump[vial] = row[0]
+        self.last_average_OD[vial] = row[2]
+
+    def integral(self, vial):
+        # sum of the P values in the integral window
+        return self.p_values[vial].sum()
+
+    def integrals(self):
+        # integral of every vial
+        return self.p_values.sum(axis=1)
+
+    def record(self, vial, elapsed_time, p, i, d, pid, drug_a_conc,
+               drug_b_conc, phase):
+        # time, p, i, d, pid, drug a conc., drug b conc., phase
+        self.writer.write(vial_file_path(self.exp_dir, 'morbido_log', vial),
+                          "{0},{1},{2},{3},{4},{5},{6},{7}\n".format(
+                              elapsed_time, p, i, d, pid, drug_a_conc,
+                              drug_b_conc, phase))
+        self.p_values[vial, :-1] = self.p_values[vial, 1:]
+        self.p_values[vial, -1] = p
+        self.drug_a_conc[vial] = drug_a_conc
+        self.drug_b_conc[vial] = drug_b_conc
+        self.phase[vial] = phase
+
+    def record_pump(self, vial, elapsed_time, time_in, average_OD, *states):
+        # time, pump duration, average OD (+ drug states for timed morbidostat)
+        row = [elapsed_time, time_in, average_OD] + list(states)
+        self.writer.write_row(vial_file_path(self.exp_dir, 'pump_log', vial),
+                              row)
+        self.last_pump[vial] = elapsed_time
+        self.last_average_OD[vial] = average_OD
+
+
+class TimedMorbidostatState(MorbidostatState):
+    """
+    Morbidostat state plus the drug A/B timer states of the timed morbidostat
+    and an index of drug cycle starts (time and cycle count per drug), so the
+    pump log never has to be scanned. The index is appended to
+    drug_events/vialX_drug_events.txt and rebuilt from the pump log when
+    missing.
+    """
+
+    DRUGS = ['A', 'B']
+    CHECKPOINTED = MorbidostatState.CHECKPOINTED + ['a_state', 'b_state',
+                                                    'last_cycle', 'cycles']
+    LOG_FILES = MorbidostatState.LOG_FILES + [('drug_events', None)]
+
+    def __init__(self, writer, exp_dir, vial_count, integral_window=5):
+        MorbidostatState.__init__(self, writer, exp_dir, vial_count,
+                                  integral_window)
+        # last states written to the pump log (NaN when written as None)
+        self.a_state = np.zeros(vial_count)
+        self.b_state = np.zeros(vial_count)
+        # drug -> per-vial time of the last cycle start and number of cycles
+        self.last_cycle = dict((d, np.zeros(vial_count)) for d in self.DRUGS)
+        self.cycles = dict((d, np.zeros(vial_count, dtype=int))
+                           for d in self.DRUGS)
+
+    def _load_pump(self, vial, row):
+        MorbidostatState._load_pump(self, vial, row)
+        self.a_state[vial] = row[3]
+        self.b_state[vial] = row[4]
+
+    def load(self, vials):
+        MorbidostatState.load(self, vials)
+        for x in vials:
+            path = vial_file_path(self.exp_dir, 'drug_events', x)
+            if os.path.exists(path):
+                self.writer.flush(path)
+                with open(path) as f:
+                    events = [line.split(',') for line in f.read().splitlines()
+                              if line]
+            else:
+                events = self.rebuild_events(x)
+            for event_time, drug, cycle in events:
+                self.last_cycle[drug][x] = float(event_time)
+                self.cycles[drug][x] = int(cycle)
+        logger.debug('timed morbidostat drug cycles: %s' % self.cycles)
+
+    def rebuild_events(self, vial):
+        """
+        Rebuilds the drug event index of a vial from its pump log. A drug
+        cycle starts on the row where the drug state becomes 1, and its start
+        time is the time of the previous pump.
+        """
+        data = np.atleast_2d(self.series.read('pump_log', vial))
+        times = data[:, 0]
+        events = []
+        for drug, column in zip(self.DRUGS, [3, 4]):
+            starts = np.flatnonzero(data[:, column] == 1)
+            starts = starts[starts > 0]
+            for cycle, event_time in enumerate(times[starts - 1]):
+                events.append((event_time, drug, cycle + 1))
+        events.sort(key=lambda event: event[0])
+        path = vial_file_path(self.exp_dir, 'drug_events', vial)
+        # experiments started before the index existed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.writer.write(path, "".join("{0},{1},{2}\n".format(*event)
+                                        for event in events))
+        logger.info('rebuilt %d drug events for vial %d from the pump log' %
+                    (len(events), vial))
+        return events
+
+    def time_since_cycle(self, drug, elapsed_time):
+        # per vial: time since the last cycle of a drug started (or since the
+        # start of the experiment) and whether any cycle of that drug happened
+        return (elapsed_time - self.last_cycle[drug],
+                self.cycles[drug] > 0)
+
+    def record_pump(self, vial, elapsed_time, time_in, average_OD, a_state,
+                    b_state):
+        previous_pump = self.last_pump[vial]
+        for drug, new_state in zip(self.DRUGS, [a_state, b_state]):
+            if new_state == 1:
+                self.cycles[drug][vial] += 1
+                self.last_cycle[drug][vial] = previous_pump
+                self.writer.write(
+                    vial_file_path(self.exp_dir, 'drug_events', vial),
+                    "{0},{1},{2}\n".format(previous_pump, drug,
+                                           self.cycles[drug][vial]))
+        MorbidostatState.record_pump(self, vial, elapsed_time, time_in,
+                                     average_OD, a_state, b_state)
+        self.a_state[vial] = np.nan if a_state is None else a_state
+        self.b_state[vial] = np.nan if b_state is None else b_state
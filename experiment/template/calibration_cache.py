@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+
+class Calibration(object):
+    """
+    Fit received from the eVOLVER with its coefficients already converted to
+    a (vials x coefficients) numpy array.
+    """
+
+    def __init__(self, fit):
+        self.fit = fit
+        self.name = fit.get('name')
+        self.type = fit['type']
+        self.params = list(fit['params'])
+        self.coefficients = np.asarray(fit['coefficients'], dtype=np.float64)
+
+
+class CalibrationManager(object):
+    """
+    Loads each calibration file once and keeps it in memory. A calibration is
+    only read again from disk if the file changes (mtime or size) or a new
+    fit is written through update().
+    """
+
+    def __init__(self, paths):
+        # calibration type ('od', 'temperature') -> json file path
+        self.paths = dict(paths)
+        self._cache = {}
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def add(self, calibration_type, path):
+        # e.g. the calibrations of another eVOLVER under its own key
+        if self.paths.get(calibration_type) != path:
+            self._cache.pop(calibration_type, None)
+        self.paths[calibration_type] = path
+
+    def get(self, calibration_type):
+        path = self.paths[calibration_type]
+        signature = self._signature(path)
+        if signature is None:
+            self._cache.pop(calibration_type, None)
+            return None
+        cached = self._cache.get(calibration_type)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        logger.info('loading %s calibration from %s' % (calibration_type,
+                                                         path))
+        with open(path) as f:
+            calibration = Calibration(json.load(f))
+        self._cache[calibration_type] = (signature, calibration)
+        return calibration
+
+    def update(self, calibration_type, fit):
+        path = self.paths[calibration_type]
+        with open(path, 'w') as f:
+            json.dump(fit, f)
+        calibration = Calibration(fit)
+        self._cache[calibration_type] = (self._signature(path), calibration)
+        return calibration
+
+    def invalidate(self, calibration_type=None):
+        if calibration_type is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(calibration_type, None)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import os
+import copy
+import time
+import pickle
+import logging
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# version of the checkpoint format, checkpoints of newer versions are ignored
+CHECKPOINT_VERSION = 2
+
+
+def same_state(a, b):
+    # deep comparison of states (dicts, lists, numpy arrays, numbers), NaN
+    # equal to NaN
+    if isinstance(a, dict):
+        return (isinstance(b, dict) and a.keys() == b.keys() and
+                all(same_state(a[key], b[key]) for key in a))
+    if isinstance(a, (list, tuple)):
+        return (isinstance(b, (list, tuple)) and len(a) == len(b) and
+                all(same_state(x, y) for x, y in zip(a, b)))
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a = np.asarray(a)
+        b = np.asarray(b)
+        if a.shape != b.shape or a.dtype.kind != b.dtype.kind:
+            return False
+        if a.dtype.kind == 'f':
+            return bool(((a == b) | (np.isnan(a) & np.isnan(b))).all())
+        return bool((a == b).all())
+    if isinstance(a, float) and isinstance(b, float) and \
+            np.isnan(a) and np.isnan(b):
+        return True
+    return type(a) == type(b) and a == b
+
+
+class Checkpoint(object):
+    """
+    State needed to resume an experiment, as a dict of numbers, numpy
+    arrays, lists and dicts of those. save() writes it only when it changed
+    since the last save, to a temporary file renamed over the checkpoint so
+    a crash never leaves half of it. Every checkpoint written gets the next
+    sequence number.
+
+    Along with the state a checkpoint holds:
+    - data: bulk data that changes all the time (e.g. the OD buffer), given
+      by a function called when the checkpoint is written. It is not
+      compared, the checkpoint is written anyway every 'interval' seconds to
+      refresh it.
+    - markers: the sizes of the files (given by a function) when the
+      checkpoint was written, to tell on resume which files were appended
+      to since.
+    """
+
+    def __init__(self, path, writer=None, data=None, files=None,
+                 interval=None):
+        self.path = path
+        # DataWriter running the writes in order with the data files, None to
+        # write at once
+        self.writer = writer
+        self.get_data = data
+        self.get_files = files
+        self.interval = interval
+        self.sequence = 0
+        # when the last checkpoint was written
+        self.time = None
+        # data and markers (path -> size) of the loaded checkpoint
+        self.data = None
+        self.markers = {}
+        self._saved = None
+
+    def load(self):
+        # the state of the last checkpoint, None if there is none usable
+        try:
+            with open(self.path, 'rb') as f:
+                record = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('cannot read checkpoint %s: %s' % (self.path, e))
+            return None
+        if not isinstance(record, dict) or \
+                record.get('version', 0) > CHECKPOINT_VERSION:
+            logger.warning('checkpoint %s has an unknown format, ignoring '
+                           'it' % self.path)
+            return None
+        self.sequence = record['sequence']
+        self.time = record['time']
+        self._saved = record['state']
+        self.data = record.get('data')
+        directory = os.path.dirname(self.path)
+        self.markers = dict((os.path.join(directory, path), size) for
+                            path, size in record.get('markers', {}).items())
+        logger.info('loaded checkpoint %d of %s' %
+                    (self.sequence, time.ctime(record['time'])))
+        return copy.deepcopy(record['state'])
+
+    def save(self, state, now=None):
+        """
+        Writes the state if it changed since the last checkpoint, or if the
+        data is more than 'interval' seconds old. Returns whether it was
+        written.
+        """
+        if now is None:
+            now = time.time()
+        if (self._saved is not None and same_state(state, self._saved) and
+                (self.interval is None or now - self.time < self.interval)):
+            return False
+        self._saved = copy.deepcopy(state)
+        self.sequence += 1
+        self.time = now
+        record = {'version': CHECKPOINT_VERSION,
+                  'sequence': self.sequence,
+                  'time': now,
+                  'state': self._saved,
+                  'data': None}
+        if self.get_data is not None:
+            record['data'] = copy.deepcopy(self.get_data())
+        logger.debug('writing checkpoint %d' % self.sequence)
+        if self.writer is None:
+            self._write(record)
+        else:
+            self.writer.run(self._write, record)
+        return True
+
+    def file_markers(self):
+        # sizes of the files, relative to the checkpoint directory
+        markers = {}
+        if self.get_files is None:
+            return markers
+        directory = os.path.dirname(self.path)
+        for path in self.get_files():
+            if self.writer is not None:
+                size = self.writer.offset(path)
+            elif os.path.exists(path):
+                size = os.path.getsize(path)
+            else:
+                size = 0
+            markers[os.path.relpath(path, directory)] = size
+        return markers
+
+    def _write(self, record):
+        # after everything written before (see DataWriter.run)
+        record['markers'] = self.file_markers()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import re
+import select
+import asyncio
+import logging
+
+from socketIO_client import SocketIO, BaseNamespace
+from socketIO_client.exceptions import (ConnectionError, TimeoutError,
+                                        PacketError)
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = '/dpu-evolver'
+# request -> event the eVOLVER answers with
+RESPONSES = {'getactivecal': 'activecalibrations',
+             'getcalibration': 'calibration',
+             'getcalibrationnames': 'calibrationnames'}
+# seconds to wait for the answer to a request
+REQUEST_TIMEOUT = 30
+# seconds between reconnection attempts
+RECONNECT_INTERVAL = 5
+# seconds between checks that the watched socket is still the connection's
+# (socketIO_client silently reconnects when sending fails)
+WATCH_INTERVAL = 1
+# seconds a read may block once the socket is readable (partial frame)
+READ_TIMEOUT = 1
+# event name of a socket.io event packet, ex. 2/dpu-evolver,["broadcast",...
+EVENT_PACKET = re.compile(br'2(?:/[^,]*,)?\d*\["([^"]*)"')
+
+
+def event_name(packet):
+    # socket.io event of an engine.io packet, None for other packets
+    engineIO_packet_type, engineIO_packet_data = packet
+    if engineIO_packet_type != 4:
+        return None
+    match = EVENT_PACKET.match(engineIO_packet_data)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+class EvolverConnection(object):
+    """
+    socket.io connection to an eVOLVER driven by an asyncio event loop.
+    Packets are read and handled by the namespace when the websocket becomes
+    readable (or when a long-poll returns, without a websocket), so nothing
+    waits in a loop. Requests the eVOLVER answers with an event, like
+    getactivecal, can be awaited with a timeout.
+
+    Every packet already received is read at once. While the namespace
+    handles a broadcast, its 'backlog' attribute is the number of newer
+    broadcasts queued behind it (the handlers were too slow), so it can
+    coalesce them.
+
+    An exception raised by a handler stops the loop and is raised again by
+    run_forever(), unless stop_on_error is False (the loop is shared by
+    other connections), then it is logged and the next packets handled.
+    """
+
+    def __init__(self, ip, port, loop=None, stop_on_error=True):
+        self.ip = ip
+        self.port = port
+        self.loop = loop or asyncio.new_event_loop()
+        self.stop_on_error = stop_on_error
+        # exception of a handler, raised by run_forever()
+        self.error = None
+        self.socketIO = None
+        self.namespace = None
+        # response event -> futures of the requests waiting for it
+        self.pending = {}
+        self._transport = None
+        self._fd = None
+        self._polling = None
+        self._watch_handle = None
+        self._reconnecting = False
+        self._closed = False
+
+    def connect(self, Namespace=BaseNamespace, wait_for_connection=True):
+        """
+        Opens the connection and the eVOLVER namespace (blocking), then
+        handles incoming packets on the event loop. Returns the namespace.
+        """
+        self.socketIO = SocketIO(self.ip, self.port,
+                                 wait_for_connection=wait_for_connection)
+        self.namespace = self.socketIO.define(Namespace, NAMESPACE)
+        self._closed = False
+        self._watch()
+        return self.namespace
+
+    def disconnect(self):
+        self._closed = True
+        self._unwatch()
+        if self._watch_handle is not None:
+            self._watch_handle.cancel()
+            self._watch_handle = None
+        self._fail_pending(ConnectionError('disconnected'))
+        self.socketIO.disconnect()
+
+    def reconnect(self):
+        # reopens a connection closed with disconnect() (blocking)
+        self.socketIO.connect()
+        self._closed = False
+        self._watch()
+
+    def run_forever(self):
+        self.loop.run_forever()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def emit(self, event, *args):
+        self.namespace.emit(event, *args)
+        self._watch()
+
+    async def request(self, event, data=None, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a request and returns the data of the event the eVOLVER
+        answers with. Raises asyncio.TimeoutError after timeout seconds.
+        Concurrent requests of the same kind all get the first answer.
+        """
+        response = RESPONSES[event]
+        if response not in self.pending:
+            self.pending[response] = []
+            self.namespace.on(response, self._responder(response))
+        future = self.loop.create_future()
+        self.pending[response].append(future)
+        try:
+            if data is None:
+                self.emit(event)
+            else:
+                self.emit(event, data)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future in self.pending[response]:
+                self.pending[response].remove(future)
+
+    async def get_active_calibrations(self, timeout=REQUEST_TIMEOUT):
+        return await self.request('getactivecal', timeout=timeout)
+
+    async def get_calibration(self, name, timeout=REQUEST_TIMEOUT):
+        return await self.request('getcalibration', {'name': name},
+                                  timeout=timeout)
+
+    async def get_calibration_names(self, timeout=REQUEST_TIMEOUT):
+        return await self.request('getcalibrationnames', timeout=timeout)
+
+    def _responder(self, response):
+        # the namespace method (ex. on_activecalibrations) still handles
+        # the event, the waiting requests get its data
+        handler = getattr(self.namespace, 'on_' + response, None)
+
+        def respond(*args):
+            data = args[0] if len(args) == 1 else list(args)
+            if handler is not None:
+                handler(*args)
+            for future in self.pending[response]:
+                if not future.done():
+                    future.set_result(data)
+        return respond
+
+    def _fail_pending(self, error):
+        for futures in self.pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+
+    def _watch(self):
+        # (re)registers the socket of the current transport with the loop
+        if self._watch_handle is None:
+            self._watch_handle = self.loop.call_later(WATCH_INTERVAL,
+                                                      self._check_transport)
+        transport = self.socketIO._transport_instance
+        if self._closed or not self.socketIO.connected or \
+                transport is self._transport:
+            return
+        self._unwatch()
+        self._transport = transport
+        if self.socketIO.transport_name == 'websocket':
+            transport.set_timeout(READ_TIMEOUT)
+            self._fd = transport._connection.fileno()
+            self.loop.add_reader(self._fd, self._on_readable)
+        else:
+            logger.warning('no websocket to %s:%s, long-polling' %
+                           (self.ip, self.port))
+            self._polling = asyncio.ensure_future(self._poll(transport),
+                                                  loop=self.loop)
+
+    def _unwatch(self):
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+        if self._polling is not None:
+            self._polling.cancel()
+            self._polling = None
+        self._transport = None
+
+    def _check_transport(self):
+        self._watch_handle = None
+        if not self._closed:
+            self._watch()
+
+    def _on_readable(self):
+        packets = []
+        try:
+            # read every frame already received, not only the first one
+            while True:
+                packets.extend(self._transport.recv_packet())
+                if not select.select([self._fd], [], [], 0)[0]:
+                    break
+        except TimeoutError:
+            pass
+        except ConnectionError as e:
+            self._dispatch(packets)
+            self._connection_lost(e)
+            return
+        self._dispatch(packets)
+
+    async def _poll(self, transport):
+        # hurried heartbeats make the server answer long-polls every second
+        self.socketIO._heartbeat_thread.hurry()
+        while True:
+            try:
+                packets = await self.loop.run_in_executor(
+                    None, lambda: list(transport.recv_packet()))
+            except TimeoutError:
+                continue
+            except ConnectionError as e:
+                self._polling = None
+                self._connection_lost(e)
+                return
+            self._dispatch(packets)
+
+    def _dispatch(self, packets):
+        events = [event_name(packet) for packet in packets]
+        backlog = events.count('broadcast')
+        try:
+            for packet, event in zip(packets, events):
+                if event == 'broadcast':
+                    backlog -= 1
+                    self.namespace.backlog = backlog
+                try:
+                    self.socketIO._process_packet(packet)
+                except PacketError as e:
+                    logger.warning('packet error: %s' % e)
+                except Exception as e:
+                    if self.stop_on_error:
+                        self._handler_failed(e)
+                        return
+                    logger.exception('%s event of %s:%s failed' %
+                                     (event, self.ip, self.port))
+        finally:
+            self.namespace.backlog = 0
+        # handlers may have reconnected while sending
+        self._watch()
+
+    def _handler_failed(self, error):
+        # the packets left are dropped, run_forever() raises the error
+        if self.error is None:
+            self.error = error
+        self.loop.stop()
+
+    def _connection_lost(self, error):
+        logger.warning('connection to %s:%s lost (%s)' %
+                       (self.ip, self.port, error))
+        self._unwatch()
+        self.socketIO._opened = False
+        self._fail_pending(ConnectionError(error))
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if not self._reconnecting and not self._closed:
+            self._reconnecting = True
+            self.loop.call_later(RECONNECT_INTERVAL,
+                                 lambda: asyncio.ensure_future(
+                                     self._reconnect(), loop=self.loop))
+
+    async def _reconnect(self):
+        try:
+            # reopens the engine.io session and the namespace
+            await self.loop.run_in_executor(
+                None, lambda: self.socketIO._transport)
+        except (ConnectionError, TimeoutError) as e:
+            logger.info('reconnection to %s:%s failed (%s)' %
+                        (self.ip, self.port, e))
+            self._reconnecting = False
+            self._schedule_reconnect()
+            return
+        self._reconnecting = False
+        logger.info('reconnected to %s:%s' % (self.ip, self.port))
+        self._watch()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import abc
+import logging
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# operation mode -> controller class. Register new controllers (e.g. in
+# custom_script.py) with @register_controller('operation_mode').
+CONTROLLERS = {}
+
+# pump racks of the fluid command: media, drug A, drug B
+PUMP_RACKS = 3
+
+
+def register_controller(operation_mode):
+    def decorator(cls):
+        CONTROLLERS[operation_mode] = cls
+        cls.name = operation_mode
+        return cls
+    return decorator
+
+
+def format_value(value):
+    # pump times as the eVOLVER expects them, e.g. '5' or '12.34'
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Commands(object):
+    """
+    Commands returned by a controller for all vials at once. Pump times are
+    in seconds (NaN leaves a pump unchanged), None leaves a command out.
+    """
+
+    def __init__(self, vial_count):
+        # one row per pump rack (media, drug A, drug B)
+        self.pump = np.full((PUMP_RACKS, vial_count), np.nan)
+        # seconds to run the suction pump (last value of the fluid command)
+        self.suction = None
+        # per-vial stir rates
+        self.stir = None
+        # per-vial temperature setpoints (C)
+        self.temp = None
+        # recurring chemostat commands: per-vial bolus (s) and period (s)
+        self.chemo = None
+
+    def fluid_message(self):
+        # 48 values fluid command, None if no pump is turned on
+        if np.isnan(self.pump).all() and self.suction is None:
+            return None
+        message = ['--'] * self.pump.size
+        for index in np.flatnonzero(~np.isnan(self.pump.ravel())):
+            message[index] = format_value(self.pump.ravel()[index])
+        if self.suction is not None:
+            message[-1] = format_value(self.suction)
+        return message
+
+
+class Controller(abc.ABC):
+    """
+    Base class of the control algorithms. The configuration is parsed once
+    from the options into per-vial numpy arrays, then step() is called on
+    every broadcast with the transformed OD and temperature arrays and the
+    algorithm state, and returns Commands for all vials. Subclasses must
+    implement step().
+    """
+
+    # operation mode, set by register_controller
+    name = None
+    # algorithm state class, created with (writer, exp_dir, vial_count)
+    state_class = None
+
+    def __init__(self, options, vials):
+        self.options = options
+        self.vial_count = len(vials)
+        # vials under control, can be restricted (ex. [0,1,2,3])
+        self.active = np.zeros(self.vial_count, dtype=bool)
+        self.active[list(vials)] = True
+        # Number of values to calculate the OD average
+        self.window = options.to_avg
+
+    def per_vial(self, value):
+        # to set all vials to the same value, creates a per-vial array
+        return np.full(self.vial_count, value, dtype=np.float64)
+
+    def create_state(self, writer, exp_dir):
+        if self.state_class is None:
+            return None
+        return self.state_class(writer, exp_dir, self.vial_count)
+
+    def valid_vials(self, eVOLVER):
+        # mask of the vials whose readings came in with this broadcast
+        if eVOLVER.valid is None:
+            return np.ones(self.vial_count, dtype=bool)
+        return eVOLVER.valid
+
+    def average_od(self, eVOLVER):
+        """
+        Median of the last 'to_avg' OD values of every vial (to avoid
+        outliers) and the mask of the vials that have enough values and
+        whose readings came in with this broadcast. Kept up to date as the
+        OD values arrive (see rolling_median.py), the OD buffer is only
+        sorted for another window.
+        """
+        od_filter = eVOLVER.od_filter
+        if od_filter is not None and od_filter.window == self.window:
+            average_OD, ready = od_filter.median(), od_filter.ready()
+        else:
+            rows, ready = eVOLVER.od_buffer.tail_all(self.window)
+            average_OD = np.full(self.vial_count, np.nan)
+            if ready.any():
+                average_OD[ready] = np.median(rows[ready, :, 1], axis=1)
+        for x in np.flatnonzero(self.active & ~ready):
+            logger.debug('not enough OD measurements for vial %d' % x)
+        return average_OD, ready & self.valid_vials(eVOLVER)
+
+    def od_spread(self, eVOLVER, threshold=3.0):
+        """
+        Median absolute deviation of the last 'to_avg' OD values of every
+        vial and the mask of the vials whose last OD value is an outlier
+        (more than 'threshold' robust standard deviations from the median),
+        e.g. to hold a dilution on a bubble reading.
+        """
+        return eVOLVER.od_filter.mad(), eVOLVER.od_filter.outliers(threshold)
+
+    @abc.abstractmethod
+    def step(self, eVOLVER, od, temp, state, elapsed_time):
+        # Commands for all vials, after a broadcast
+        pass
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import os
+import io
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+
+def vial_file_path(exp_dir, directory, vial, param=None):
+    # e.g. <exp_dir>/ODset/vial3_ODset.txt
+    if param is None:
+        param = directory
+    file_name = "vial{0}_{1}.txt".format(vial, param)
+    return os.path.join(exp_dir, directory, file_name)
+
+
+def tail_lines(path, window=10, BUFFER_SIZE=512):
+    """
+    Reads file from the end and returns its last 'window' lines (fewer if the
+    file is shorter) as strings.
+    """
+    if window == 0:
+        return []
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        remaining_bytes = f.tell()
+        size = window + 1  # Read one more line to avoid broken lines
+        block = -1
+        data = []
+
+        while size > 0 and remaining_bytes > 0:
+            if remaining_bytes - BUFFER_SIZE > 0:
+                # Seek back one whole BUFFER_SIZE
+                f.seek(block * BUFFER_SIZE, os.SEEK_END)
+                # read BUFFER
+                bunch = f.read(BUFFER_SIZE)
+            else:
+                # file too small, start from beginning
+                f.seek(0, 0)
+                # only read what was not read
+                bunch = f.read(remaining_bytes)
+
+            bunch = bunch.decode('utf-8')
+            data.append(bunch)
+            size -= bunch.count('\n')
+            remaining_bytes -= BUFFER_SIZE
+            block -= 1
+
+    return ''.join(reversed(data)).splitlines()[-window:]
+
+
+def tail_to_np(path, window=10, BUFFER_SIZE=512):
+    """
+    Reads file from the end and returns a numpy array with the data of the last 'window' lines.
+    Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
+    """
+    data = tail_lines(path, window, BUFFER_SIZE)
+
+    if window == 0 or len(data) < window:
+        # Not enough data
+        return np.asarray([])
+
+    for c, v in enumerate(data):
+        data[c] = v.split(',')
+
+    try:
+        data = np.asarray(data, dtype=np.float64)
+        return data
+    except ValueError:
+        # It is reading the header
+        return np.asarray([])
+
+
+def count_lines(path, BUFFER_SIZE=65536):
+    # number of lines in a file, without parsing it
+    lines = 0
+    with open(path, 'rb') as f:
+        bunch = f.read(BUFFER_SIZE)
+        while bunch:
+            lines += bunch.count(b'\n')
+            bunch = f.read(BUFFER_SIZE)
+    return lines
+
+
+def file_size(path):
+    # size in bytes, 0 if the file does not exist (yet)
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def read_rows(path, offset=0, skip_header=0, columns=2, end=None):
+    """
+    Parses the rows of a file after a byte offset (up to another one, if
+    given) in one vectorized pass, a lot faster than np.genfromtxt. Returns a
+    (rows x columns) array, values that are not numbers (e.g. None) are read
+    as NaN like with genfromtxt.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for _ in range(skip_header):
+            f.readline()
+        if end is None:
+            text = f.read()
+        else:
+            text = f.read(max(end - f.tell(), 0))
+    lines = text.splitlines()
+    if not lines:
+        return np.empty((0, columns))
+    values = b','.join(lines).split(b',')
+    if len(values) == len(lines) * columns:
+        try:
+            return np.array(values, dtype=np.float64).reshape(-1, columns)
+        except ValueError:
+            pass
+    # values that are not numbers or rows of other lengths, slow path
+    data = np.genfromtxt(io.BytesIO(text), delimiter=',',
+                         invalid_raise=False)
+    return np.asarray(data, dtype=np.float64).reshape(-1, columns)
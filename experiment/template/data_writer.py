@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+from data_files import read_rows
+from series_store import (SERIES_FORMATS, INDEX_STRIDE, binary_path,
+                          encode_header, encode_row, read_columns,
+                          text_header_lines, index_path, read_index,
+                          build_index, encode_index_header,
+                          encode_index_entry)
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# When buffered rows are written to disk:
+# broadcast: at the end of every broadcast
+# interval: at the end of a broadcast, if flush_interval seconds have passed
+# pump: only on pump events (with fsync) and when closing
+FLUSH_POLICIES = ['broadcast', 'interval', 'pump']
+
+
+class DataWriter(object):
+    """
+    Appends lines to the experiment files through file handles that are kept
+    open between broadcasts. Rows are buffered in memory and written
+    according to the flush policy. Rows of the per-vial series go to text
+    and/or binary files depending on the series format (see
+    series_store.py), text files get a time index as they grow.
+    """
+
+    def __init__(self, flush_policy='broadcast', flush_interval=10,
+                 max_open_files=256, series_format='text'):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError('unknown flush policy %s' % flush_policy)
+        if series_format not in SERIES_FORMATS:
+            raise ValueError('unknown series format %s' % series_format)
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self.series_format = series_format
+        self._files = OrderedDict()
+        # binary file -> number of columns
+        self._columns = {}
+        # text file -> [size, rows since the last index entry]
+        self._indexed = {}
+        self._last_flush = time.time()
+
+    def _get_file(self, path, mode='a'):
+        f = self._files.get(path)
+        if f is None:
+            if len(self._files) >= self.max_open_files:
+                # close the least recently used handle
+                old_path, old_file = self._files.popitem(last=False)
+                old_file.close()
+            f = open(path, mode)
+            self._files[path] = f
+        else:
+            self._files.move_to_end(path)
+        return f
+
+    def write(self, path, line):
+        self._get_file(path).write(line)
+
+    def write_bytes(self, path, data):
+        # binary records (e.g. of the journal, see journal.py)
+        DataWriter._get_file(self, path, 'ab').write(data)
+
+    def write_row(self, path, values):
+        """
+        Appends a row of values to the series of a text file path: to the
+        binary file and/or as a comma-separated line to the text file.
+        """
+        if self.series_format != 'text':
+            bin_path = binary_path(path)
+            if bin_path not in self._columns:
+                self._create_series(path, len(values))
+            DataWriter._get_file(self, bin_path, 'ab').write(
+                encode_row(values, self._columns[bin_path]))
+        if self.series_format != 'binary':
+            line = ','.join(str(value) for value in values) + '\n'
+            DataWriter._index_row(self, path, values[0], line)
+            DataWriter.write(self, path, line)
+
+    def _index_row(self, path, row_time, line):
+        # index entry for every INDEX_STRIDE rows of a text file
+        state = self._indexed.get(path)
+        if state is None:
+            state = self._open_index(path)
+        if state[1] >= INDEX_STRIDE:
+            try:
+                entry = encode_index_entry(float(row_time), state[0])
+            except (TypeError, ValueError):
+                entry = None
+            if entry is not None:
+                DataWriter._get_file(self, index_path(path), 'ab').write(
+                    entry)
+                state[1] = 0
+        # bytes written, with the newlines translated
+        state[0] += len(line) + line.count('\n') * (len(os.linesep) - 1)
+        state[1] += 1
+
+    def _open_index(self, path):
+        # the index of a text file written before (e.g. by an older version
+        # or another run) is completed first, entries past the end of the
+        # file (the DPU stopped before writing the rows) are dropped
+        size = DataWriter.offset(self, path)
+        entries = read_index(path)
+        rows = INDEX_STRIDE
+        if entries is None or (len(entries) and
+                               entries['offset'][-1] >= size):
+            contents = encode_index_header()
+            if size > 0:
+                contents, size, rows = build_index(path)
+            DataWriter.flush(self, index_path(path))
+            with open(index_path(path), 'wb') as f:
+                f.write(contents)
+        state = self._indexed[path] = [size, rows]
+        return state
+
+    def create_series(self, path):
+        # binary file of a series with the rows of its text file so far
+        self._create_series(path)
+
+    def _create_series(self, path, columns=None):
+        bin_path = binary_path(path)
+        if os.path.exists(bin_path) and os.path.getsize(bin_path) > 0:
+            self._columns[bin_path] = read_columns(bin_path)
+            return
+        rows = None
+        if os.path.exists(path):
+            DataWriter.flush(self, path)
+            with open(path, 'rb') as f:
+                lines = f.read().splitlines()
+            header = text_header_lines(path)
+            if len(lines) > header:
+                columns = lines[-1].count(b',') + 1
+                try:
+                    rows = read_rows(path, skip_header=header,
+                                     columns=columns)
+                except ValueError:
+                    logger.warning('cannot convert %s to binary' % path)
+        if columns is None:
+            # no rows yet, created with the first one
+            return
+        logger.debug('creating %s with %d rows' %
+                     (bin_path, 0 if rows is None else len(rows)))
+        with open(bin_path, 'wb') as f:
+            f.write(encode_header(columns))
+            if rows is not None:
+                f.write(rows.astype('=f8').tobytes())
+        self._columns[bin_path] = columns
+
+    def run(self, func, *args):
+        # other persistence work (e.g. pickling variables)
+        func(*args)
+
+    def offset(self, path):
+        # size of a file with the rows written so far (only call it from
+        # functions given to run(), so it is in order with the writes)
+        f = self._files.get(path)
+        if f is not None:
+            f.flush()
+            return os.fstat(f.fileno()).st_size
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        return 0
+
+    def _flush_all(self):
+        for f in self._files.values():
+            f.flush()
+        self._last_flush = time.time()
+
+    def _sync_all(self):
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self._last_flush = time.time()
+
+    def flush(self, path=None):
+        # flush one file (e.g. before reading it back) or all of them
+        if path is None:
+            self._flush_all()
+            return
+        f = self._files.get(path)
+        if f is not None:
+            f.flush()
+
+    def sync(self):
+        # flush and make sure the data reached the disk
+        self._sync_all()
+
+    def end_broadcast(self):
+        if self.flush_policy == 'broadcast':
+            self._flush_all()
+        elif self.flush_policy == 'interval':
+            if time.time() - self._last_flush >= self.flush_interval:
+                self._flush_all()
+
+    def pump_event(self):
+        if self.flush_policy == 'pump':
+            self._sync_all()
+
+    def close(self):
+        # files are opened again on the next write
+        logger.debug('closing %d data files' % len(self._files))
+        self._sync_all()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+class AsyncDataWriter(DataWriter):
+    """
+    DataWriter whose disk I/O is done by a background thread, so a slow disk
+    never blocks the broadcast handler. Work is handed over through a bounded
+    queue: when it is full the handler waits (backpressure), which is counted
+    in stats.
+    """
+
+    def __init__(self, flush_policy='broadcast', flush_interval=10,
+                 max_open_files=256, queue_size=10000, series_format='text'):
+        DataWriter.__init__(self, flush_policy, flush_interval,
+                            max_open_files, series_format)
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self.stats = {'queued': 0, 'blocked': 0, 'blocked_time': 0.0,
+                      'max_depth': 0, 'errors': 0}
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error('data writer error: %s' % str(e))
+            finally:
+                self._queue.task_done()
+
+    def _put(self, func, *args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker,
+                                            name='data-writer')
+            self._thread.daemon = True
+            self._thread.start()
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            self.stats['blocked'] += 1
+            if self.stats['blocked'] % 100 == 1:
+                logger.warning('data writer queue full, waiting for disk '
+                               '(%d times so far)' % self.stats['blocked'])
+            start = time.time()
+            self._queue.put((func, args))
+            self.stats['blocked_time'] += time.time() - start
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'],
+                                      self._queue.qsize())
+
+    def drain(self):
+        # wait until everything queued so far has been written
+        self._queue.join()
+
+    def write(self, path, line):
+        self._put(DataWriter.write, self, path, line)
+
+    def write_bytes(self, path, data):
+        self._put(DataWriter.write_bytes, self, path, data)
+
+    def write_row(self, path, values):
+        self._put(DataWriter.write_row, self, path, values)
+
+    def create_series(self, path):
+        self._put(DataWriter.create_series, self, path)
+
+    def run(self, func, *args):
+        self._put(func, *args)
+
+    def flush(self, path=None):
+        if path is None:
+            self._put(self._flush_all)
+            return
+        # a file is about to be read back, it must be complete
+        self.drain()
+        DataWriter.flush(self, path)
+
+    def sync(self):
+        self._put(self._sync_all)
+
+    def end_broadcast(self):
+        self._put(DataWriter.end_broadcast, self)
+        logger.debug('data writer queue: %d, stats: %s' %
+                     (self._queue.qsize(), self.stats))
+
+    def pump_event(self):
+        self._put(DataWriter.pump_event, self)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        DataWriter.close(self)
@@ -11,30 +11,52 @@ import shutil
 import logging
 import argparse
 import numpy as np
-import json
 import traceback
 from scipy import stats
-from socketIO_client import SocketIO, BaseNamespace
+from socketIO_client import BaseNamespace
 
 import custom_script
 from custom_script import EVOLVER_IP, EVOLVER_PORT
+import data_files
+from ring_buffer import VialRingBuffer
+from rolling_median import RollingMedian
+from growth_rate import GrowthRateEstimator
+import controllers
+from connection import EvolverConnection, NAMESPACE
+from calibration_cache import CalibrationManager
+from latency import LatencyStats, StatusServer
+from checkpoint import Checkpoint
+from journal import Journal, JOURNAL_DIRECTORY, is_journal_field
+import replay
+import transforms
+from data_writer import DataWriter, AsyncDataWriter, FLUSH_POLICIES
+from series_store import SeriesReader, SERIES_FORMATS, is_series
 
 # See get_options() for config of options.
-options = None
-OPERATION_MODE = None
-EXP_NAME = None
 # tab delimited, mL/s with 16 influx pumps on first row, etc.
 PUMP_CAL_FILE = 'pump_cal.txt'
 SAVE_PATH = os.path.dirname(os.path.realpath(__file__))
-EXP_DIR = None
-TEMP_INITIAL = None
-OD_CAL_PATH = os.path.join(SAVE_PATH, 'od_cal.json')
-TEMP_CAL_PATH = os.path.join(SAVE_PATH, 'temp_cal.json')
+# calibration type -> file, in the calibration directory of an eVOLVER
+CALIBRATION_FILES = {'od': 'od_cal.json', 'temperature': 'temp_cal.json'}
+OD_CAL_PATH = os.path.join(SAVE_PATH, CALIBRATION_FILES['od'])
+TEMP_CAL_PATH = os.path.join(SAVE_PATH, CALIBRATION_FILES['temperature'])
+# Calibrations are kept in memory and only reloaded when the files change.
+# Shared by all the eVOLVERs driven by this process (see fleet.py).
+CALIBRATIONS = CalibrationManager({'od': OD_CAL_PATH,
+                                   'temperature': TEMP_CAL_PATH})
 # Should not be changed. Vials to be considered/excluded should be handled inside the custom functions.
 VIALS = [x for x in range(16)]
-SIGMOID = 'sigmoid'
-LINEAR = 'linear'
-THREE_DIMENSION = '3d'
+# Number of recent OD rows per vial kept in memory for the custom functions.
+OD_BUFFER_SIZE = 512
+# per-stage broadcast handling times, in the experiment directory
+LATENCY_FILE = 'latency.json'
+# state needed to resume an experiment, see checkpoint.py
+CHECKPOINT_FILE = 'checkpoint.pickle'
+# What to do with broadcasts that queued up while the DPU was busy:
+# process: handle all of them
+# store: save all of them, run the custom functions on the newest only
+# latest: only handle the newest
+BACKLOG_POLICIES = ['process', 'store', 'latest']
 
 logger = logging.getLogger('eVOLVER')
 
@@ -42,9 +64,77 @@ EVOLVER_NS = None
 
 
 class EvolverNamespace(BaseNamespace):
+    # experiment of this connection, see configure()
+    options = None
+    name = None
+    operation_mode = None
+    exp_name = None
+    exp_dir = None
+    temp_initial = None
+    pump_cal_path = os.path.join(SAVE_PATH, PUMP_CAL_FILE)
+    calibration_keys = {'od': 'od', 'temperature': 'temperature'}
     start_time = None
     use_blank = False
     OD_initial = None
+    od_buffer = None
+    # median and MAD of the last 'to_avg' OD values (see rolling_median.py)
+    od_filter = None
+    # mask of the vials whose readings came in with the last broadcast
+    valid = None
+    temp_setpoints = None
+    # temperature setpoints last sent to the eVOLVER
+    sent_temp_setpoints = None
+    # whether setpoints were missing from the last config echo
+    temp_echo_missing = False
+    growth_rate = None
+    algorithm_state = None
+    controller = None
+    writer = None
+    series = None
+    checkpoint = None
+    # OD, temperature and raw readings of the broadcasts (--journal)
+    journal = None
+    flow_rate = None
+    # newer broadcasts queued behind the one being handled (see connection.py)
+    backlog = 0
+    backlog_policy = 'store'
+    # queued broadcasts not fully handled since the last report
+    coalesced = 0
+    # shortest delay between a broadcast being sent and handled
+    min_delay = None
+    latency = None
+    # time source, a virtual clock during a replay (see replay.py)
+    clock = time.time
+    # virtual clock set from the broadcast timestamps (--simulator-clock)
+    broadcast_clock = None
+
+    def configure(self, options, name=None, calibration_dir=SAVE_PATH):
+        """
+        Sets the experiment run through this connection. name identifies the
+        eVOLVER when one process drives several of them (see fleet.py); its
+        calibration files are then read from calibration_dir.
+        """
+        self.options = options
+        self.name = name
+        self.operation_mode = options.algo
+        self.exp_name = options.exp_name
+        self.exp_dir = os.path.join(SAVE_PATH, self.exp_name)
+        self.temp_initial = [options.temp_initial] * len(VIALS)
+        self.pump_cal_path = os.path.join(calibration_dir, PUMP_CAL_FILE)
+        self.backlog_policy = options.backlog_policy
+        if options.simulator_clock:
+            # time of server_simulator.py, moved forward by its broadcasts
+            self.broadcast_clock = replay.VirtualClock(time.time())
+            self.clock = self.broadcast_clock.time
+        self.latency = LatencyStats(os.path.join(self.exp_dir, LATENCY_FILE),
+                                    options.latency_interval, self.clock)
+        self.calibration_keys = {}
+        for calibration_type, file_name in CALIBRATION_FILES.items():
+            key = calibration_type
+            if name is not None:
+                key = '{0}/{1}'.format(name, calibration_type)
+            CALIBRATIONS.add(key, os.path.join(calibration_dir, file_name))
+            self.calibration_keys[calibration_type] = key
 
     def on_connect(self, *args):
         print("Connected to eVOLVER as client")
@@ -60,19 +150,33 @@ class EvolverNamespace(BaseNamespace):
 
     def on_broadcast(self, data):
         logger.debug('broadcast received')
-        elapsed_time = round((time.time() - self.start_time) / 3600, 4)
+        self.record('broadcast', data)
+        if self.broadcast_clock is not None and 'timestamp' in data:
+            self.broadcast_clock.set(float(data['timestamp']))
+        self.latency.begin(data.get('timestamp'))
+        try:
+            self.handle_broadcast(data)
+        finally:
+            self.latency.end()
+
+    def handle_broadcast(self, data):
+        lag = self.broadcast_lag(data)
+        if self.backlog and self.backlog_policy == 'latest':
+            # a newer broadcast is already queued
+            self.coalesced += 1
+            return
+        elapsed_time = round((self.clock() - lag - self.start_time) / 3600, 4)
         logger.debug('elapsed time: %.4f hours' % elapsed_time)
-        print("{0}: {1} Hours".format(EXP_NAME, elapsed_time))
+        print("{0}: {1} Hours".format(self.exp_name, elapsed_time))
         # are the calibrations in yet?
         if not self.check_for_calibrations():
             logger.warning('calibration files still missing, skipping custom '
                            'functions')
             return
 
-        with open(OD_CAL_PATH) as f:
-            od_cal = json.load(f)
-        with open(TEMP_CAL_PATH) as f:
-            temp_cal = json.load(f)
+        od_cal = CALIBRATIONS.get(self.calibration_keys['od'])
+        temp_cal = CALIBRATIONS.get(self.calibration_keys['temperature'])
+        self.latency.lap('calibrations')
 
         # apply calibrations
         # update temperatures if needed
@@ -80,51 +184,132 @@ class EvolverNamespace(BaseNamespace):
         if data is None:
             logger.error('could not tranform raw data, skipping user-'
                          'defined functions')
+            self.latency.dropped_broadcasts += 1
             return
+        # only the valid vials are saved, the controllers see the others as
+        # not ready
+        self.mask_vials(data['transformed']['valid'])
+        vials = [x for x in VIALS if self.valid[x]]
 
         # should we "blank" the OD?
         if self.use_blank and self.OD_initial is None:
             logger.info('setting initial OD reading')
-            self.OD_initial = data['transformed']['od']
+            self.OD_initial = np.where(self.valid, data['transformed']['od'],
+                                       np.nan)
         elif self.OD_initial is None:
             self.OD_initial = np.zeros(len(VIALS))
+        elif self.use_blank:
+            # vials without an initial reading yet (e.g. left out of the
+            # first broadcast)
+            blank = (self.valid & np.isnan(self.OD_initial) &
+                     np.isfinite(data['transformed']['od']))
+            if blank.any():
+                logger.info('setting initial OD reading of vials %s' %
+                            np.flatnonzero(blank).tolist())
+                self.OD_initial = np.where(blank, data['transformed']['od'],
+                                           self.OD_initial)
         data['transformed']['od'] = (data['transformed']['od'] -
                                      self.OD_initial)
+        self.latency.lap('transform')
         # save data
         self.save_data(data['transformed']['od'], elapsed_time,
-                       VIALS, 'OD')
+                       vials, 'OD')
+        self.latency.lap('save_od')
         self.save_data(data['transformed']['temp'], elapsed_time,
-                       VIALS, 'temp')
-        for param in od_cal['params']:
+                       vials, 'temp')
+        self.latency.lap('save_temp')
+        for param in od_cal.params:
             self.save_data(data['data'].get(param, []), elapsed_time,
-                           VIALS, param + '_raw')
-        for param in temp_cal['params']:
+                           vials, param + '_raw')
+        for param in temp_cal.params:
             self.save_data(data['data'].get(param, []), elapsed_time,
-                           VIALS, param + '_raw')
-        # run custom functions
-        self.custom_functions(data, VIALS, elapsed_time)
-        # save variables
-        self.save_variables(self.start_time, self.OD_initial)
+                           vials, param + '_raw')
+        if self.journal is not None:
+            self.journal.write_broadcast(self.clock(), elapsed_time,
+                                         data['config'], self.valid)
+        self.latency.lap('save_raw')
+        # run custom functions, on the newest queued broadcast only
+        if self.backlog and self.backlog_policy == 'store':
+            self.coalesced += 1
+        else:
+            self.report_backlog(lag)
+            self.custom_functions(data, VIALS, elapsed_time)
+        if self.journal is not None:
+            self.journal.write_commands(self.clock())
+        self.latency.lap('custom_functions')
+        # checkpoint the state needed to resume, if it changed
+        self.save_checkpoint()
+        self.latency.lap('checkpoint')
+        self.writer.end_broadcast()
+        self.latency.lap('flush')
+
+    def mask_vials(self, valid):
+        # counts the vials left out of a broadcast, logs when they drop out
+        # or come back
+        previous = self.valid
+        if previous is None:
+            previous = np.ones(len(valid), dtype=bool)
+        self.latency.count_masked(np.flatnonzero(~valid))
+        for x in np.flatnonzero(previous & ~valid).tolist():
+            logger.warning('NaN or missing readings from vial %d, leaving it '
+                           'out until they come back (%d broadcasts so far)'
+                           % (x, self.latency.masked[x]))
+        back = np.flatnonzero(~previous & valid).tolist()
+        if back:
+            logger.info('readings from vials %s are back' % back)
+        self.valid = valid
+
+    def emit(self, event, *args, **kw):
+        # commands sent are journaled with the broadcast they answer
+        if self.journal is not None:
+            self.journal.command(event, args)
+        BaseNamespace.emit(self, event, *args, **kw)
+
+    def record(self, event, data):
+        # raw events, to replay the experiment later (--record)
+        if self.options.record:
+            self.writer.write(os.path.join(self.exp_dir, replay.RECORD_FILE),
+                              replay.format_event(self.clock(), event, data))
+
+    def broadcast_lag(self, data):
+        """
+        Seconds a broadcast waited before being handled, measured against
+        the fastest broadcast so far as the eVOLVER and DPU clocks differ.
+        0 if the broadcast has no timestamp.
+        """
+        try:
+            delay = self.clock() - float(data['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            return 0.0
+        if self.min_delay is None or delay < self.min_delay:
+            self.min_delay = delay
+        return delay - self.min_delay
+
+    def report_backlog(self, lag):
+        if self.coalesced == 0:
+            return
+        logger.warning('%d queued broadcasts coalesced (%s policy), newest '
+                       'one handled %.1f s late' % (self.coalesced,
+                                                    self.backlog_policy, lag))
+        self.coalesced = 0
 
     def on_activecalibrations(self, data):
         print('Calibrations recieved')
+        self.record('activecalibrations', data)
         for calibration in data:
-            if calibration['calibrationType'] == 'od':
-                file_path = OD_CAL_PATH
-            elif calibration['calibrationType'] == 'temperature':
-                file_path = TEMP_CAL_PATH
-            else:
+            calibration_type = calibration['calibrationType']
+            if calibration_type not in self.calibration_keys:
                 continue
             for fit in calibration['fits']:
                 if fit['active']:
-                    with open(file_path, 'w') as f:
-                        json.dump(fit, f)
+                    CALIBRATIONS.update(
+                        self.calibration_keys[calibration_type], fit)
                     # Create raw data directories and files for params needed
                     for param in fit['params']:
-                        if not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')):
-                            os.makedirs(os.path.join(EXP_DIR, param + '_raw'))
+                        if not os.path.isdir(os.path.join(self.exp_dir, param + '_raw')):
+                            os.makedirs(os.path.join(self.exp_dir, param + '_raw'))
                             for x in range(len(fit['coefficients'])):
-                                exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
+                                exp_str = "Experiment: {0} vial {1}, {2}".format(self.exp_name,
                                                                                  x,
                                                                                  time.strftime("%c"))
                                 self._create_file(
@@ -138,103 +323,77 @@ class EvolverNamespace(BaseNamespace):
 
     # Where OD and temperature calibrations are applied to raw data readings.
     def transform_data(self, data, vials, od_cal, temp_cal):
-        od_data_2 = None
-        if od_cal['type'] == THREE_DIMENSION:
-            od_data_2 = data['data'].get(od_cal['params'][1], None)
-
-        od_data = data['data'].get(od_cal['params'][0], None)
-        temp_data = data['data'].get(temp_cal['params'][0], None)
+        """
+        Applies the calibrations to the readings of a broadcast, in
+        data['transformed']: od and temp of every vial, and valid, the mask
+        of the vials whose readings all came in (a vial reporting 'NaN' or
+        missing from a list is left out, the others are handled as usual).
+        Returns None if a reading is missing for all vials, or no vial is
+        valid.
+        """
+        od_params = transforms.calibration_params(od_cal)
+        od_raw = [data['data'].get(param, None) for param in od_params]
+        temp_data = data['data'].get(temp_cal.params[0], None)
         set_temp_data = data['config'].get('temp', {}).get('value', None)
 
-        if od_data is None or temp_data is None or set_temp_data is None:
+        if None in od_raw or temp_data is None or set_temp_data is None:
             print('Incomplete data recieved, Error with measurement')
             logger.error('Incomplete data received, error with measurements')
             return None
-        if 'NaN' in od_data or 'NaN' in temp_data or 'NaN' in set_temp_data:
+
+        # convert raw readings with the calibrations, all vials at once
+        od_raw = [transforms.to_array(raw, len(vials)) for raw in od_raw]
+        temp_data = transforms.to_array(temp_data, len(vials))
+        valid = np.isfinite(temp_data)
+        for raw in od_raw:
+            valid &= np.isfinite(raw)
+        if not valid.any():
             print('NaN recieved, Error with measurement')
-            logger.error('NaN received, error with measurements')
+            logger.error('NaN received from all vials, error with '
+                         'measurements')
             return None
-
-        od_data = np.array([float(x) for x in od_data])
-        if od_data_2:
-            od_data_2 = np.array([float(x) for x in od_data_2])
-        temp_data = np.array([float(x) for x in temp_data])
-        set_temp_data = np.array([float(x) for x in set_temp_data])
-
-        temps = []
-        for x in vials:
-            file_name = "vial{0}_temp_config.txt".format(x)
-            file_path = os.path.join(EXP_DIR, 'temp_config', file_name)
-            temp_set_data = np.genfromtxt(file_path, delimiter=',')
-            temp_set = temp_set_data[len(temp_set_data)-1][1]
-            temps.append(temp_set)
-            od_coefficients = od_cal['coefficients'][x]
-            temp_coefficients = temp_cal['coefficients'][x]
-            try:
-                if od_cal['type'] == SIGMOID:
-                    # convert raw photodiode data into ODdata using calibration curve
-                    od_data[x] = np.real(od_coefficients[2] -
-                                         ((np.log10((od_coefficients[1] -
-                                                     od_coefficients[0]) /
-                                                    (float(od_data[x]) -
-                                                     od_coefficients[0])-1)) /
-                                          od_coefficients[3]))
-                    if not np.isfinite(od_data[x]):
-                        od_data[x] = 'NaN'
-                        logger.debug('OD from vial %d: %s' % (x, od_data[x]))
-                    else:
-                        logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
-                elif od_cal['type'] == THREE_DIMENSION:
-                    od_data[x] = np.real(od_coefficients[0] +
-                                         (od_coefficients[1]*od_data[x]) +
-                                         (od_coefficients[2]*od_data_2[x]) +
-                                         (od_coefficients[3]*(od_data[x]**2)) +
-                                         (od_coefficients[4]*od_data[x]*od_data_2[x]) +
-                                         (od_coefficients[5]*(od_data_2[x]**2)))
-                else:
-                    logger.error('OD calibration not of supported type!')
-                    od_data[x] = 'NaN'
-            except ValueError:
-                print("OD Read Error")
-                logger.error('OD read error for vial %d, setting to NaN' % x)
-                od_data[x] = 'NaN'
-            try:
-                temp_data[x] = (float(temp_data[x]) *
-                                temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('temperature from vial %d: %.3f' %
-                             (x, temp_data[x]))
-            except ValueError:
-                print("Temp Read Error")
-                logger.error('temperature read error for vial %d, setting to NaN'
-                             % x)
-                temp_data[x] = 'NaN'
-            try:
-                set_temp_data[x] = (float(set_temp_data[x]) *
-                                    temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('set_temperature from vial %d: %.3f' % (x,
-                                                                     set_temp_data[x]))
-            except ValueError:
-                print("Set Temp Read Error")
-                logger.error('set temperature read error for vial %d, setting to NaN'
-                             % x)
-                set_temp_data[x] = 'NaN'
-
-        temps = np.array(temps)
+        od_data = transforms.apply_calibration(od_cal, *od_raw)
+        temp_data = transforms.apply_calibration(temp_cal, temp_data)
+        set_temp_data = transforms.apply_calibration(
+            temp_cal, transforms.to_array(set_temp_data, len(vials)))
+        logger.debug('OD: %s', od_data)
+        logger.debug('temperature: %s', temp_data)
+        logger.debug('set temperature: %s', set_temp_data)
+
+        temps = self.temp_setpoints[vials]
         # update temperatures only if difference with expected
-        # value is above 0.2 degrees celsius
-        delta_t = np.abs(set_temp_data - temps).max()
+        # value is above 0.2 degrees celsius. Setpoints missing from the
+        # config echo are only sent again when they changed since sent.
+        delta = np.abs(set_temp_data - temps)
+        missing = np.isnan(set_temp_data)
+        if missing.any():
+            if not self.temp_echo_missing:
+                logger.warning('no temperature setpoint in the config echo '
+                               'of vials %s' %
+                               np.flatnonzero(missing).tolist())
+            sent = self.sent_temp_setpoints
+            if sent is None:
+                changed = missing
+            else:
+                changed = missing & (sent != temps)
+            delta[missing] = np.where(changed[missing], np.inf, 0)
+        elif self.temp_echo_missing:
+            logger.info('temperature setpoints back in the config echo')
+        self.temp_echo_missing = missing.any()
+        delta_t = delta.max()
         if delta_t > 0.2:
             logger.info('updating temperatures (max. deltaT is %.2f)' %
                         delta_t)
-            coefficients = temp_cal['coefficients']
-            raw_temperatures = [str(int((temps[x] - temp_cal['coefficients'][x][1]) /
-                                        temp_cal['coefficients'][x][0]))
+            coefficients = temp_cal.coefficients
+            raw_temperatures = [str(int((temps[x] - coefficients[x, 1]) /
+                                        coefficients[x, 0]))
                                 for x in vials]
             self.update_temperature(raw_temperatures)
+            self.sent_temp_setpoints = temps.copy()
         else:
             # config from server agrees with local config
             # report if actual temperature doesn't match
-            delta_t = np.abs(temps - temp_data).max()
+            delta_t = np.abs(temps - temp_data)[valid].max()
             if delta_t > 0.2:
                 logger.info('actual temperature doesn\'t match configuration '
                             '(yet? max deltaT is %.2f)' % delta_t)
@@ -245,6 +404,7 @@ class EvolverNamespace(BaseNamespace):
         data['transformed'] = {}
         data['transformed']['od'] = od_data
         data['transformed']['temp'] = temp_data
+        data['transformed']['valid'] = valid
         return data
 
     def update_stir_rate(self, stir_rates, immediate=False):
@@ -264,6 +424,7 @@ class EvolverNamespace(BaseNamespace):
         command = {'param': 'pump', 'value': MESSAGE,
                    'recurring': False, 'immediate': True}
         self.emit('command', command, namespace='/dpu-evolver')
+        self.writer.pump_event()
 
     def update_chemo(self, data, vials, bolus_in_s, period_config, immediate=False):
         current_pump = data['config']['pump']['value']
@@ -292,6 +453,7 @@ class EvolverNamespace(BaseNamespace):
         if MESSAGE['value'] != current_pump:
             logger.info('updating chemostat: %s' % MESSAGE)
             self.emit('command', MESSAGE, namespace='/dpu-evolver')
+            self.writer.pump_event()
 
     def stop_all_pumps(self, ):
         data = {'param': 'pump',
@@ -320,17 +482,50 @@ class EvolverNamespace(BaseNamespace):
             defaults = []
         if directory is None:
             directory = param
+        if self.journal is not None and is_journal_field(directory):
+            # in the journal, see journal.py to write the text files
+            return
         file_name = "vial{0}_{1}.txt".format(vial, param)
-        file_path = os.path.join(EXP_DIR, directory, file_name)
+        file_path = os.path.join(self.exp_dir, directory, file_name)
         text_file = open(file_path, "w")
         for default in defaults:
             text_file.write(default + '\n')
         text_file.close()
+        if is_series(directory) and self.writer.series_format != 'text':
+            self.writer.create_series(file_path)
+
+    def create_series(self):
+        # binary files of the series written as text so far (e.g. when an
+        # experiment continues with another --series-format)
+        for directory in sorted(os.listdir(self.exp_dir)):
+            if not is_series(directory):
+                continue
+            path = os.path.join(self.exp_dir, directory)
+            for file_name in sorted(os.listdir(path)):
+                if file_name.endswith('.txt'):
+                    self.writer.create_series(os.path.join(path, file_name))
 
     def initialize_exp(self, vials, always_yes=False):
         logger.debug('initializing experiment')
-
-        if os.path.exists(EXP_DIR):
+        # the writer may already be set up (and shared, see fleet.py)
+        if self.writer is None:
+            if self.options.async_io:
+                self.writer = AsyncDataWriter(
+                    self.options.flush_policy, self.options.flush_interval,
+                    queue_size=self.options.io_queue_size,
+                    series_format=self.options.series_format)
+            else:
+                self.writer = DataWriter(
+                    self.options.flush_policy, self.options.flush_interval,
+                    series_format=self.options.series_format)
+        self.journal = None
+        self.checkpoint = Checkpoint(
+            os.path.join(self.exp_dir, CHECKPOINT_FILE), self.writer,
+            data=self.checkpoint_data, files=self.checkpoint_files,
+            interval=self.options.checkpoint_interval)
+        state = None
+
+        if os.path.exists(self.exp_dir):
             logger.info('found an existing experiment')
             exp_continue = None
             if always_yes:
@@ -343,7 +538,7 @@ class EvolverNamespace(BaseNamespace):
             exp_continue = 'n'
 
         if exp_continue == 'n':
-            if os.path.exists(EXP_DIR):
+            if os.path.exists(self.exp_dir):
                 exp_overwrite = None
                 if always_yes:
                     exp_overwrite = 'y'
@@ -354,7 +549,7 @@ class EvolverNamespace(BaseNamespace):
                 logger.info('data directory already exists')
                 if exp_overwrite == 'y':
                     logger.info('deleting existing data directory')
-                    shutil.rmtree(EXP_DIR)
+                    shutil.rmtree(self.exp_dir)
                 else:
                     print('Change experiment name in custom_script.py '
                           'and then restart...')
@@ -362,23 +557,30 @@ class EvolverNamespace(BaseNamespace):
                         'not deleting existing data directory, exiting')
                     sys.exit(1)
 
-            start_time = time.time()
+            start_time = self.clock()
+            if self.options.journal:
+                self.journal = Journal(self.exp_dir, self.writer,
+                                       len(vials), self.exp_name)
 
             self.request_calibrations()
 
             logger.debug('creating data directories')
-            os.makedirs(os.path.join(EXP_DIR, 'OD'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp_config'))
-            os.makedirs(os.path.join(EXP_DIR, 'pump_log'))
-            os.makedirs(os.path.join(EXP_DIR, 'ODset'))
-            os.makedirs(os.path.join(EXP_DIR, 'growthrate'))
-            if options.algo == 'chemostat':
-                os.makedirs(os.path.join(EXP_DIR, 'chemo_config'))
-            elif options.algo == 'morbidostat' or options.algo == 'old_morbidostat' or options.algo == 'timed_morbidostat':
-                os.makedirs(os.path.join(EXP_DIR, 'morbido_log'))
+            os.makedirs(os.path.join(self.exp_dir, 'OD'))
+            os.makedirs(os.path.join(self.exp_dir, 'temp'))
+            os.makedirs(os.path.join(self.exp_dir, 'temp_config'))
+            os.makedirs(os.path.join(self.exp_dir, 'pump_log'))
+            os.makedirs(os.path.join(self.exp_dir, 'ODset'))
+            os.makedirs(os.path.join(self.exp_dir, 'growthrate'))
+            if self.journal is not None:
+                self.journal.open()
+            if self.options.algo == 'chemostat':
+                os.makedirs(os.path.join(self.exp_dir, 'chemo_config'))
+            elif self.options.algo == 'morbidostat' or self.options.algo == 'old_morbidostat' or self.options.algo == 'timed_morbidostat':
+                os.makedirs(os.path.join(self.exp_dir, 'morbido_log'))
+            if self.options.algo == 'timed_morbidostat':
+                os.makedirs(os.path.join(self.exp_dir, 'drug_events'))
             for x in vials:
-                exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
+                exp_str = "Experiment: {0} vial {1}, {2}".format(self.exp_name,
                                                                  x,
                                                                  time.strftime("%c"))
                 # make OD file
@@ -388,12 +590,12 @@ class EvolverNamespace(BaseNamespace):
                 # make temperature configuration file
                 self._create_file(x, 'temp_config',
                                   defaults=[exp_str,
-                                            "0,{0}".format(TEMP_INITIAL[x])])
+                                            "0,{0}".format(self.temp_initial[x])])
                 # make pump log file [time, pump_duration, average (smoothed) OD].
                 # Timed morbidostat adds two columns to track states instead of smoothed OD.
                 self._create_file(x, 'pump_log',
                                   defaults=[exp_str,
-                                            "0,0,0,0,0" if options.algo == 'timed_morbidostat' else "0,0,0"])
+                                            "0,0,0,0,0" if self.options.algo == 'timed_morbidostat' else "0,0,0"])
                 # make ODset file
                 self._create_file(x, 'ODset',
                                   defaults=[exp_str,
@@ -404,17 +606,17 @@ class EvolverNamespace(BaseNamespace):
                                             "0,0"],
                                   directory='growthrate')
                 # make chemostat file
-                if options.algo == 'chemostat':
+                if self.options.algo == 'chemostat':
                     self._create_file(x, 'chemo_config',
                                       defaults=["0,0,0",
                                                 "0,0,0"],
                                       directory='chemo_config')
-                elif options.algo == 'morbidostat' or options.algo == 'old_morbidostat' or options.algo == 'timed_morbidostat':
+                elif self.options.algo == 'morbidostat' or self.options.algo == 'old_morbidostat' or self.options.algo == 'timed_morbidostat':
                     # time, p, i, d, pid, drug a conc., drug b conc., phase
                     self._create_file(x, 'morbido_log',
                                       defaults=["0,0,0,0,0,0,0,I"],
                                       directory='morbido_log')
-            self.update_stir_rate(options.stir_initial)
+            self.update_stir_rate(self.options.stir_initial)
 
             if always_yes:
                 exp_blank = 'y'
@@ -429,19 +631,51 @@ class EvolverNamespace(BaseNamespace):
                 self.OD_initial = np.zeros(len(vials))
         else:
             # load existing experiment
-            pickle_name = "{0}.pickle".format(EXP_NAME)
-            pickle_path = os.path.join(EXP_DIR, pickle_name)
-            logger.info('loading previous experiment data: %s' % pickle_path)
-            with open(pickle_path, 'rb') as f:
-                loaded_var = pickle.load(f)
-            x = loaded_var
-            start_time = x[0]
-            self.OD_initial = x[1]
+            if self.writer.series_format != 'text':
+                self.create_series()
+            # the journal is only started with new experiments
+            if os.path.isdir(os.path.join(self.exp_dir, JOURNAL_DIRECTORY)):
+                self.journal = Journal(self.exp_dir, self.writer,
+                                       len(vials), self.exp_name)
+                self.journal.open()
+            elif self.options.journal:
+                logger.warning('experiment started without --journal, '
+                               'continuing without it')
+            state = self.checkpoint.load()
+            if state is not None:
+                start_time = state['start_time']
+                self.use_blank = state['use_blank']
+                self.OD_initial = state['OD_initial']
+            else:
+                # experiments of older versions only saved these
+                pickle_name = "{0}.pickle".format(self.exp_name)
+                pickle_path = os.path.join(self.exp_dir, pickle_name)
+                logger.info('loading previous experiment data: %s' %
+                            pickle_path)
+                with open(pickle_path, 'rb') as f:
+                    loaded_var = pickle.load(f)
+                x = loaded_var
+                start_time = x[0]
+                self.OD_initial = x[1]
+
+        self.series = SeriesReader(self.exp_dir, self.writer, self.journal)
+        reload = exp_continue != 'n'
+        self.init_od_buffer(vials)
+        self.init_growth_rate(vials)
+        # the checkpoint replaces reading the log files
+        if state is None or not self.restore_checkpoint(vials, state):
+            self.init_temp_setpoints(vials, reload=reload)
+            self.init_controller(vials, reload=reload)
+            if reload:
+                self.load_od_data(vials, [self.odset_time(x) for x in vials])
+        self.load_od_filter(vials)
+        self.start_time = start_time
+        self.save_checkpoint()
 
         # copy current custom script to txt file
-        backup_filename = '{0}_{1}.txt'.format(EXP_NAME,
+        backup_filename = '{0}_{1}.txt'.format(self.exp_name,
                                                time.strftime('%y%m%d_%H%M'))
-        shutil.copy('custom_script.py', os.path.join(EXP_DIR,
+        shutil.copy('custom_script.py', os.path.join(self.exp_dir,
                                                      backup_filename))
         logger.info('saved a copy of current custom_script.py as %s' %
                     backup_filename)
@@ -450,47 +684,261 @@ class EvolverNamespace(BaseNamespace):
 
     def check_for_calibrations(self):
         result = True
-        if not os.path.exists(OD_CAL_PATH) or not os.path.exists(TEMP_CAL_PATH):
+        if (CALIBRATIONS.get(self.calibration_keys['od']) is None or
+                CALIBRATIONS.get(
+                    self.calibration_keys['temperature']) is None):
             # log and request again
             logger.warning('Calibrations not received yet, requesting again')
             self.request_calibrations()
             result = False
         return result
 
+    def init_od_buffer(self, vials):
+        buffer_size = max(OD_BUFFER_SIZE, self.options.to_avg)
+        self.od_buffer = VialRingBuffer(len(vials), buffer_size)
+        self.od_filter = RollingMedian(len(vials), self.options.to_avg)
+
+    def load_od_filter(self, vials):
+        # the median filter is rebuilt from the OD buffer (within its window)
+        for x in vials:
+            count = min(self.od_buffer.count(x), self.od_filter.window)
+            rows = np.asarray(self.od_buffer.tail(x, count)).reshape(-1, 2)
+            self.od_filter.load(x, rows[:, 1])
+
+    def load_od_data(self, vials, starts):
+        """
+        Rebuilds the OD buffer and the growth rate sums (of the growth curves
+        starting at 'starts') of the given vials, reading each OD file once:
+        its tail if the buffer goes back to the start of the growth curve,
+        else the rows since then.
+        """
+        logger.debug('loading OD data of vials %s into memory' % vials)
+        for x, gr_start in zip(vials, starts):
+            data = self.series.tail('OD', x, self.od_buffer.capacity)
+            if data.size == 0:
+                data = self.series.read('OD', x)
+            elif data[0][0] > gr_start:
+                data = self.series.read_range('OD', x, gr_start)
+            data = np.asarray(data).reshape(-1, 2)
+            data = data[np.isfinite(data[:, 0])]
+            self.od_buffer.load(x, data)
+            self.growth_rate.load(x, gr_start, data[:, 0], data[:, 1])
+
+    def init_temp_setpoints(self, vials, reload=False):
+        self.temp_setpoints = np.array(
+            [self.temp_initial[x] for x in vials], dtype=np.float64)
+        if reload:
+            self.load_temp_setpoints(vials)
+
+    def load_temp_setpoints(self, vials):
+        # the last row of each temp_config file is the current setpoint
+        for x in vials:
+            file_name = "vial{0}_temp_config.txt".format(x)
+            file_path = os.path.join(self.exp_dir, 'temp_config', file_name)
+            data = self.tail_to_np(file_path, 1)
+            if data.size != 0:
+                self.temp_setpoints[x] = data[-1][1]
+        logger.debug('temperature setpoints: %s' % self.temp_setpoints)
+
+    def set_temp_setpoints(self, vials, temps, elapsed_time):
+        """
+        Changes the temperature setpoint (C) of the given vials. New values
+        are appended to the temp_config files and applied with the next
+        broadcast.
+        """
+        for x, temp in zip(vials, temps):
+            if self.temp_setpoints[x] == temp:
+                continue
+            logger.info('temperature setpoint for vial %d: %.2f' % (x, temp))
+            self.temp_setpoints[x] = temp
+            file_name = "vial{0}_temp_config.txt".format(x)
+            file_path = os.path.join(self.exp_dir, 'temp_config', file_name)
+            self.writer.write(file_path,
+                              "{0},{1}\n".format(elapsed_time, temp))
+
+    def init_growth_rate(self, vials):
+        self.growth_rate = GrowthRateEstimator(len(vials))
+
+    def odset_time(self, vial):
+        # growth curves start at the last ODset change of each vial
+        data = self.series.tail('ODset', vial, 1)
+        return data[-1][0] if data.size != 0 else 0
+
+    def init_controller(self, vials, reload=False):
+        # controller of the operation mode and its in-memory state
+        controller_class = controllers.CONTROLLERS.get(self.operation_mode)
+        if controller_class is None:
+            return
+        logger.info('using controller %s' % controller_class.__name__)
+        self.controller = controller_class(self.options, vials)
+        self.algorithm_state = self.controller.create_state(self.writer,
+                                                            self.exp_dir)
+        if reload and self.algorithm_state is not None:
+            self.algorithm_state.load(vials)
+
+    def get_recent_od(self, vial, window):
+        """
+        Returns the last 'window' (time, OD) rows of a vial from memory.
+        Same output as tail_to_np on the vial OD file.
+        """
+        return self.od_buffer.tail(vial, window)
+
     def save_data(self, data, elapsed_time, vials, parameter):
         if len(data) == 0:
             return
+        if parameter == 'OD':
+            self.od_buffer.append(vials, elapsed_time, data)
+            self.od_filter.append(vials, data)
+            self.growth_rate.add(vials, elapsed_time, data)
+        if self.journal is not None and is_journal_field(parameter):
+            # all the series of the broadcast in one record, written by
+            # handle_broadcast()
+            self.journal.add(parameter, data)
+            return
         for x in vials:
             file_name = "vial{0}_{1}.txt".format(x, parameter)
-            file_path = os.path.join(EXP_DIR, parameter, file_name)
-            text_file = open(file_path, "a+")
-            text_file.write("{0},{1}\n".format(elapsed_time, data[x]))
-            text_file.close()
-
-    def save_variables(self, start_time, OD_initial):
-        # save variables needed for restarting experiment later
-        save_path = os.path.dirname(os.path.realpath(__file__))
-        pickle_name = "{0}.pickle".format(EXP_NAME)
-        pickle_path = os.path.join(EXP_DIR, pickle_name)
-        logger.debug('saving all variables: %s' % pickle_path)
-        with open(pickle_path, 'wb') as f:
-            pickle.dump([start_time, OD_initial], f)
+            file_path = os.path.join(self.exp_dir, parameter, file_name)
+            self.writer.write_row(file_path, [elapsed_time, data[x]])
+
+    def checkpoint_state(self):
+        # state needed for restarting the experiment later
+        algorithm_state = None
+        if self.algorithm_state is not None:
+            algorithm_state = self.algorithm_state.snapshot()
+        return {'start_time': self.start_time,
+                'use_blank': self.use_blank,
+                'OD_initial': self.OD_initial,
+                'temp_setpoints': self.temp_setpoints,
+                'growth_rate_start': self.growth_rate.start,
+                'algorithm_state': algorithm_state}
+
+    def checkpoint_data(self):
+        # changes with every broadcast, refreshed every --checkpoint-interval
+        return {'od_buffer': self.od_buffer.snapshot(),
+                'growth_rate': self.growth_rate.snapshot()}
+
+    def checkpoint_files(self):
+        # files whose size is recorded with every checkpoint
+        paths = []
+        for x in range(len(self.temp_setpoints)):
+            paths += self.vial_state_files(x)
+            paths.append(self.series.path('OD', x))
+        return paths
+
+    def vial_state_files(self, vial):
+        # log files the checkpointed state of a vial is loaded from otherwise
+        paths = [data_files.vial_file_path(self.exp_dir, 'temp_config',
+                                           vial)]
+        if self.algorithm_state is not None:
+            paths += self.algorithm_state.log_paths(vial)
+        return paths
+
+    def save_checkpoint(self):
+        # only written when the state changed (see checkpoint.py)
+        self.checkpoint.save(self.checkpoint_state(), self.clock())
+
+    def restore_checkpoint(self, vials, state):
+        """
+        Sets the temperature setpoints, algorithm state, OD buffer and growth
+        rate sums from a checkpoint, then checks the log files against the
+        sizes they had when it was written:
+        - OD rows written after the checkpoint are added to the buffer and
+          sums.
+        - the vials whose other log files changed (the DPU stopped between
+          writing them and the checkpoint) or whose OD file is shorter are
+          loaded from their files.
+        Returns False if the checkpoint does not fit the experiment (other
+        number of vials or operation mode).
+        """
+        data = self.checkpoint.data
+        fits = (data is not None and
+                len(state['temp_setpoints']) == len(vials) and
+                self.od_buffer.restore(data['od_buffer']) and
+                self.growth_rate.restore(data['growth_rate']))
+        if fits:
+            self.init_controller(vials)
+            fits = (self.algorithm_state is None or
+                    self.algorithm_state.restore(
+                        state['algorithm_state'] or {}))
+        if not fits:
+            logger.warning('checkpoint does not fit the experiment, loading '
+                           'the state from the log files')
+            return False
+        self.init_temp_setpoints(vials)
+        self.temp_setpoints[:] = state['temp_setpoints']
+
+        markers = self.checkpoint.markers
+        stale = [x for x in vials if any(
+            data_files.file_size(path) != markers.get(path)
+            for path in self.vial_state_files(x))]
+        if stale:
+            logger.warning('log files of vials %s changed since the '
+                           'checkpoint, loading their state from the files' %
+                           stale)
+            self.load_temp_setpoints(stale)
+            if self.algorithm_state is not None:
+                self.algorithm_state.load(stale)
+        rebuild = list(stale)
+        for x in vials:
+            if x in stale:
+                continue
+            OD_path = self.series.path('OD', x)
+            offset = markers.get(OD_path)
+            if offset is None or data_files.file_size(OD_path) < offset:
+                rebuild.append(x)
+                continue
+            rows = np.asarray(self.series.read('OD', x, offset=offset))
+            rows = rows.reshape(-1, 2)
+            rows = rows[np.isfinite(rows[:, 0])]
+            self.od_buffer.extend(x, rows)
+            self.growth_rate.extend(x, rows[:, 0], rows[:, 1])
+        if rebuild:
+            self.load_od_data(rebuild, [
+                self.odset_time(x) if x in stale else self.growth_rate.start[x]
+                for x in rebuild])
+        logger.info('restored the experiment state from checkpoint %d' %
+                    self.checkpoint.sequence)
+        return True
 
     def get_flow_rate(self):
-        file_path = os.path.join(SAVE_PATH, PUMP_CAL_FILE)
+        file_path = self.pump_cal_path
+        # only read the calibration file again if it changed
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if self.flow_rate is not None and self.flow_rate[0] == signature:
+            return self.flow_rate[1]
         flow_calibration = np.loadtxt(file_path, delimiter="\t")
         if len(flow_calibration) == 16:
             flow_rate = flow_calibration
         else:
             # Currently just implementing influx flow rate
             flow_rate = flow_calibration[0, :]
+        self.flow_rate = (signature, flow_rate)
         return flow_rate
 
     def calc_growth_rate(self, vial, gr_start, elapsed_time):
-        ODfile_name = "vial{0}_OD.txt".format(vial)
+        # streaming estimate since the last reset of the growth curve
+        slope, intercept, std_err = self.growth_rate.fit(vial)
+        from_memory = self.growth_rate.start[vial] == gr_start
+        if not from_memory or self.options.verify_growth_rate:
+            file_slope = self.calc_growth_rate_from_file(vial, gr_start)
+            if from_memory and not np.isclose(slope, file_slope,
+                                              equal_nan=True):
+                logger.warning('growth rate mismatch for vial %s: %s '
+                               '(streaming) vs %s (file)' %
+                               (vial, slope, file_slope))
+            slope = file_slope
+        logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
+
+        # Save slope to file
+        file_name = "vial{0}_gr.txt".format(vial)
+        gr_path = os.path.join(self.exp_dir, 'growthrate', file_name)
+        self.writer.write_row(gr_path, [elapsed_time, slope])
+
+    def calc_growth_rate_from_file(self, vial, gr_start):
         # Grab Data and make setpoint
-        OD_path = os.path.join(EXP_DIR, 'OD', ODfile_name)
-        OD_data = np.genfromtxt(OD_path, delimiter=',')
+        OD_data = np.asarray(self.series.read_range('OD', vial, gr_start))
+        OD_data = OD_data.reshape(-1, 2)
         raw_time = OD_data[:, 0]
         raw_OD = OD_data[:, 1]
         raw_time = raw_time[np.isfinite(raw_OD)]
@@ -505,97 +953,63 @@ class EvolverNamespace(BaseNamespace):
         slope, intercept, r_value, p_value, std_err = stats.linregress(
             trim_time[np.isfinite(log_OD)],
             log_OD[np.isfinite(log_OD)])
-        logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
-
-        # Save slope to file
-        file_name = "vial{0}_gr.txt".format(vial)
-        gr_path = os.path.join(EXP_DIR, 'growthrate', file_name)
-        text_file = open(gr_path, "a+")
-        text_file.write("{0},{1}\n".format(elapsed_time, slope))
-        text_file.close()
+        return slope
 
     def tail_to_np(self, path, window=10, BUFFER_SIZE=512):
-        """
-        Reads file from the end and returns a numpy array with the data of the last 'window' lines.
-        Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
-        """
-        f = open(path, 'rb')
-        if window == 0:
-            return []
-
-        f.seek(0, os.SEEK_END)
-        remaining_bytes = f.tell()
-        size = window + 1  # Read one more line to avoid broken lines
-        block = -1
-        data = []
-
-        while size > 0 and remaining_bytes > 0:
-            if remaining_bytes - BUFFER_SIZE > 0:
-                # Seek back one whole BUFFER_SIZE
-                f.seek(block * BUFFER_SIZE, os.SEEK_END)
-                # read BUFFER
-                bunch = f.read(BUFFER_SIZE)
-            else:
-                # file too small, start from beginning
-                f.seek(0, 0)
-                # only read what was not read
-                bunch = f.read(remaining_bytes)
-
-            bunch = bunch.decode('utf-8')
-            data.append(bunch)
-            size -= bunch.count('\n')
-            remaining_bytes -= BUFFER_SIZE
-            block -= 1
-
-        data = ''.join(reversed(data)).splitlines()[-window:]
-
-        if len(data) < window:
-            # Not enough data
-            return np.asarray([])
-
-        for c, v in enumerate(data):
-            data[c] = v.split(',')
-
-        try:
-            data = np.asarray(data, dtype=np.float64)
-            return data
-        except ValueError:
-            # It is reading the header
-            return np.asarray([])
+        return data_files.tail_to_np(path, window, BUFFER_SIZE)
 
     def custom_functions(self, data, vials, elapsed_time):
-        # load user script from custom_script.py
-        if OPERATION_MODE == 'turbidostat':
-            custom_script.turbidostat(self, data, vials, elapsed_time, options)
-        elif OPERATION_MODE == 'chemostat':
-            custom_script.chemostat(self, data, vials, elapsed_time, options)
-        elif OPERATION_MODE == 'morbidostat':
-            custom_script.morbidostat(self, data, vials, elapsed_time, options)
-        elif OPERATION_MODE == 'timed_morbidostat':
-            custom_script.timed_morbidostat(
-                self, data, vials, elapsed_time, options)
-        elif OPERATION_MODE == 'old_morbidostat':
-            custom_script.old_morbidostat(
-                self, data, vials, elapsed_time, options)
+        # controllers registered in controllers.CONTROLLERS (built-in ones
+        # live in custom_script.py)
+        if self.controller is not None:
+            commands = self.controller.step(self, data['transformed']['od'],
+                                            data['transformed']['temp'],
+                                            self.algorithm_state,
+                                            elapsed_time)
+            self.apply_commands(data, vials, commands, elapsed_time)
         else:
             # try to load the user function
             # if failing report to user
-            logger.info('user-defined operation mode %s' % OPERATION_MODE)
+            logger.info('user-defined operation mode %s' %
+                        self.operation_mode)
             try:
-                func = getattr(custom_script, OPERATION_MODE)
+                func = getattr(custom_script, self.operation_mode)
                 func(self, data, vials, elapsed_time)
             except AttributeError:
                 logger.error('could not find function %s in custom_script.py' %
-                             OPERATION_MODE)
+                             self.operation_mode)
                 print('Could not find function %s in custom_script.py '
                       '- Skipping user defined functions' %
-                      OPERATION_MODE)
+                      self.operation_mode)
 
-    def stop_exp(self):
+    def apply_commands(self, data, vials, commands, elapsed_time):
+        if commands is None:
+            return
+        if commands.temp is not None:
+            self.set_temp_setpoints(vials, commands.temp, elapsed_time)
+        if commands.stir is not None:
+            self.update_stir_rate([controllers.format_value(stir)
+                                   for stir in commands.stir])
+        if commands.chemo is not None:
+            bolus_in_s, period_config = commands.chemo
+            self.update_chemo(data, vials, bolus_in_s, period_config)
+        # send fluidic command only if we are actually turning on any of
+        # the pumps
+        message = commands.fluid_message()
+        if message is not None:
+            self.fluid_command(message)
+
+    def stop_exp(self, close_writer=True):
+        # close_writer=False leaves a writer shared with other experiments
+        # open (see fleet.py)
         self.stop_all_pumps()
+        if self.latency is not None:
+            self.latency.write()
+        if self.writer is not None and close_writer:
+            self.writer.close()
 
 
-def get_options():
+def get_options(argv=None):
     description = 'Custom eVOLVER script for Toprak Lab. (As a last resort) contact furkancemaltoprak@gmail.com for assistance.'
     parser = argparse.ArgumentParser(description=description)
     # Usage information for our lovely labmates
@@ -608,6 +1022,85 @@ def get_options():
     parser.add_argument('--log-name',
                         default='evolver.log',
                         help='Log file name directory (default: %(default)s)')
+    parser.add_argument('--flush-policy',
+                        default='broadcast', choices=FLUSH_POLICIES,
+                        help='When buffered data is written to disk: at '
+                             'every broadcast, every --flush-interval '
+                             'seconds or on pump events only '
+                             '(default: %(default)s)')
+    parser.add_argument('--flush-interval', type=float,
+                        default=10,
+                        help='Seconds between data flushes with '
+                             '--flush-policy interval (default: %(default)s)')
+    parser.add_argument('--backlog-policy',
+                        default='store', choices=BACKLOG_POLICIES,
+                        help='What to do with broadcasts queued while the '
+                             'DPU was busy: handle all of them, store all of '
+                             'them but only control on the newest, or only '
+                             'handle the newest (default: %(default)s)')
+    parser.add_argument('--latency-interval', type=float,
+                        default=60,
+                        help='Seconds between writes of the broadcast '
+                             'handling times to ' + LATENCY_FILE +
+                             ' (default: %(default)s)')
+    parser.add_argument('--checkpoint-interval', type=float,
+                        default=3600,
+                        help='Seconds between checkpoints of the OD data, '
+                             'resuming reads the OD rows written since the '
+                             'last one (default: %(default)s)')
+    parser.add_argument('--status-port', type=int,
+                        default=None,
+                        help='Serve the broadcast handling times as JSON on '
+                             'this local port (default: off)')
+    parser.add_argument('--record', action='store_true',
+                        default=False,
+                        help='Record the events received from the eVOLVER '
+                             'to ' + replay.RECORD_FILE + ' in the '
+                             'experiment directory, for --replay')
+    parser.add_argument('--replay',
+                        default=None,
+                        help='Replay a recorded ' + replay.RECORD_FILE +
+                             ' instead of connecting to the eVOLVER. '
+                             'Commands are written to ' +
+                             replay.COMMANDS_FILE + ' in the experiment '
+                             'directory')
+    parser.add_argument('--replay-speed', type=float,
+                        default=0,
+                        help='Replay speed multiplier, 0 to replay as fast '
+                             'as possible (default: %(default)s)')
+    parser.add_argument('--simulator-clock', action='store_true',
+                        default=False,
+                        help='Time the experiment on the broadcast '
+                             'timestamps instead of this computer\'s clock, '
+                             'to follow server_simulator.py running faster '
+                             'than real time (--speed)')
+    parser.add_argument('--verify-growth-rate', action='store_true',
+                        default=False,
+                        help='Also compute growth rates from the OD files '
+                             'and warn if they differ from the streaming '
+                             'estimate')
+    parser.add_argument('--async-io', action='store_true',
+                        default=False,
+                        help='Write data from a background thread so slow '
+                             'disks do not delay the pump commands')
+    parser.add_argument('--io-queue-size', type=int,
+                        default=10000,
+                        help='Maximum number of pending writes with '
+                             '--async-io (default: %(default)s)')
+    parser.add_argument('--series-format',
+                        default='text', choices=SERIES_FORMATS,
+                        help='Files of the OD, temperature, growth rate, raw, '
+                             'pump_log and ODset series: text, binary '
+                             '(memory-mappable, see series_store.py) or both '
+                             '(default: %(default)s)')
+    parser.add_argument('--journal', action='store_true',
+                        default=False,
+                        help='Write the OD, temperature and raw readings of '
+                             'each broadcast, its config and the commands '
+                             'sent as one record of an append-only journal '
+                             'instead of per-vial files. Only for new '
+                             'experiments, see journal.py to write the text '
+                             'files')
 
     log_nolog = parser.add_mutually_exclusive_group()
     log_nolog.add_argument('--verbose', action='count',
@@ -705,7 +1198,7 @@ def get_options():
         '--pump_test_for', help='Specify pump numbers in a space-seperated list. Example `py eVOLVER.py --algo pump_test --pump 1 4 8`', type=int, nargs='+'
     )
     # Sanity check for required arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.algo is None or not args.algo in algo_options:
         print('Specify algorithm within the available options.')
         exit(-1)
@@ -813,21 +1306,69 @@ def get_options():
     return args
 
 
+def run_experiment(connection, namespace):
+    # handles broadcasts until the experiment is stopped with Ctrl-C or by
+    # an error
+    while True:
+        try:
+            # infinite loop, wakes up on incoming events
+            connection.run_forever()
+        except KeyboardInterrupt:
+            try:
+                print('Ctrl-C detected, pausing experiment')
+                logger.warning('interrupt received, pausing experiment')
+                namespace.stop_exp()
+                # stop receiving broadcasts
+                connection.disconnect()
+                while True:
+                    key = input('Experiment paused. Press enter key to restart '
+                                ' or hit Ctrl-C again to terminate experiment')
+                    logger.warning('resuming experiment')
+                    # no need to have something like "restart_chemo" here
+                    # with the new server logic
+                    connection.reconnect()
+                    break
+            except KeyboardInterrupt:
+                print('Second Ctrl-C detected, shutting down')
+                logger.warning('second interrupt received, terminating '
+                               'experiment')
+                namespace.stop_exp()
+                print('Experiment stopped, goodbye!')
+                logger.warning('experiment stopped, goodbye!')
+                break
+        except Exception as e:
+            logger.critical('exception %s stopped the experiment' % str(e))
+            print('error "%s" stopped the experiment' % str(e))
+            traceback.print_exc(file=sys.stdout)
+            namespace.stop_exp()
+            print('Experiment stopped, goodbye!')
+            logger.warning('experiment stopped, goodbye!')
+            break
+
+    # stop experiment one last time
+    # covers corner case where user presses Ctrl-C twice quickly
+    connection.reconnect()
+    namespace.stop_exp()
+
+
 if __name__ == '__main__':
     options = get_options()
-    OPERATION_MODE = options.algo
-    EXP_NAME = options.exp_name
-    EXP_DIR = os.path.join(SAVE_PATH, EXP_NAME)
-    TEMP_INITIAL = [options.temp_initial] * 16
-    print(OPERATION_MODE)
+    print(options.algo)
     # changes terminal tab title in OSX
     print('\x1B]0;eVOLVER EXPERIMENT: PRESS Ctrl-C TO PAUSE\x07')
 
     # silence logging until experiment is initialized
     logging.level = logging.CRITICAL + 10
 
-    socketIO = SocketIO(EVOLVER_IP, EVOLVER_PORT)
-    EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
+    if options.replay is None:
+        connection = EvolverConnection(EVOLVER_IP, EVOLVER_PORT)
+        EVOLVER_NS = connection.connect(EvolverNamespace)
+    else:
+        # no eVOLVER: recorded events are fed to the namespace on a virtual
+        # clock and the commands are written to a file
+        replayer = replay.Replay(options.replay, options.replay_speed)
+        EVOLVER_NS = replayer.namespace(EvolverNamespace, NAMESPACE)
+    EVOLVER_NS.configure(options)
 
     # start by stopping any existing regime
     EVOLVER_NS.stop_all_pumps()
@@ -849,56 +1390,21 @@ if __name__ == '__main__':
         logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
                             '- %(message)s',
                             datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=os.path.join(EXP_DIR, options.log_name),
+                            filename=os.path.join(EVOLVER_NS.exp_dir,
+                                                  options.log_name),
                             level=level)
 
-    reset_connection_timer = time.time()
-    while True:
-        try:
-            # infinite loop
-            socketIO.wait(seconds=0.1)
-            if time.time() - reset_connection_timer > 3600:
-                # reset connection to avoid buildup of broadcast
-                # messages (unlikely but could happen for very long
-                # experiments with slow dpu code/computer)
-                logger.info('resetting connection to eVOLVER to avoid '
-                            'potential buildup of broadcast messages')
-                socketIO.disconnect()
-                socketIO.connect()
-                reset_connection_timer = time.time()
-        except KeyboardInterrupt:
-            try:
-                print('Ctrl-C detected, pausing experiment')
-                logger.warning('interrupt received, pausing experiment')
-                EVOLVER_NS.stop_exp()
-                # stop receiving broadcasts
-                socketIO.disconnect()
-                while True:
-                    key = input('Experiment paused. Press enter key to restart '
-                                ' or hit Ctrl-C again to terminate experiment')
-                    logger.warning('resuming experiment')
-                    # no need to have something like "restart_chemo" here
-                    # with the new server logic
-                    socketIO.connect()
-                    break
-            except KeyboardInterrupt:
-                print('Second Ctrl-C detected, shutting down')
-                logger.warning('second interrupt received, terminating '
-                               'experiment')
-                EVOLVER_NS.stop_exp()
-                print('Experiment stopped, goodbye!')
-                logger.warning('experiment stopped, goodbye!')
-                break
-        except Exception as e:
-            logger.critical('exception %s stopped the experiment' % str(e))
-            print('error "%s" stopped the experiment' % str(e))
-            traceback.print_exc(file=sys.stdout)
-            EVOLVER_NS.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
-            break
+    if options.replay is not None:
+        replayer.commands.open(os.path.join(EVOLVER_NS.exp_dir,
+                                            replay.COMMANDS_FILE))
+        count, duration = replayer.run(EVOLVER_NS)
+        EVOLVER_NS.stop_exp()
+        replayer.commands.close()
+        print('Replayed {0} events in {1:.2f} s'.format(count, duration))
+        exit(0)
 
-    # stop experiment one last time
-    # covers corner case where user presses Ctrl-C twice quickly
-    socketIO.connect()
-    EVOLVER_NS.stop_exp()
+    if options.status_port is not None:
+        StatusServer(options.status_port,
+                     {EVOLVER_NS.exp_name: EVOLVER_NS.latency}).start()
+
+    run_experiment(connection, EVOLVER_NS)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import json
+import asyncio
+import logging
+import argparse
+
+from socketIO_client.exceptions import ConnectionError
+
+import eVOLVER
+from connection import EvolverConnection, RECONNECT_INTERVAL
+from eVOLVER import EvolverNamespace, VIALS, SAVE_PATH
+from data_writer import DataWriter, AsyncDataWriter, FLUSH_POLICIES
+from series_store import SERIES_FORMATS
+from latency import StatusServer
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+# Drives several eVOLVERs from one process, on one asyncio event loop.
+# The units are listed in a JSON file:
+#
+# {"devices": [{"name": "box1", "ip": "192.168.1.2", "port": 8081,
+#               "calibration_dir": "box1",
+#               "args": ["--algo", "turbidostat", "--exp_name", "expt_1",
+#                        ...]},
+#              ...]}
+#
+# "args" are the eVOLVER.py arguments of the experiment run on that unit.
+# Calibration files (od_cal.json, temp_cal.json, pump_cal.txt) are read from
+# "calibration_dir" (relative to this directory, default: this directory).
+
+logger = logging.getLogger('fleet')
+
+# open data files kept by the shared writer, per unit
+OPEN_FILES_PER_DEVICE = 256
+# eVOLVER.py arguments of the writer, set for the whole fleet instead
+WRITER_ARGS = ['--async-io', '--io-queue-size', '--series-format',
+               '--flush-policy', '--flush-interval']
+
+
+class EvolverSession(object):
+    """
+    One eVOLVER unit of the fleet: its connection and the EvolverNamespace
+    running its experiment. All connections share the event loop, so
+    sessions never block each other while waiting for packets.
+    """
+
+    def __init__(self, name, ip, port, options, calibration_dir=SAVE_PATH):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.options = options
+        self.calibration_dir = calibration_dir
+        self.connection = None
+        self.namespace = None
+
+    def connect(self, loop, writer, always_yes=False):
+        # raises ConnectionError if the unit cannot be reached
+        logger.info('connecting to %s (%s:%s)' % (self.name, self.ip,
+                                                  self.port))
+        # a failing handler is logged, it must not stop the other units
+        self.connection = EvolverConnection(self.ip, self.port, loop,
+                                            stop_on_error=False)
+        self.namespace = self.connection.connect(EvolverNamespace,
+                                                 wait_for_connection=False)
+        self.namespace.configure(self.options, self.name,
+                                 self.calibration_dir)
+        self.namespace.writer = writer
+        # start by stopping any existing regime
+        self.namespace.stop_all_pumps()
+        self.namespace.start_time = self.namespace.initialize_exp(
+            VIALS, always_yes)
+
+    def stop(self):
+        # the writer is shared, closed by run_fleet()
+        if self.namespace is None:
+            return
+        self.namespace.stop_exp(close_writer=False)
+        self.connection.disconnect()
+
+
+def load_sessions(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    sessions = []
+    for device in config['devices']:
+        writer_args = [arg for arg in device['args']
+                       if arg.split('=')[0] in WRITER_ARGS]
+        if writer_args:
+            raise ValueError('%s: %s apply to the whole fleet, pass them to '
+                             'fleet.py instead' % (device['name'],
+                                                   ' '.join(writer_args)))
+        options = eVOLVER.get_options(device['args'])
+        calibration_dir = os.path.join(SAVE_PATH,
+                                       device.get('calibration_dir', ''))
+        sessions.append(EvolverSession(device['name'], device['ip'],
+                                       device['port'], options,
+                                       calibration_dir))
+    names = [session.name for session in sessions]
+    exp_names = [session.options.exp_name for session in sessions]
+    if len(set(names)) != len(names):
+        raise ValueError('device names must be unique')
+    if len(set(exp_names)) != len(exp_names):
+        raise ValueError('every device needs its own experiment')
+    return sessions
+
+
+def run_fleet(sessions, writer, always_yes=False, status_port=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # broadcast handling times of the units started so far
+    latencies = {}
+
+    def start(session):
+        # units that cannot be reached are retried in the background, the
+        # others run meanwhile
+        try:
+            session.connect(loop, writer, always_yes)
+        except ConnectionError as e:
+            logger.error('could not connect to %s (%s), retrying in %d s' %
+                         (session.name, e, RECONNECT_INTERVAL))
+            session.namespace = None
+            loop.call_later(RECONNECT_INTERVAL, start, session)
+            return
+        latencies[session.name] = session.namespace.latency
+
+    try:
+        for session in sessions:
+            start(session)
+        if status_port is not None:
+            StatusServer(status_port, latencies).start()
+        loop.run_forever()
+    finally:
+        for session in sessions:
+            session.stop()
+        writer.close()
+        loop.close()
+
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Run experiments on several eVOLVERs from one process.')
+    parser.add_argument('config',
+                        help='JSON file listing the eVOLVERs and the '
+                             'eVOLVER.py arguments of their experiments')
+    parser.add_argument('--always-yes', action='store_true',
+                        default=False,
+                        help='Answer yes to all questions for every device')
+    parser.add_argument('--log-name',
+                        default='fleet.log',
+                        help='Log file name (default: %(default)s)')
+    parser.add_argument('--flush-policy',
+                        default='broadcast', choices=FLUSH_POLICIES,
+                        help='When buffered data is written to disk '
+                             '(default: %(default)s)')
+    parser.add_argument('--flush-interval', type=float,
+                        default=10,
+                        help='Seconds between data flushes with '
+                             '--flush-policy interval (default: %(default)s)')
+    parser.add_argument('--async-io', action='store_true',
+                        default=False,
+                        help='Write the data of all devices from one '
+                             'background thread')
+    parser.add_argument('--io-queue-size', type=int,
+                        default=10000,
+                        help='Maximum number of pending writes with '
+                             '--async-io (default: %(default)s)')
+    parser.add_argument('--series-format',
+                        default='text', choices=SERIES_FORMATS,
+                        help='Files of the OD, temperature, growth rate, raw, '
+                             'pump_log and ODset series: text, binary '
+                             '(memory-mappable, see series_store.py) or both '
+                             '(default: %(default)s)')
+    parser.add_argument('--status-port', type=int,
+                        default=None,
+                        help='Serve the broadcast handling times of all '
+                             'devices as JSON on this local port '
+                             '(default: off)')
+    parser.add_argument('--verbose', action='count',
+                        default=0,
+                        help='Increase logging verbosity level to DEBUG '
+                             '(default: INFO)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
+                        '- %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        filename=os.path.join(SAVE_PATH, options.log_name),
+                        level=logging.DEBUG if options.verbose else
+                        logging.INFO)
+    sessions = load_sessions(options.config)
+    # one writer (and I/O thread with --async-io) for the whole fleet
+    max_open_files = OPEN_FILES_PER_DEVICE * len(sessions)
+    if options.async_io:
+        writer = AsyncDataWriter(options.flush_policy, options.flush_interval,
+                                 max_open_files, options.io_queue_size,
+                                 options.series_format)
+    else:
+        writer = DataWriter(options.flush_policy, options.flush_interval,
+                            max_open_files, options.series_format)
+    print('\x1B]0;eVOLVER FLEET: PRESS Ctrl-C TO STOP\x07')
+    try:
+        run_fleet(sessions, writer, options.always_yes, options.status_port)
+    except KeyboardInterrupt:
+        print('Ctrl-C detected, stopping all experiments')
+        logger.warning('interrupt received, stopping all experiments')
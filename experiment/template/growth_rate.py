@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+
+class GrowthRateEstimator(object):
+    """
+    Streaming least squares fit of ln(OD) against time for every vial, using
+    only the points after the start of the current growth curve. Gives the
+    same slope, intercept and standard error as scipy.stats.linregress on
+    those points, without reading the OD files.
+    """
+
+    def __init__(self, vial_count):
+        self.start = np.zeros(vial_count)
+        # running sums, time is relative to the segment start
+        self._n = np.zeros(vial_count)
+        self._t = np.zeros(vial_count)
+        self._y = np.zeros(vial_count)
+        self._tt = np.zeros(vial_count)
+        self._ty = np.zeros(vial_count)
+        self._yy = np.zeros(vial_count)
+
+    def reset(self, vial, start_time):
+        # start a new growth curve, only later points are used
+        self.start[vial] = start_time
+        for sums in (self._n, self._t, self._y, self._tt, self._ty,
+                     self._yy):
+            sums[vial] = 0
+
+    def add(self, vials, elapsed_time, od):
+        # one OD value per vial, all vials sharing the same timestamp
+        vials = np.asarray(vials, dtype=int)
+        with np.errstate(all='ignore'):
+            log_od = np.log(np.asarray(od, dtype=np.float64)[vials])
+        valid = np.isfinite(log_od) & (elapsed_time > self.start[vials])
+        vials = vials[valid]
+        t = elapsed_time - self.start[vials]
+        y = log_od[valid]
+        self._n[vials] += 1
+        self._t[vials] += t
+        self._y[vials] += y
+        self._tt[vials] += t * t
+        self._ty[vials] += t * y
+        self._yy[vials] += y * y
+
+    def load(self, vial, start_time, times, od):
+        # rebuild the sums of a vial from (time, OD) rows, e.g. on resume
+        self.reset(vial, start_time)
+        self.extend(vial, times, od)
+
+    def extend(self, vial, times, od):
+        # add (time, OD) rows of a vial
+        start_time = self.start[vial]
+        times = np.asarray(times, dtype=np.float64)
+        with np.errstate(all='ignore'):
+            log_od = np.log(np.asarray(od, dtype=np.float64))
+        valid = np.isfinite(log_od) & (times > start_time)
+        t = times[valid] - start_time
+        y = log_od[valid]
+        self._n[vial] += len(t)
+        self._t[vial] += t.sum()
+        self._y[vial] += y.sum()
+        self._tt[vial] += (t * t).sum()
+        self._ty[vial] += (t * y).sum()
+        self._yy[vial] += (y * y).sum()
+
+    def snapshot(self):
+        # curve starts and sums (not copies), see restore()
+        return {'start': self.start, 'n': self._n, 't': self._t,
+                'y': self._y, 'tt': self._tt, 'ty': self._ty, 'yy': self._yy}
+
+    def restore(self, snapshot):
+        # False (and nothing restored) if the snapshot has another shape
+        if any(np.shape(values) != self.start.shape
+               for values in snapshot.values()):
+            return False
+        self.start = np.array(snapshot['start'], dtype=np.float64)
+        for name in ['n', 't', 'y', 'tt', 'ty', 'yy']:
+            setattr(self, '_' + name,
+                    np.array(snapshot[name], dtype=np.float64))
+        return True
+
+    def count(self, vial):
+        return int(self._n[vial])
+
+    def fit(self, vial):
+        """
+        Returns slope (growth rate, 1/h), intercept and standard error of the
+        slope for the current growth curve of a vial.
+        """
+        n = self._n[vial]
+        if n < 2:
+            return np.nan, np.nan, np.nan
+        mean_t = self._t[vial] / n
+        mean_y = self._y[vial] / n
+        ss_t = self._tt[vial] - n * mean_t * mean_t
+        ss_y = self._yy[vial] - n * mean_y * mean_y
+        ss_ty = self._ty[vial] - n * mean_t * mean_y
+        if ss_t <= 0:
+            return np.nan, np.nan, np.nan
+        slope = ss_ty / ss_t
+        intercept = mean_y - slope * (mean_t + self.start[vial])
+        if n == 2:
+            std_err = 0.0
+        else:
+            residuals = max(ss_y - slope * ss_ty, 0.0)
+            std_err = np.sqrt(residuals / (n - 2) / ss_t)
+        return slope, intercept, std_err
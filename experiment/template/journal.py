@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+import argparse
+import numpy as np
+
+from data_files import file_size, vial_file_path
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# in the experiment directory
+JOURNAL_DIRECTORY = 'journal'
+# a new segment is started once the current one is this big
+SEGMENT_SIZE = 64 * 1024 * 1024
+# legacy text files without an 'Experiment: ...' first line
+HEADERLESS = ['temp']
+
+# The journal holds everything a broadcast brought in (OD, temperature and
+# raw readings of every vial, config echo) and the commands sent in
+# response. It is a sequence of segment files, each named after the journal
+# offset (bytes written before it) of its start. A segment is:
+# - a header: magic, format version, layout length (SEGMENT), then the
+#   layout as JSON: number of vials, fields (series directories, e.g. OD,
+#   temp, od_90_raw), first line of their legacy text files, sequence
+#   number of the last record before the segment
+# - records, only ever appended: body length and CRC32 of the body (RECORD),
+#   the body, then the length of the whole record (TRAILER) so a segment can
+#   also be read backwards. A body is the record kind, broadcast sequence
+#   number and DPU time (BODY), then:
+#   - broadcast records: bit mask of the fields present, elapsed time and
+#     the values (fields x vials, NaN if missing), little-endian float64,
+#     then (since version 2) one byte per vial, 0 if it was left out of the
+#     broadcast (broadcast_row()), then {"config": ...} as JSON if the
+#     config echo changed since the previous record of the segment
+#   - commands records: JSON list of the [event, args] emitted after the
+#     broadcast of the same sequence number
+MAGIC = b'EVJOURNL'
+VERSION = 2
+SEGMENT = struct.Struct('<8sHI')
+RECORD = struct.Struct('<II')
+BODY = struct.Struct('<IQd')
+TRAILER = struct.Struct('<I')
+BROADCAST = 1
+COMMANDS = 2
+
+
+def is_journal_field(directory):
+    # series written to the journal instead of per-vial files
+    return directory in ['OD', 'temp'] or directory.endswith('_raw')
+
+
+def segment_name(offset):
+    return '{0:020d}.evj'.format(offset)
+
+
+def broadcast_row(fields, vials, version=VERSION):
+    # dtype of the fixed part of a broadcast record, version 1 records have
+    # no valid mask (all vials are valid)
+    row = [('present', '<u8'), ('elapsed', '<f8'),
+           ('values', '<f8', (fields, vials))]
+    if version >= 2:
+        row.append(('valid', 'u1', (vials,)))
+    return np.dtype(row)
+
+
+def layout_row(layout):
+    return broadcast_row(len(layout['fields']), layout['vials'],
+                         layout['version'])
+
+
+def encode_record(kind, sequence, event_time, payload):
+    body = BODY.pack(kind, sequence, event_time) + payload
+    return (RECORD.pack(len(body), zlib.crc32(body) & 0xffffffff) + body +
+            TRAILER.pack(RECORD.size + len(body) + TRAILER.size))
+
+
+def to_floats(values, count):
+    # values of the vials (numbers or strings), NaN if not numbers
+    row = np.full(count, np.nan)
+    try:
+        values = np.asarray(values, dtype=np.float64)[:count]
+        row[:len(values)] = values
+    except ValueError:
+        for c, value in enumerate(values[:count]):
+            try:
+                row[c] = float(value)
+            except (TypeError, ValueError):
+                pass
+    return row
+
+
+def format_value(field, value):
+    # as in the legacy text files: raw readings are integers
+    if field.endswith('_raw') and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class JournalReader(object):
+    """
+    Reads the journal of an experiment. Series are returned as
+    (elapsed time, value) rows of a vial, like the legacy text files:
+
+        journal = JournalReader(exp_dir)
+        od = journal.read('OD', 3)
+        for record in journal.records():
+            ...
+    """
+
+    def __init__(self, exp_dir):
+        self.directory = os.path.join(exp_dir, JOURNAL_DIRECTORY)
+        # segment -> parsed broadcast records, see _broadcasts()
+        self._parsed = {}
+
+    def exists(self):
+        return os.path.isdir(self.directory)
+
+    def segments(self):
+        if not self.exists():
+            return []
+        return [os.path.join(self.directory, name) for name in
+                sorted(os.listdir(self.directory)) if name.endswith('.evj')]
+
+    def segment_path(self):
+        # segment being written
+        segments = self.segments()
+        if segments:
+            return segments[-1]
+        return os.path.join(self.directory, segment_name(0))
+
+    def mtime(self):
+        # of the segment being written, 0 if there is none yet
+        path = self.segment_path()
+        return os.path.getmtime(path) if os.path.exists(path) else 0
+
+    def layout(self, path):
+        # (layout, with the format version, size of the segment header)
+        with open(path, 'rb') as f:
+            header = f.read(SEGMENT.size)
+            if len(header) < SEGMENT.size:
+                return None, 0
+            magic, version, length = SEGMENT.unpack(header)
+            if magic != MAGIC or version > VERSION:
+                raise ValueError('%s is not a journal segment' % path)
+            layout = f.read(length)
+        if len(layout) < length:
+            return None, 0
+        layout = json.loads(layout.decode('utf-8'))
+        layout['version'] = version
+        return layout, SEGMENT.size + length
+
+    def scan(self, path, offset=None):
+        """
+        Yields (end, kind, sequence, time, payload) of the records of a
+        segment, from a byte offset (default: the first record). Stops at a
+        torn or corrupted record.
+        """
+        if offset is None:
+            offset = self.layout(path)[1]
+            if offset == 0:
+                return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        position = 0
+        while position + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, position)
+            start = position + RECORD.size
+            end = start + length + TRAILER.size
+            body = data[start:start + length]
+            if (end > len(data) or length < BODY.size or
+                    zlib.crc32(body) & 0xffffffff != crc):
+                break
+            kind, sequence, event_time = BODY.unpack_from(body)
+            yield (offset + end, kind, sequence, event_time,
+                   body[BODY.size:])
+            position = end
+        if position < len(data):
+            logger.warning('%d bytes of torn or corrupted records at the '
+                           'end of %s' % (len(data) - position, path))
+
+    def scan_back(self, path):
+        """
+        Yields the records of a segment like scan(), last one first. Stops
+        at the first one that does not check out (e.g. a torn last record).
+        """
+        start = self.layout(path)[1]
+        if start == 0:
+            return
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            while end - start >= RECORD.size + TRAILER.size:
+                f.seek(end - TRAILER.size)
+                length, = TRAILER.unpack(f.read(TRAILER.size))
+                if length > end - start or length < RECORD.size + BODY.size:
+                    return
+                f.seek(end - length)
+                data = f.read(length)
+                size, crc = RECORD.unpack_from(data)
+                body = data[RECORD.size:RECORD.size + size]
+                if (RECORD.size + size + TRAILER.size != length or
+                        zlib.crc32(body) & 0xffffffff != crc):
+                    return
+                kind, sequence, event_time = BODY.unpack_from(body)
+                yield end, kind, sequence, event_time, body[BODY.size:]
+                end -= length
+
+    def _broadcasts(self, path):
+        """
+        Layout, elapsed times, field masks and values (rows x fields x
+        vials) of the broadcast records of a segment. Only the records
+        appended since the last call are parsed.
+        """
+        parsed = self._parsed.get(path)
+        if parsed is None:
+            layout, start = self.layout(path)
+            if layout is None:
+                return None
+            dtype = layout_row(layout)
+            parsed = {'layout': layout, 'dtype': dtype, 'end': start,
+                      'rows': np.empty(0, dtype)}
+            self._parsed[path] = parsed
+        if file_size(path) > parsed['end']:
+            rows = []
+            size = parsed['dtype'].itemsize
+            for end, kind, _, _, payload in self.scan(path, parsed['end']):
+                if kind == BROADCAST:
+                    rows.append(payload[:size])
+                parsed['end'] = end
+            if rows:
+                parsed['rows'] = np.concatenate([
+                    parsed['rows'],
+                    np.frombuffer(b''.join(rows), parsed['dtype'])])
+        return parsed
+
+    def _column(self, layout, rows, field, vial):
+        # (elapsed time, value) rows of a field of a vial, where it was valid
+        if field not in layout['fields']:
+            return np.empty((0, 2))
+        index = layout['fields'].index(field)
+        keep = (rows['present'] >> np.uint64(index)) & np.uint64(1) == 1
+        if 'valid' in rows.dtype.names:
+            keep &= rows['valid'][:, vial] != 0
+        rows = rows[keep]
+        return np.column_stack([rows['elapsed'],
+                                rows['values'][:, index, vial]])
+
+    def read(self, field, vial, path=None, offset=0):
+        """
+        (elapsed time, value) rows of a field of a vial, from the whole
+        journal, or from a byte offset of one segment.
+        """
+        if path is None:
+            columns = []
+            for segment in self.segments():
+                parsed = self._broadcasts(segment)
+                if parsed is not None:
+                    columns.append(self._column(parsed['layout'],
+                                                parsed['rows'], field, vial))
+            if not columns:
+                return np.empty((0, 2))
+            return np.concatenate(columns)
+        if not os.path.exists(path):
+            return np.empty((0, 2))
+        layout, start = self.layout(path)
+        if layout is None:
+            return np.empty((0, 2))
+        dtype = layout_row(layout)
+        rows = [payload[:dtype.itemsize] for _, kind, _, _, payload in
+                self.scan(path, max(offset, start)) if kind == BROADCAST]
+        return self._column(layout, np.frombuffer(b''.join(rows), dtype),
+                            field, vial)
+
+    def tail(self, field, vial, window):
+        """
+        Last 'window' rows of a field of a vial, read from the end of the
+        journal. Like tail_to_np, an empty array is returned if there are
+        not that many rows.
+        """
+        if window <= 0:
+            return np.asarray([])
+        columns = []
+        count = 0
+        for path in reversed(self.segments()):
+            layout = self.layout(path)[0]
+            if layout is None or field not in layout['fields']:
+                continue
+            if self._last_end(path) < file_size(path):
+                # a torn last record stops the backward walk
+                column = self._column(layout, self._broadcasts(path)['rows'],
+                                      field, vial)[-(window - count):]
+            else:
+                column = self._tail_column(path, layout, field, vial,
+                                           window - count)
+            columns.insert(0, column)
+            count += len(column)
+            if count >= window:
+                return np.concatenate(columns)
+        return np.asarray([])
+
+    def _tail_column(self, path, layout, field, vial, window):
+        # last rows of a field of a vial in a segment, walking backwards
+        dtype = layout_row(layout)
+        bit = 1 << layout['fields'].index(field)
+        valid = None
+        if 'valid' in dtype.names:
+            valid = dtype.fields['valid'][1] + vial
+        rows = []
+        for _, kind, _, _, payload in self.scan_back(path):
+            if (kind == BROADCAST and
+                    int.from_bytes(payload[:8], 'little') & bit and
+                    (valid is None or payload[valid])):
+                rows.append(payload[:dtype.itemsize])
+                if len(rows) >= window:
+                    break
+        rows.reverse()
+        return self._column(layout, np.frombuffer(b''.join(rows), dtype),
+                            field, vial)
+
+    def _last_end(self, path):
+        # end of the last record, if it checks out
+        for end, _, _, _, _ in self.scan_back(path):
+            return end
+        return self.layout(path)[1]
+
+    def records(self):
+        """
+        Yields every record of the journal as a dict: kind ('broadcast' or
+        'commands'), sequence, time, and elapsed_time, the values of each
+        field, the vials left out (masked) and the config echo (of the
+        previous record if unchanged), or the commands.
+        """
+        for path in self.segments():
+            layout, start = self.layout(path)
+            if layout is None:
+                continue
+            dtype = layout_row(layout)
+            config = None
+            for _, kind, sequence, event_time, payload in self.scan(path,
+                                                                   start):
+                record = {'sequence': sequence, 'time': event_time}
+                if kind == BROADCAST:
+                    row = np.frombuffer(payload[:dtype.itemsize], dtype)[0]
+                    extra = payload[dtype.itemsize:]
+                    if extra:
+                        config = json.loads(extra.decode('utf-8'))['config']
+                    record.update({
+                        'kind': 'broadcast',
+                        'elapsed_time': float(row['elapsed']),
+                        'values': dict(
+                            (field, row['values'][c].tolist())
+                            for c, field in enumerate(layout['fields'])
+                            if int(row['present']) >> c & 1),
+                        'masked': ([] if 'valid' not in dtype.names else
+                                   np.flatnonzero(row['valid'] == 0).tolist()),
+                        'config': config})
+                elif kind == COMMANDS:
+                    record.update({
+                        'kind': 'commands',
+                        'commands': json.loads(payload.decode('utf-8'))})
+                else:
+                    continue
+                yield record
+
+    def project(self, output, fields=None, vials=None):
+        """
+        Writes the legacy text files of the journal series
+        (<output>/<field>/vial<N>_<field>.txt). Returns the paths written.
+        """
+        layouts = [layout for layout in
+                   (self.layout(path)[0] for path in self.segments())
+                   if layout is not None]
+        if not layouts:
+            return []
+        headers = {}
+        for layout in layouts:
+            for field in layout['fields']:
+                headers.setdefault(field, layout['headers'].get(field))
+        if fields is None:
+            fields = list(headers)
+        if vials is None:
+            vials = range(max(layout['vials'] for layout in layouts))
+        paths = []
+        for field in fields:
+            if field not in headers:
+                logger.warning('no %s series in the journal' % field)
+                continue
+            os.makedirs(os.path.join(output, field), exist_ok=True)
+            for x in vials:
+                path = vial_file_path(output, field, x)
+                lines = []
+                if headers[field] is not None:
+                    lines.append('Experiment: {0} vial {1}, {2}'.format(
+                        layouts[0]['exp_name'], x, headers[field]))
+                for elapsed_time, value in self.read(field, x).tolist():
+                    lines.append('{0},{1}'.format(
+                        repr(elapsed_time), format_value(field, value)))
+                with open(path, 'w') as f:
+                    f.write(''.join(line + '\n' for line in lines))
+                paths.append(path)
+        return paths
+
+
+class Journal(JournalReader):
+    """
+    Writes the journal of an experiment: one record per broadcast instead of
+    a line in a file per vial and series. Records are appended through the
+    DataWriter, so they follow its flush policy (and thread with
+    --async-io).
+
+        journal.add('OD', od)                # values of every vial
+        journal.add('temp', temp)
+        journal.write_broadcast(time.time(), elapsed_time, data['config'],
+                                valid)      # vials left out are not read
+        journal.command('command', [data])   # sent to the eVOLVER
+        journal.write_commands(time.time())
+    """
+
+    def __init__(self, exp_dir, writer, vials, exp_name,
+                 segment_size=SEGMENT_SIZE):
+        JournalReader.__init__(self, exp_dir)
+        self.writer = writer
+        self.vials = vials
+        self.exp_name = exp_name
+        self.segment_size = segment_size
+        self.sequence = 0
+        # segment being written, its size and journal offset
+        self.path = None
+        self.size = 0
+        self.base = 0
+        self.fields = []
+        # format of the segment being written
+        self.version = VERSION
+        # field -> first line of its legacy text files
+        self.headers = {}
+        self._config = None
+        self._values = {}
+        self._commands = []
+
+    def open(self):
+        # continues the journal of the experiment, if any, dropping a torn
+        # last record (the DPU stopped while writing it)
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        if not segments:
+            return
+        path = segments[-1]
+        self.writer.flush(path)
+        layout, start = self.layout(path)
+        if layout is None:
+            # the DPU stopped while writing the segment header
+            os.remove(path)
+            return self.open()
+        self.sequence = layout['sequence']
+        end = start
+        for end, _, sequence, _, _ in self.scan_back(path):
+            self.sequence = sequence
+            break
+        if end < file_size(path):
+            # a torn record, the good ones end before it
+            end = start
+            for end, _, sequence, _, _ in self.scan(path, start):
+                self.sequence = sequence
+            logger.warning('dropping %d bytes of a torn record at the end '
+                           'of %s' % (file_size(path) - end, path))
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        for segment in segments:
+            self.headers.update(self.layout(segment)[0]['headers'])
+        self.path = path
+        self.size = end
+        self.base = int(os.path.basename(path).split('.')[0])
+        self.fields = layout['fields']
+        # records of another format go to a new segment
+        self.version = layout['version']
+        logger.info('continuing journal %s at record %d' %
+                    (path, self.sequence))
+
+    def segment_path(self):
+        if self.path is not None:
+            return self.path
+        return os.path.join(self.directory, segment_name(self.base))
+
+    def add(self, field, values):
+        # values of a field for every vial, in the next broadcast record
+        self._values[field] = to_floats(values, self.vials)
+
+    def command(self, event, args):
+        # sent to the eVOLVER, in the next commands record
+        self._commands.append([event, list(args)])
+
+    def write_broadcast(self, event_time, elapsed_time, config=None,
+                        valid=None):
+        # valid: mask of the vials whose readings came in (default: all)
+        new_fields = [field for field in self._values
+                      if field not in self.fields]
+        if (self.path is None or new_fields or self.version != VERSION or
+                self.size >= self.segment_size):
+            self._start_segment(self.fields + new_fields)
+        row = np.zeros(1, broadcast_row(len(self.fields), self.vials))
+        row['elapsed'] = elapsed_time
+        row['values'] = np.nan
+        row['valid'] = 1 if valid is None else valid
+        present = 0
+        for c, field in enumerate(self.fields):
+            if field in self._values:
+                present |= 1 << c
+                row['values'][0, c] = self._values[field]
+        row['present'] = present
+        payload = row.tobytes()
+        if config is not None and config != self._config:
+            payload += json.dumps({'config': config}, default=str,
+                                  separators=(',', ':')).encode('utf-8')
+            self._config = config
+        self.sequence += 1
+        self._append(BROADCAST, event_time, payload)
+        self._values = {}
+
+    def write_commands(self, event_time):
+        if not self._commands or self.path is None:
+            return
+        self._append(COMMANDS, event_time, json.dumps(
+            self._commands, default=str,
+            separators=(',', ':')).encode('utf-8'))
+        self._commands = []
+
+    def _start_segment(self, fields):
+        self.base += self.size
+        self.size = 0
+        self.path = os.path.join(self.directory, segment_name(self.base))
+        for field in fields:
+            if field not in self.headers:
+                self.headers[field] = (None if field in HEADERLESS else
+                                       time.strftime('%c'))
+        self.fields = fields
+        self.version = VERSION
+        layout = json.dumps({
+            'vials': self.vials,
+            'fields': fields,
+            'exp_name': self.exp_name,
+            # of the last record before the segment
+            'sequence': self.sequence,
+            'headers': dict((field, self.headers[field])
+                            for field in fields)}).encode('utf-8')
+        logger.debug('starting journal segment %s' % self.path)
+        self._write(SEGMENT.pack(MAGIC, VERSION, len(layout)) + layout)
+        # segments start with the config echo
+        self._config = None
+
+    def _append(self, kind, event_time, payload):
+        self._write(encode_record(kind, self.sequence, event_time, payload))
+
+    def _write(self, data):
+        self.writer.write_bytes(self.path, data)
+        self.size += len(data)
+
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Writes the legacy per-vial text files '
+                    '(<param>/vial<N>_<param>.txt) of the series in the '
+                    'journal of an experiment, or prints its records.')
+    parser.add_argument('exp_dir',
+                        help='Experiment directory')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Directory to write the files to (default: '
+                             'the experiment directory)')
+    parser.add_argument('--fields', nargs='+',
+                        default=None,
+                        help='Series to write, e.g. OD temp (default: all)')
+    parser.add_argument('--vials', type=int, nargs='+',
+                        default=None,
+                        help='Vials to write (default: all)')
+    parser.add_argument('--dump', action='store_true',
+                        default=False,
+                        help='Print the records as JSON lines instead')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = get_options()
+    logging.basicConfig(level=logging.WARNING)
+    journal = JournalReader(options.exp_dir)
+    if not journal.exists():
+        print('{0} has no journal'.format(options.exp_dir))
+        sys.exit(1)
+    if options.dump:
+        for record in journal.records():
+            print(json.dumps(record, default=str))
+    else:
+        paths = journal.project(options.output or options.exp_dir,
+                                options.fields, options.vials)
+        print('{0} files written'.format(len(paths)))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets (ms), the last bucket is unbounded
+BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+           5000, 10000]
+# warn when handling a broadcast takes this fraction of the broadcast interval
+WARNING_FRACTION = 0.8
+# weight of the newest interval in the broadcast interval estimate
+INTERVAL_SMOOTHING = 0.1
+
+
+class StageStats(object):
+    # count, total, max and histogram of the durations of one stage (ms)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the percentile, at most the
+        # longest duration seen
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else None,
+                'max_ms': self.max,
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'p99_ms': self.percentile(0.99),
+                'buckets_ms': BUCKETS,
+                'histogram': list(self.histogram)}
+
+
+class LatencyStats(object):
+    """
+    Times the stages of every broadcast handled by the DPU:
+
+        stats.begin(timestamp)
+        ...
+        stats.lap('transform')
+        ...
+        stats.lap('custom_functions')
+        stats.end()
+
+    lap() records the time since the previous lap (or begin). Stats are
+    written to a JSON file every write_interval seconds, and a warning is
+    logged when a broadcast takes most of the broadcast interval. Stage
+    durations are measured with time.perf_counter(), the broadcast interval
+    and write times with clock (the virtual clock during a replay).
+    """
+
+    def __init__(self, path, write_interval=60, clock=time.time):
+        self.path = path
+        self.write_interval = write_interval
+        self.clock = clock
+        self.stages = {}
+        self.total = StageStats()
+        # estimated seconds between broadcasts
+        self.interval = None
+        self.slow_broadcasts = 0
+        # broadcasts each vial was left out of (NaN or missing readings) and
+        # broadcasts dropped altogether
+        self.masked = {}
+        self.dropped_broadcasts = 0
+        self._started = None
+        self._last_lap = None
+        self._last_broadcast = None
+        self._last_write = clock()
+        self._warned = False
+
+    def begin(self, timestamp=None):
+        # timestamp: when the broadcast was sent, if known (arrival time
+        # otherwise, which is wrong while queued broadcasts are drained)
+        self._started = self._last_lap = time.perf_counter()
+        if timestamp is None:
+            timestamp = self.clock()
+        if self._last_broadcast is not None:
+            interval = timestamp - self._last_broadcast
+            if interval > 0:
+                if self.interval is None:
+                    self.interval = interval
+                else:
+                    self.interval += INTERVAL_SMOOTHING * (interval -
+                                                           self.interval)
+        self._last_broadcast = timestamp
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats()
+        stats.add((now - self._last_lap) * 1000)
+        self._last_lap = now
+
+    def count_masked(self, vials):
+        for x in vials:
+            self.masked[int(x)] = self.masked.get(int(x), 0) + 1
+
+    def end(self):
+        if self._started is None:
+            return
+        duration = time.perf_counter() - self._started
+        self._started = None
+        self.total.add(duration * 1000)
+        if self.interval and duration > WARNING_FRACTION * self.interval:
+            self.slow_broadcasts += 1
+            if not self._warned:
+                # once per write interval
+                logger.warning('broadcast handled in %.2f s, broadcasts '
+                               'come every %.2f s' % (duration,
+                                                      self.interval))
+                self._warned = True
+        if self.clock() - self._last_write >= self.write_interval:
+            self.write()
+
+    def snapshot(self):
+        return {'time': self.clock(),
+                'broadcast_interval_s': self.interval,
+                'slow_broadcasts': self.slow_broadcasts,
+                'masked_vials': dict((str(x), count) for x, count in
+                                     sorted(self.masked.items())),
+                'dropped_broadcasts': self.dropped_broadcasts,
+                'total': self.total.snapshot(),
+                'stages': dict((stage, stats.snapshot())
+                               for stage, stats in list(self.stages.items()))}
+
+    def write(self):
+        self._last_write = self.clock()
+        self._warned = False
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        # replace the file at once, readers never see half of it
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class StatusServer(object):
+    """
+    Serves the latency stats of one or more experiments as JSON on
+    http://host:port/ from a background thread.
+    """
+
+    def __init__(self, port, sources, host='127.0.0.1'):
+        # sources: experiment name -> LatencyStats
+        self.sources = sources
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # a snapshot may be taken mid-broadcast, close enough
+                body = json.dumps(dict(
+                    (name, stats.snapshot())
+                    for name, stats in list(server.sources.items()))
+                ).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        logger.info('serving latency stats on port %d' %
+                    self.httpd.server_address[1])
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import json
+import time
+import logging
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# events received from the eVOLVER, in the experiment directory (--record)
+RECORD_FILE = 'events.jsonl'
+# commands emitted during a replay, in the experiment directory
+COMMANDS_FILE = 'replay_commands.jsonl'
+# recorded events -> namespace handler
+HANDLERS = {'broadcast': 'on_broadcast',
+            'activecalibrations': 'on_activecalibrations'}
+
+
+def format_event(event_time, event, data):
+    # one JSON object per line: {"time":...,"event":...,"data":...}
+    return json.dumps({'time': event_time, 'event': event, 'data': data},
+                      separators=(',', ':')) + '\n'
+
+
+def read_events(path):
+    # yields (time, event, data) of a recorded log
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last line of a log that was being written
+                logger.warning('skipping truncated event in %s' % path)
+                continue
+            yield record['time'], record['event'], record['data']
+
+
+class VirtualClock(object):
+    # stands in for time.time(), moved forward by the replay
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def set(self, now):
+        self.now = now
+
+
+class CommandLog(object):
+    """
+    Stands in for the socket.io connection of the namespace during a replay:
+    emitted commands are written to a file instead of being sent. Commands
+    emitted before the file is opened (the experiment directory may not
+    exist yet) are kept until then.
+    """
+
+    def __init__(self, clock, url='replay'):
+        self.clock = clock
+        self._url = url
+        self.count = 0
+        self._file = None
+        self._pending = []
+
+    def open(self, path):
+        self._file = open(path, 'w')
+        for line in self._pending:
+            self._file.write(line)
+        self._pending = []
+
+    def emit(self, event, *args, **kwargs):
+        line = format_event(self.clock(), event, list(args))
+        self.count += 1
+        if self._file is None:
+            self._pending.append(line)
+        else:
+            self._file.write(line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Replay(object):
+    """
+    Feeds a recorded event log through an EvolverNamespace, on a virtual
+    clock starting at the first recorded event. speed is the replay speed
+    multiplier, 0 to replay as fast as possible.
+    """
+
+    def __init__(self, path, speed=0):
+        self.path = path
+        self.speed = speed
+        self.events = read_events(path)
+        self.first = next(self.events, None)
+        if self.first is None:
+            raise ValueError('no events recorded in %s' % path)
+        self.clock = VirtualClock(self.first[0])
+        self.commands = CommandLog(self.clock.time, path)
+
+    def namespace(self, Namespace, path):
+        # offline namespace, emitting to the command log, on the virtual clock
+        namespace = Namespace(self.commands, path)
+        namespace.clock = self.clock.time
+        return namespace
+
+    def run(self, namespace):
+        count = 0
+        started = time.time()
+        for event_time, event, data in self._all_events():
+            if self.speed > 0:
+                delay = ((event_time - self.first[0]) / self.speed -
+                         (time.time() - started))
+                if delay > 0:
+                    time.sleep(delay)
+            self.clock.set(event_time)
+            handler = HANDLERS.get(event)
+            if handler is None:
+                logger.warning('cannot replay %s events' % event)
+                continue
+            getattr(namespace, handler)(data)
+            count += 1
+        duration = time.time() - started
+        logger.info('replayed %d events in %.2f s, %d commands written' %
+                    (count, duration, self.commands.count))
+        return count, duration
+
+    def _all_events(self):
+        yield self.first
+        for event in self.events:
+            yield event
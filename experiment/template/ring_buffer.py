@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+
+class VialRingBuffer(object):
+    """
+    Keeps the most recent rows (e.g. time, OD) of a per-vial time series in a
+    preallocated numpy array, so control code can look at recent data
+    without going back to the files on disk.
+    """
+
+    def __init__(self, vial_count, capacity, columns=2):
+        self.capacity = capacity
+        self.columns = columns
+        self._rows = np.full((vial_count, capacity, columns), np.nan)
+        # index of the next row to write and number of valid rows, per vial
+        self._head = np.zeros(vial_count, dtype=int)
+        self._count = np.zeros(vial_count, dtype=int)
+
+    def append(self, vials, elapsed_time, values):
+        # one row per vial, all vials sharing the same timestamp
+        vials = np.asarray(vials, dtype=int)
+        values = np.asarray(values, dtype=np.float64)
+        head = self._head[vials]
+        self._rows[vials, head, 0] = elapsed_time
+        self._rows[vials, head, 1] = values[vials]
+        self._head[vials] = (head + 1) % self.capacity
+        self._count[vials] = np.minimum(self._count[vials] + 1, self.capacity)
+
+    def load(self, vial, rows):
+        # replace the content of a vial with the last 'capacity' rows given
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.columns)
+        rows = rows[-self.capacity:]
+        self._rows[vial, :len(rows)] = rows
+        self._head[vial] = len(rows) % self.capacity
+        self._count[vial] = len(rows)
+
+    def extend(self, vial, rows):
+        # append rows to a vial
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.columns)
+        self.load(vial, np.concatenate([
+            self.tail(vial, self.count(vial)).reshape(-1, self.columns),
+            rows]))
+
+    def snapshot(self):
+        # content of the buffer (not copies), see restore()
+        return {'rows': self._rows, 'head': self._head, 'count': self._count}
+
+    def restore(self, snapshot):
+        # False (and nothing restored) if the snapshot has another shape
+        if np.shape(snapshot['rows']) != self._rows.shape:
+            return False
+        self._rows = np.array(snapshot['rows'], dtype=np.float64)
+        self._head = np.array(snapshot['head'], dtype=int)
+        self._count = np.array(snapshot['count'], dtype=int)
+        return True
+
+    def count(self, vial):
+        return int(self._count[vial])
+
+    def tail(self, vial, window):
+        """
+        Returns the last 'window' rows of a vial, oldest first. Mirrors
+        tail_to_np: an empty array is returned if there is not enough data.
+        """
+        if window <= 0 or self._count[vial] < window:
+            return np.asarray([])
+        index = (self._head[vial] - window + np.arange(window)) % self.capacity
+        return self._rows[vial, index]
+
+    def tail_all(self, window):
+        """
+        Returns the last 'window' rows of every vial as a (vials x window x
+        columns) array, oldest first, and the mask of the vials that have
+        enough data. Rows of the other vials are NaN.
+        """
+        vial_count = len(self._count)
+        ready = self._count >= max(window, 1)
+        index = ((self._head[:, None] - window + np.arange(window)) %
+                 self.capacity)
+        rows = self._rows[np.arange(vial_count)[:, None], index]
+        rows[~ready] = np.nan
+        return rows, ready
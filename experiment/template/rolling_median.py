@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import bisect
+import collections
+import math
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+# MAD to standard deviation of normally distributed noise
+MAD_SCALE = 1.4826
+
+
+def sorted_median(values):
+    # median of a sorted list, as np.median
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+def sorted_mad(values, median):
+    """
+    Median of the distances of a sorted list of values to their median, as
+    np.median(np.abs(values - median)), in O(log n): the distances of the
+    values below the median and of the others are two ascending sequences,
+    the middle ones of both are found by binary search.
+    """
+    n = len(values)
+    split = bisect.bisect_left(values, median)
+
+    def below(i):
+        return median - values[split - 1 - i]
+
+    def above(i):
+        return values[split + i] - median
+
+    def kth(k):
+        # k-th smallest distance, taking i of them from below
+        lo, hi = max(0, k + 1 - (n - split)), min(k + 1, split)
+        while lo < hi:
+            i = (lo + hi) // 2
+            if below(i) < above(k - i):
+                lo = i + 1
+            else:
+                hi = i
+        candidates = []
+        if lo > 0:
+            candidates.append(below(lo - 1))
+        if k + 1 - lo > 0:
+            candidates.append(above(k - lo))
+        return max(candidates)
+
+    if n % 2:
+        return kth(n // 2)
+    return (kth(n // 2 - 1) + kth(n // 2)) / 2
+
+
+class RollingMedian(object):
+    """
+    Median and median absolute deviation (MAD) of the last 'window' values
+    of every vial, kept up to date as values arrive. Each vial keeps its
+    window sorted, so a new value costs a binary search and an O(window)
+    list insert/remove instead of sorting the window again, and the median
+    and MAD are read in O(log window). Same results as np.median over the
+    window, NaN if the window holds a NaN.
+    """
+
+    def __init__(self, vial_count, window):
+        self.window = window
+        # values in arrival order, the same sorted (without NaN)
+        self._values = [collections.deque() for _ in range(vial_count)]
+        self._sorted = [[] for _ in range(vial_count)]
+        self._nan = [0] * vial_count
+
+    def append(self, vials, values):
+        # one value per vial
+        for x in vials:
+            self._push(x, float(values[x]))
+
+    def _push(self, vial, value):
+        self._values[vial].append(value)
+        if math.isnan(value):
+            self._nan[vial] += 1
+        else:
+            bisect.insort(self._sorted[vial], value)
+        if len(self._values[vial]) > self.window:
+            old = self._values[vial].popleft()
+            if math.isnan(old):
+                self._nan[vial] -= 1
+            else:
+                del self._sorted[vial][bisect.bisect_left(self._sorted[vial],
+                                                          old)]
+
+    def load(self, vial, values):
+        # replace the window of a vial with the last values given
+        values = [float(value) for value in values][-self.window:]
+        self._values[vial] = collections.deque(values)
+        self._sorted[vial] = sorted(value for value in values
+                                    if not math.isnan(value))
+        self._nan[vial] = len(values) - len(self._sorted[vial])
+
+    def ready(self):
+        # mask of the vials whose window is full
+        return np.array([len(values) >= self.window
+                         for values in self._values], dtype=bool)
+
+    def _stat(self, func):
+        # per vial, NaN if the window is not full or holds a NaN
+        result = np.full(len(self._values), np.nan)
+        for x, values in enumerate(self._sorted):
+            if len(self._values[x]) >= self.window and not self._nan[x]:
+                result[x] = func(values)
+        return result
+
+    def median(self):
+        return self._stat(sorted_median)
+
+    def mad(self):
+        return self._stat(lambda values: sorted_mad(values,
+                                                    sorted_median(values)))
+
+    def last(self):
+        # newest value of every vial
+        return np.array([values[-1] if values else np.nan
+                         for values in self._values])
+
+    def outliers(self, threshold=3.0):
+        """
+        Mask of the vials whose newest value is more than 'threshold'
+        robust standard deviations (MAD_SCALE * MAD) away from the median
+        of their window.
+        """
+        with np.errstate(invalid='ignore'):
+            return (np.abs(self.last() - self.median()) >
+                    threshold * MAD_SCALE * self.mad())
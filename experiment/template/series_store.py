@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import os
+import struct
+import numpy as np
+
+from data_files import (vial_file_path, tail_lines, count_lines, read_rows,
+                        file_size)
+from journal import JournalReader, is_journal_field
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+# How the per-vial series (OD, temperature, growth rate, raw readings, pump
+# log and ODset) are stored:
+# text: comma-separated text files (vialX_<param>.txt)
+# binary: float64 rows in binary files (vialX_<param>.bin), see below
+# both: binary files, with the text files as a mirror
+SERIES_FORMATS = ['text', 'binary', 'both']
+# directories of the series, plus the <param>_raw ones
+SERIES_DIRECTORIES = ['OD', 'temp', 'growthrate', 'pump_log', 'ODset']
+
+# A binary file is a 16 bytes header (magic, format version, number of
+# columns) followed by the rows, fixed-width float64 values in native byte
+# order. Rows are only ever appended, so the file can be read through
+# np.memmap while the DPU writes it. The rows are those of the text file,
+# without its header line; values that are not numbers (None) are NaN.
+MAGIC = b'EVSERIES'
+VERSION = 1
+HEADER = struct.Struct('<8sHHI')
+
+# Text files have a sparse index next to them (vialX_<param>.idx), kept by
+# the DataWriter as it appends rows: a header (magic, format version, rows
+# between entries) then entries of the time of a row and its byte offset in
+# the text file, every INDEX_STRIDE rows. Reading a time range only parses
+# the rows from the last entry before it.
+INDEX_MAGIC = b'EVSINDEX'
+INDEX_VERSION = 1
+INDEX_STRIDE = 64
+INDEX_HEADER = struct.Struct('<8sHHI')
+INDEX_ENTRY = np.dtype([('time', '<f8'), ('offset', '<u8')])
+
+
+def is_series(directory):
+    return directory in SERIES_DIRECTORIES or directory.endswith('_raw')
+
+
+def binary_path(path):
+    # vialX_<param>.txt -> vialX_<param>.bin
+    return os.path.splitext(path)[0] + '.bin'
+
+
+def index_path(path):
+    # vialX_<param>.txt -> vialX_<param>.idx
+    return os.path.splitext(path)[0] + '.idx'
+
+
+def encode_index_header():
+    return INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_STRIDE, 0)
+
+
+def encode_index_entry(row_time, offset):
+    return np.array([(row_time, offset)], INDEX_ENTRY).tobytes()
+
+
+def build_index(path):
+    """
+    Index of the rows of a text file so far: (index file contents, size of
+    the text file, rows after the last entry).
+    """
+    entries = []
+    offset = 0
+    rows = 0
+    header = text_header_lines(path)
+    with open(path, 'rb') as f:
+        for n, line in enumerate(f):
+            if n >= header:
+                if rows % INDEX_STRIDE == 0:
+                    try:
+                        entries.append((float(line.split(b',')[0]), offset))
+                    except ValueError:
+                        rows -= 1
+                rows += 1
+            offset += len(line)
+    return (encode_index_header() + np.array(entries, INDEX_ENTRY).tobytes(),
+            offset, (rows - 1) % INDEX_STRIDE + 1 if rows else INDEX_STRIDE)
+
+
+def read_index(path):
+    # entries of the index of a text file, None if it has none
+    path = index_path(path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        header = f.read(INDEX_HEADER.size)
+        data = f.read()
+    if len(header) < INDEX_HEADER.size:
+        return None
+    magic, version, _, _ = INDEX_HEADER.unpack(header)
+    if magic != INDEX_MAGIC or version > INDEX_VERSION:
+        return None
+    # a partly written last entry is left out
+    size = len(data) - len(data) % INDEX_ENTRY.itemsize
+    return np.frombuffer(data[:size], INDEX_ENTRY)
+
+
+def starts_line(path, offset):
+    # whether a byte offset of a file is at the start of a line
+    if offset == 0:
+        return True
+    if offset >= file_size(path):
+        return False
+    with open(path, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+
+
+def index_offsets(path, start=None, end=None):
+    """
+    Byte offsets (first, last) of a text file between which its rows from
+    time 'start' to 'end' are, from its index. last is None for the end of
+    the file. Without index (or if it does not match the file) the whole
+    file: (0, None).
+    """
+    entries = read_index(path)
+    if entries is None or len(entries) == 0:
+        return 0, None
+    first = 0
+    last = None
+    if start is not None:
+        # rows can have the same time, the entry must be before it
+        before = np.searchsorted(entries['time'], start, 'left') - 1
+        if before >= 0:
+            first = int(entries['offset'][before])
+    if end is not None:
+        after = np.searchsorted(entries['time'], end, 'right')
+        if after < len(entries):
+            last = int(entries['offset'][after])
+    if not starts_line(path, first) or (last is not None and
+                                        not starts_line(path, last)):
+        return 0, None
+    return first, last
+
+
+def search_time(times, value, side='left'):
+    # np.searchsorted on a (memory-mapped) column without copying it
+    lo, hi = 0, len(times)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[mid] < value or (side == 'right' and times[mid] == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def encode_header(columns):
+    return HEADER.pack(MAGIC, VERSION, columns, 0)
+
+
+def encode_row(values, columns=None):
+    # values that are not numbers (None) are NaN, missing columns too
+    row = np.full(columns or len(values), np.nan)
+    for c, value in enumerate(values[:len(row)]):
+        try:
+            row[c] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return row.tobytes()
+
+
+def read_columns(path):
+    # number of columns from the header of a binary file
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, version, columns, _ = HEADER.unpack(header)
+    if magic != MAGIC or version > VERSION:
+        raise ValueError('%s is not a series file' % path)
+    return columns
+
+
+def open_binary(path, columns=None):
+    """
+    (rows x columns) view of the rows of a binary file, memory-mapped (not
+    copied). A partly written last row is left out.
+    """
+    if columns is None:
+        columns = read_columns(path)
+    if columns is None:
+        return np.empty((0, 0))
+    rows = (os.path.getsize(path) - HEADER.size) // (8 * columns)
+    if rows <= 0:
+        return np.empty((0, columns))
+    return np.memmap(path, dtype=np.float64, mode='r', offset=HEADER.size,
+                     shape=(rows, columns))
+
+
+def text_header_lines(path):
+    # 1 if the text file starts with an 'Experiment: ...' line, else 0
+    with open(path, 'rb') as f:
+        first = f.readline().split(b',')[0]
+    try:
+        float(first)
+        return 0
+    except ValueError:
+        return 1 if first else 0
+
+
+def parse_lines(lines):
+    """
+    Rows of text lines, values that are not numbers (None) read as NaN.
+    Lines from the header on are left out.
+    """
+    rows = []
+    for line in reversed(lines):
+        values = line.split(',')
+        try:
+            row = [float(values[0])]
+        except ValueError:
+            break
+        for value in values[1:]:
+            try:
+                row.append(float(value))
+            except ValueError:
+                row.append(np.nan)
+        rows.append(row)
+    rows.reverse()
+    try:
+        return np.array(rows, dtype=np.float64)
+    except ValueError:
+        # rows of different lengths
+        return np.asarray([])
+
+
+class SeriesReader(object):
+    """
+    Reads the per-vial series of an experiment from whichever files hold
+    them: the binary files if the DPU writes them, else the text files.
+    Rows are returned as numpy arrays, views of the memory-mapped binary
+    files (read only) or parsed from the text.
+
+        series = SeriesReader(exp_dir)
+        od = series.read('OD', 3)            # time, OD of vial 3
+        rows = series.tail('pump_log', 3, 5)  # last 5 pumps
+
+    With the DataWriter of the experiment, its buffered rows are written
+    out before reading and its series format decides the files read.
+    Without it (e.g. the graphing views) the binary files are read if they
+    are at least as new as the text files.
+
+    The OD, temperature and raw series of an experiment with a journal (see
+    journal.py) are read from it: always with the Journal the DPU writes,
+    else if it is at least as new as the text files.
+    """
+
+    def __init__(self, exp_dir, writer=None, journal=None):
+        self.exp_dir = exp_dir
+        self.writer = writer
+        if journal is None and writer is None:
+            journal = JournalReader(exp_dir)
+            if not journal.exists():
+                journal = None
+        self.journal = journal
+
+    def from_journal(self, directory, vial, param=None):
+        # whether the series is read from the journal
+        if self.journal is None or not is_journal_field(directory):
+            return False
+        if self.writer is not None:
+            return True
+        text = vial_file_path(self.exp_dir, directory, vial, param)
+        return (not os.path.exists(text) or
+                self.journal.mtime() >= os.path.getmtime(text))
+
+    def binary(self, directory, vial, param=None):
+        # whether the series is read from its binary file
+        if not is_series(directory):
+            return False
+        if self.writer is not None:
+            return self.writer.series_format != 'text'
+        text = vial_file_path(self.exp_dir, directory, vial, param)
+        if not os.path.exists(binary_path(text)):
+            return False
+        return (not os.path.exists(text) or
+                os.path.getmtime(binary_path(text)) >= os.path.getmtime(text))
+
+    def path(self, directory, vial, param=None):
+        # file the series is read from
+        if self.from_journal(directory, vial, param):
+            return self.journal.segment_path()
+        path = vial_file_path(self.exp_dir, directory, vial, param)
+        if self.binary(directory, vial, param):
+            return binary_path(path)
+        return path
+
+    def _flush(self, path):
+        if self.writer is not None:
+            self.writer.flush(path)
+
+    def read(self, directory, vial, param=None, offset=0):
+        """
+        Rows of a series, after a byte offset of its file (e.g. its size
+        when last read), the whole series by default.
+        """
+        path = self.path(directory, vial, param)
+        self._flush(path)
+        if self.from_journal(directory, vial, param):
+            if offset:
+                return self.journal.read(directory, vial, path, offset)
+            return self.journal.read(directory, vial)
+        if not os.path.exists(path):
+            return np.empty((0, 0))
+        if path.endswith('.bin'):
+            data = open_binary(path)
+            if offset > HEADER.size and data.shape[1]:
+                data = data[(offset - HEADER.size) // (8 * data.shape[1]):]
+            return data
+        if offset:
+            rows = read_rows(path, offset, columns=self._columns(path))
+        else:
+            rows = read_rows(path, skip_header=text_header_lines(path),
+                             columns=self._columns(path))
+        return rows
+
+    def read_range(self, directory, vial, start=None, end=None, param=None):
+        """
+        Rows of a series with a time from 'start' to 'end' (included), the
+        whole series when not given. Only these rows are read: found by
+        binary search in binary files and the journal, through the index in
+        text files.
+        """
+        path = self.path(directory, vial, param)
+        self._flush(path)
+        if self.from_journal(directory, vial, param):
+            data = self.journal.read(directory, vial)
+        elif not os.path.exists(path):
+            return np.empty((0, 0))
+        elif path.endswith('.bin'):
+            data = open_binary(path)
+            if len(data) and start is not None:
+                data = data[search_time(data[:, 0], start, 'left'):]
+            if len(data) and end is not None:
+                data = data[:search_time(data[:, 0], end, 'right')]
+            return data
+        else:
+            self._flush(index_path(path))
+            first, last = index_offsets(path, start, end)
+            data = read_rows(path, first,
+                             text_header_lines(path) if first == 0 else 0,
+                             self._columns(path), last)
+        if len(data) == 0:
+            return data
+        keep = np.ones(len(data), dtype=bool)
+        if start is not None:
+            keep &= data[:, 0] >= start
+        if end is not None:
+            keep &= data[:, 0] <= end
+        return data[keep]
+
+    def _columns(self, path):
+        # from the last line of a text file
+        with open(path, 'rb') as f:
+            f.seek(max(os.path.getsize(path) - 512, 0))
+            lines = f.read().splitlines()
+        return lines[-1].count(b',') + 1 if lines else 1
+
+    def tail(self, directory, vial, window, param=None):
+        """
+        Last 'window' rows of a series. Like tail_to_np, an empty array is
+        returned if there are not that many rows.
+        """
+        path = self.path(directory, vial, param)
+        self._flush(path)
+        if self.from_journal(directory, vial, param):
+            return self.journal.tail(directory, vial, window)
+        if not os.path.exists(path):
+            return np.asarray([])
+        if path.endswith('.bin'):
+            data = open_binary(path)
+        else:
+            data = parse_lines(tail_lines(path, window))
+        if window <= 0 or len(data) < window:
+            return np.asarray([])
+        return data[-window:]
+
+    def count(self, directory, vial, param=None):
+        # number of rows of a series
+        path = self.path(directory, vial, param)
+        self._flush(path)
+        if self.from_journal(directory, vial, param):
+            return len(self.journal.read(directory, vial))
+        if not os.path.exists(path):
+            return 0
+        if path.endswith('.bin'):
+            return len(open_binary(path))
+        return count_lines(path) - text_header_lines(path)
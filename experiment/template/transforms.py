@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import logging
+import numpy as np
+
+##### IMPORTANT #####
+# Read the README.md file before touching this file.
+
+logger = logging.getLogger(__name__)
+
+# fit type -> (function(coefficients, raw_param_1, ...), number of params)
+# coefficients is a (vials x coefficients) array, raw params are per-vial
+# arrays. Register new fit types with @register_transform('fit_type', n).
+TRANSFORMS = {}
+
+
+def register_transform(fit_type, param_count=1):
+    def decorator(func):
+        TRANSFORMS[fit_type] = (func, param_count)
+        return func
+    return decorator
+
+
+@register_transform('sigmoid')
+def sigmoid(coefficients, raw):
+    # inverse of the sigmoid fit, raw photodiode reading -> OD
+    a, b, c, d = coefficients.T
+    return c - np.log10((b - a) / (raw - a) - 1) / d
+
+
+@register_transform('linear')
+def linear(coefficients, raw):
+    a, b = coefficients.T
+    return raw * a + b
+
+
+@register_transform('3d', 2)
+def three_dimension(coefficients, raw, raw_2):
+    c0, c1, c2, c3, c4, c5 = coefficients.T
+    return (c0 + c1 * raw + c2 * raw_2 + c3 * raw ** 2 +
+            c4 * raw * raw_2 + c5 * raw_2 ** 2)
+
+
+def calibration_params(calibration):
+    # raw params the calibration is applied to, in order
+    if calibration.type not in TRANSFORMS:
+        return calibration.params[:1]
+    return calibration.params[:TRANSFORMS[calibration.type][1]]
+
+
+def to_array(values, size=None):
+    """
+    Raw values come in as strings from the eVOLVER. A vial reporting 'NaN'
+    or something that is not a number is NaN, as are the vials missing from
+    a list shorter than 'size'.
+    """
+    try:
+        array = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        array = np.full(len(values), np.nan)
+        for c, value in enumerate(values):
+            try:
+                array[c] = float(value)
+            except (TypeError, ValueError):
+                pass
+    if size is not None and len(array) < size:
+        array = np.concatenate([array, np.full(size - len(array), np.nan)])
+    return array
+
+
+def apply_calibration(calibration, *raw):
+    """
+    Applies a calibration to all vials at once. Non-finite results (e.g.
+    readings outside of the sigmoid range) are set to NaN; use
+    np.isfinite() on the result to get the mask of valid vials.
+    """
+    if calibration.type not in TRANSFORMS:
+        logger.error('calibration type %s not supported!' % calibration.type)
+        return np.full(len(calibration.coefficients), np.nan)
+    transform = TRANSFORMS[calibration.type][0]
+    with np.errstate(all='ignore'):
+        values = np.real(transform(calibration.coefficients, *raw))
+    values = np.array(values, dtype=np.float64)
+    values[~np.isfinite(values)] = np.nan
+    return values
@@ -4,11 +4,15 @@ from bokeh.plotting import figure
 from bokeh.embed import components
 from bokeh.models import Range1d
 import numpy as np
-import itertools
 import os
+import sys
 import time
 import math
 
+# the experiment series are read through the DPU's reader (text or binary)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), 'experiment', 'template'))
+from series_store import SeriesReader
+
 # Create your views here.
 def home(request):
 	sidebar_links, subdir_log = file_scan('expt')
@@ -37,18 +41,25 @@ def vial_num(request, experiment, vial):
 	expt_dir, expt_subdir = file_scan(experiment)
 	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 	evolver_dir = os.path.join(rootdir, 'experiment')
-	OD_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "OD", "vial{0}_OD.txt".format(vial))
-	gr_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "growthrate", "vial{0}_gr.txt".format(vial))
-	temp_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "temp", "vial{0}_temp.txt".format(vial))
+	series = SeriesReader(os.path.join(evolver_dir, expt_subdir[0], experiment))
+	OD_dir = series.path("OD", vial)
+	gr_dir = series.path("growthrate", vial, "gr")
+	temp_dir = series.path("temp", vial)
+
+	# ?hours=N only plots the last N hours (only these rows are read)
+	start = None
+	if request.GET.get("hours"):
+		last = series.tail("OD", vial, 1)
+		if last.size != 0:
+			start = last[-1][0] - float(request.GET["hours"])
 
 	"""
 	OD PLOT
 	"""
 
-	with open(OD_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 5), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(OD_dir, delimiter=',')
+	data = series.read_range("OD", vial, start)
+	if len(data[::5]) >= 1000:
+		data = data[::5]
 
 	last_OD_update = time.ctime(os.path.getmtime(OD_dir))
 
@@ -64,7 +75,10 @@ def vial_num(request, experiment, vial):
 	GROWTH RATE PLOT
 	"""
 
-	gr_data = np.genfromtxt(gr_dir, delimiter=',', skip_header=2)
+	# without the initial 0,0 row
+	gr_data = series.read_range("growthrate", vial, start, param="gr")
+	if start is None:
+		gr_data = gr_data[1:]
 
 	last_grate_update = time.ctime(os.path.getmtime(gr_dir))
 
@@ -106,10 +120,9 @@ def vial_num(request, experiment, vial):
 	TEMPERATURE PLOT
 	"""
 
-	with open(temp_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 10), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(temp_dir, delimiter=',')
+	data = series.read_range("temp", vial, start)
+	if len(data[::10]) >= 1000:
+		data = data[::10]
 
 	last_temp_update = time.ctime(os.path.getmtime(temp_dir))
 
@@ -166,17 +179,18 @@ def dilutions(request, experiment):
 	efficiency = []
 	last = []
 
+	series = SeriesReader(os.path.join(evolver_dir, expt_subdir[0], experiment))
 	for vial in vial_count:
-		pump_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "pump_log", "vial{0}_pump_log.txt".format(vial))
-		ODset_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "ODset", "vial{0}_ODset.txt".format(vial))
-		data = np.genfromtxt(pump_dir, delimiter=',', skip_header=2)
+		pump_dir = series.path("pump_log", vial)
+		# without the initial 0,0,0 rows
+		data = series.read("pump_log", vial)[1:]
 
 		dil_triggered = len(data)
 
 		if dil_triggered != 0:
 			volume = str(round(sum(data[:, 1]) * cal[0, vial] / 1000, 2))
 
-			dil_intervals = len(np.genfromtxt(ODset_dir, delimiter=",", skip_header=2)) / 2
+			dil_intervals = len(series.read("ODset", vial)[1:]) / 2
 			if dil_intervals != 0:
 				extra_dils = dil_triggered - dil_intervals
 				vial_eff = (dil_intervals - extra_dils) / dil_intervals * 100
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the experiment modules import each other from the template directory
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'experiment', 'template')
+sys.path.insert(0, TEMPLATE)
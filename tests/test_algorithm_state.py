@@ -0,0 +1,55 @@
+import os
+
+from algorithm_state import TimedMorbidostatState
+from data_writer import DataWriter
+from series_store import is_series
+
+# time, pump duration, average OD, drug A state, drug B state
+PUMP_LOG = ['0,0,0,0,0', '10,5,0.3,1,0', '20,5,0.3,0,0', '30,5,0.3,1,1']
+
+
+def timed_morbidostat(exp_dir):
+    for directory in ['pump_log', 'morbido_log']:
+        os.makedirs(os.path.join(exp_dir, directory))
+    with open(os.path.join(exp_dir, 'pump_log', 'vial0_pump_log.txt'),
+              'w') as f:
+        f.write('Experiment: header\n' + '\n'.join(PUMP_LOG) + '\n')
+    with open(os.path.join(exp_dir, 'morbido_log', 'vial0_morbido_log.txt'),
+              'w') as f:
+        f.write('0,0,0,0,0,0,0,I\n')
+    writer = DataWriter()
+    return writer, TimedMorbidostatState(writer, exp_dir, 1)
+
+
+def read_events(exp_dir):
+    with open(os.path.join(exp_dir, 'drug_events',
+                           'vial0_drug_events.txt')) as f:
+        return f.read().splitlines()
+
+
+def test_drug_events_rebuilt_from_pump_log(tmp_path):
+    exp_dir = str(tmp_path)
+    writer, state = timed_morbidostat(exp_dir)
+    state.load([0])
+    writer.flush()
+    assert read_events(exp_dir) == ['0.0,A,1', '20.0,A,2', '20.0,B,1']
+    assert state.cycles['A'][0] == 2 and state.cycles['B'][0] == 1
+    assert state.last_cycle['A'][0] == 20
+    # the index is not a series, it never gets a binary file
+    assert not is_series('drug_events')
+    assert os.listdir(os.path.join(exp_dir, 'pump_log')) == \
+        ['vial0_pump_log.txt']
+
+
+def test_drug_events_appended(tmp_path):
+    exp_dir = str(tmp_path)
+    writer, state = timed_morbidostat(exp_dir)
+    state.load([0])
+    state.record_pump(0, 40, 5, 0.3, 0, 1)
+    writer.flush()
+    assert read_events(exp_dir)[-1] == '30.0,B,2'
+    # loaded back from the index
+    state = TimedMorbidostatState(writer, exp_dir, 1)
+    state.load([0])
+    assert state.cycles['B'][0] == 2 and state.last_cycle['B'][0] == 30
+    writer.close()
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from checkpoint import Checkpoint, same_state
+from data_files import vial_file_path
+from data_writer import DataWriter
+from growth_rate import GrowthRateEstimator
+from ring_buffer import VialRingBuffer
+from series_store import SeriesReader
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'checkpoint.pickle')
+    checkpoint = Checkpoint(path, interval=60)
+    state = {'setpoints': np.array([30.0, np.nan]), 'phase': ['I', 'R'],
+             'cycles': {'A': np.array([1, 2])}}
+    assert checkpoint.save(state, 0)
+    # unchanged, written again once the data is 'interval' seconds old
+    assert not checkpoint.save(state, 30)
+    assert checkpoint.save(state, 61)
+    state['phase'][1] = 'I'
+    assert checkpoint.save(state, 62)
+    assert checkpoint.sequence == 3
+
+    loaded = Checkpoint(path)
+    assert same_state(loaded.load(), state)
+    assert loaded.sequence == 3 and loaded.time == 62
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_missing_or_corrupted(tmp_path):
+    path = str(tmp_path / 'checkpoint.pickle')
+    assert Checkpoint(path).load() is None
+    with open(path, 'wb') as f:
+        f.write(b'not a pickle')
+    assert Checkpoint(path).load() is None
+
+
+@pytest.mark.parametrize('series_format', ['text', 'binary'])
+def test_markers_replay(tmp_path, series_format):
+    # OD rows written after the checkpoint are replayed from its markers
+    exp_dir = str(tmp_path)
+    os.makedirs(os.path.join(exp_dir, 'OD'))
+    writer = DataWriter(series_format=series_format)
+    series = SeriesReader(exp_dir, writer)
+    od_path = vial_file_path(exp_dir, 'OD', 0)
+    if series_format == 'text':
+        writer.write(od_path, 'Experiment: test vial 0\n')
+    od_buffer = VialRingBuffer(1, 8)
+    growth_rate = GrowthRateEstimator(1)
+    checkpoint = Checkpoint(
+        os.path.join(exp_dir, 'checkpoint.pickle'), writer,
+        data=lambda: {'od_buffer': od_buffer.snapshot(),
+                      'growth_rate': growth_rate.snapshot()},
+        files=lambda: [series.path('OD', 0)])
+
+    def broadcast(t):
+        od = 0.1 * np.exp(0.5 * t)
+        writer.write_row(od_path, [t, od])
+        od_buffer.append([0], t, [od])
+        growth_rate.add([0], t, [od])
+
+    for t in np.arange(1, 11) / 6.0:
+        broadcast(t)
+    checkpoint.save({'vials': 1}, 0)
+    for t in np.arange(11, 16) / 6.0:
+        broadcast(t)
+    writer.close()
+
+    loaded = Checkpoint(checkpoint.path)
+    loaded.load()
+    offset = loaded.markers[series.path('OD', 0)]
+    rows = np.asarray(SeriesReader(exp_dir).read('OD', 0, offset=offset))
+    assert rows.reshape(-1, 2)[:, 0].tolist() == \
+        (np.arange(11, 16) / 6.0).tolist()
+
+    restored_buffer = VialRingBuffer(1, 8)
+    restored_growth = GrowthRateEstimator(1)
+    assert restored_buffer.restore(loaded.data['od_buffer'])
+    assert restored_growth.restore(loaded.data['growth_rate'])
+    restored_buffer.extend(0, rows)
+    restored_growth.extend(0, rows[:, 0], rows[:, 1])
+    assert np.array_equal(restored_buffer.tail(0, 8), od_buffer.tail(0, 8))
+    assert np.allclose(restored_growth.fit(0), growth_rate.fit(0))
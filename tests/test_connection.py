@@ -0,0 +1,70 @@
+import pytest
+
+import eVOLVER
+from connection import EvolverConnection
+
+BROADCAST = (4, b'2/dpu-evolver,["broadcast",{}]')
+
+
+class FakeSocketIO(object):
+    # hands the packets to the namespace, never connected to anything
+    connected = False
+    _transport_instance = None
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def _process_packet(self, packet):
+        self.namespace.on_broadcast()
+
+    def connect(self):
+        pass
+
+
+class FailingNamespace(object):
+    backlog = 0
+
+    def __init__(self):
+        self.broadcasts = 0
+        self.stopped = 0
+
+    def on_broadcast(self):
+        self.broadcasts += 1
+        raise ValueError('bad broadcast')
+
+    def stop_exp(self):
+        self.stopped += 1
+
+
+def fake_connection(stop_on_error=True):
+    connection = EvolverConnection('localhost', 0,
+                                   stop_on_error=stop_on_error)
+    connection.namespace = FailingNamespace()
+    connection.socketIO = FakeSocketIO(connection.namespace)
+    return connection
+
+
+def test_handler_error_raised_by_run_forever():
+    connection = fake_connection()
+    connection.loop.call_soon(connection._dispatch, [BROADCAST, BROADCAST])
+    with pytest.raises(ValueError):
+        connection.run_forever()
+    # the packets after the failing one are dropped
+    assert connection.namespace.broadcasts == 1
+    assert connection.namespace.backlog == 0
+    assert connection.error is None
+
+
+def test_handler_error_stops_experiment():
+    connection = fake_connection()
+    connection.loop.call_soon(connection._dispatch, [BROADCAST])
+    eVOLVER.run_experiment(connection, connection.namespace)
+    assert connection.namespace.stopped >= 1
+
+
+def test_handler_error_logged_without_stop_on_error():
+    connection = fake_connection(stop_on_error=False)
+    connection._dispatch([BROADCAST, BROADCAST])
+    assert connection.namespace.broadcasts == 2
+    assert connection.namespace.backlog == 0
+    assert connection.error is None
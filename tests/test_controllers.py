@@ -0,0 +1,22 @@
+import argparse
+import inspect
+
+import pytest
+
+# registers the controllers of the operation modes
+import custom_script  # noqa: F401
+from controllers import CONTROLLERS, Controller
+
+
+def test_step_required():
+    class NoStep(Controller):
+        pass
+
+    with pytest.raises(TypeError, match='step'):
+        NoStep(argparse.Namespace(to_avg=7), range(16))
+
+
+def test_registered_controllers_implement_step():
+    assert CONTROLLERS
+    for name, cls in CONTROLLERS.items():
+        assert not inspect.isabstract(cls), name
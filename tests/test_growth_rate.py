@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from growth_rate import GrowthRateEstimator
+
+
+def growth_curve(seed, count=50):
+    rng = np.random.RandomState(seed)
+    times = np.cumsum(rng.uniform(0.01, 0.03, count))
+    od = 0.05 * np.exp(0.8 * times) * rng.lognormal(0, 0.02, count)
+    return times, od
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_fit_as_linregress(seed):
+    times, od = growth_curve(seed)
+    estimator = GrowthRateEstimator(2)
+    for t, value in zip(times, od):
+        estimator.add([1], t, [np.nan, value])
+    fit = stats.linregress(times, np.log(od))
+    assert np.allclose(estimator.fit(1),
+                       [fit.slope, fit.intercept, fit.stderr])
+    assert estimator.count(0) == 0
+    assert np.isnan(estimator.fit(0)).all()
+
+
+def test_only_points_after_the_curve_start():
+    times, od = growth_curve(0)
+    start = times[19]
+    estimator = GrowthRateEstimator(1)
+    estimator.reset(0, start)
+    estimator.extend(0, times, od)
+    fit = stats.linregress(times[20:], np.log(od[20:]))
+    assert estimator.count(0) == 30
+    assert np.allclose(estimator.fit(0),
+                       [fit.slope, fit.intercept, fit.stderr])
+    # the same sums whether loaded or added one point at a time
+    loaded = GrowthRateEstimator(1)
+    loaded.load(0, start, times, od)
+    assert np.allclose(loaded.fit(0), estimator.fit(0))
+
+
+def test_bad_readings_left_out():
+    times, od = growth_curve(1)
+    bad = od.copy()
+    bad[[3, 7]] = [np.nan, 0]
+    estimator = GrowthRateEstimator(1)
+    estimator.extend(0, times, bad)
+    keep = np.ones(len(od), dtype=bool)
+    keep[[3, 7]] = False
+    fit = stats.linregress(times[keep], np.log(od[keep]))
+    assert np.allclose(estimator.fit(0),
+                       [fit.slope, fit.intercept, fit.stderr])
@@ -0,0 +1,125 @@
+import json
+import os
+
+import numpy as np
+
+import journal
+from data_writer import DataWriter
+from journal import Journal, JournalReader
+
+VIALS = 4
+
+
+def write_broadcasts(exp_dir, count, valid=None):
+    writer = DataWriter()
+    log = Journal(exp_dir, writer, VIALS, 'test')
+    log.open()
+    for b in range(count):
+        log.add('OD', [0.1 * b + x for x in range(VIALS)])
+        log.add('temp', ['30.0'] * VIALS)
+        log.write_broadcast(1000.0 + b, b / 60.0, {'temp': b},
+                            None if valid is None else valid(b))
+        log.command('command', [{'param': 'pump', 'value': b}])
+        log.write_commands(1000.0 + b)
+    writer.close()
+
+
+def test_round_trip(tmp_path):
+    exp_dir = str(tmp_path)
+    write_broadcasts(exp_dir, 5)
+    reader = JournalReader(exp_dir)
+    od = reader.read('OD', 2)
+    assert od.tolist() == [[b / 60.0, 0.1 * b + 2] for b in range(5)]
+    assert reader.tail('OD', 2, 2).tolist() == od[-2:].tolist()
+    assert reader.tail('OD', 2, 6).size == 0
+    assert reader.read('temp', 0)[:, 1].tolist() == [30.0] * 5
+    records = list(reader.records())
+    assert [r['kind'] for r in records] == ['broadcast', 'commands'] * 5
+    assert records[-2]['sequence'] == 5
+    assert records[-2]['config'] == {'temp': 4}
+    assert records[-2]['masked'] == []
+    assert records[-1]['commands'] == [['command',
+                                        [{'param': 'pump', 'value': 4}]]]
+
+
+def test_masked_vials_left_out(tmp_path):
+    exp_dir = str(tmp_path)
+    # vial 1 missing from the odd broadcasts
+    write_broadcasts(exp_dir, 4, lambda b: np.arange(VIALS) != b % 2)
+    reader = JournalReader(exp_dir)
+    assert reader.read('OD', 1)[:, 0].tolist() == [0, 2 / 60.0]
+    assert reader.tail('OD', 1, 2)[:, 0].tolist() == [0, 2 / 60.0]
+    assert len(reader.read('OD', 0)) == 2
+    assert [r['masked'] for r in reader.records()
+            if r['kind'] == 'broadcast'] == [[0], [1], [0], [1]]
+
+
+def test_torn_record_dropped_on_resume(tmp_path):
+    exp_dir = str(tmp_path)
+    write_broadcasts(exp_dir, 3)
+    path = JournalReader(exp_dir).segment_path()
+    size = os.path.getsize(path)
+    # the DPU stopped while writing the next record
+    record = journal.encode_record(journal.BROADCAST, 4, 1004.0, b'x' * 200)
+    with open(path, 'ab') as f:
+        f.write(record[:len(record) // 2])
+    reader = JournalReader(exp_dir)
+    assert len(reader.read('OD', 0)) == 3
+    assert len(reader.tail('OD', 0, 3)) == 3
+
+    writer = DataWriter()
+    log = Journal(exp_dir, writer, VIALS, 'test')
+    log.open()
+    assert os.path.getsize(path) == size
+    assert log.sequence == 3
+    log.add('OD', [9.0] * VIALS)
+    log.write_broadcast(1003.0, 3 / 60.0)
+    writer.close()
+    od = JournalReader(exp_dir).read('OD', 0)
+    assert od[:, 1].tolist() == [0.0, 0.1, 0.2, 9.0]
+    assert [r['sequence'] for r in JournalReader(exp_dir).records()
+            if r['kind'] == 'broadcast'] == [1, 2, 3, 4]
+
+
+def write_v1_segment(exp_dir, count):
+    # segment of the first journal format, without the valid mask
+    directory = os.path.join(exp_dir, journal.JOURNAL_DIRECTORY)
+    os.makedirs(directory)
+    layout = json.dumps({'vials': VIALS, 'fields': ['OD'],
+                         'exp_name': 'test', 'sequence': 0,
+                         'headers': {'OD': 'then'}}).encode('utf-8')
+    data = journal.SEGMENT.pack(journal.MAGIC, 1, len(layout)) + layout
+    for b in range(count):
+        row = np.zeros(1, journal.broadcast_row(1, VIALS, version=1))
+        row['present'] = 1
+        row['elapsed'] = b
+        row['values'] = b + np.arange(VIALS)
+        data += journal.encode_record(journal.BROADCAST, b + 1, 1000.0 + b,
+                                      row.tobytes())
+    with open(os.path.join(directory, journal.segment_name(0)), 'wb') as f:
+        f.write(data)
+
+
+def test_v1_segment(tmp_path):
+    exp_dir = str(tmp_path)
+    write_v1_segment(exp_dir, 3)
+    reader = JournalReader(exp_dir)
+    assert reader.layout(reader.segment_path())[0]['version'] == 1
+    assert reader.read('OD', 1).tolist() == [[0, 1], [1, 2], [2, 3]]
+    assert reader.tail('OD', 1, 2).tolist() == [[1, 2], [2, 3]]
+    assert [r['masked'] for r in reader.records()] == [[], [], []]
+
+    # continuing it starts a segment of the current format
+    writer = DataWriter()
+    log = Journal(exp_dir, writer, VIALS, 'test')
+    log.open()
+    assert log.version == 1
+    log.add('OD', [7.0] * VIALS)
+    log.write_broadcast(1003.0, 3, valid=np.arange(VIALS) != 1)
+    writer.close()
+    reader = JournalReader(exp_dir)
+    assert len(reader.segments()) == 2
+    assert reader.layout(reader.segment_path())[0]['version'] == \
+        journal.VERSION
+    assert reader.read('OD', 0)[:, 1].tolist() == [0, 1, 2, 7]
+    assert reader.read('OD', 1)[:, 1].tolist() == [1, 2, 3]
@@ -0,0 +1,41 @@
+import numpy as np
+
+from ring_buffer import VialRingBuffer
+
+
+def test_wraparound():
+    buffer = VialRingBuffer(2, 4)
+    for t in range(1, 11):
+        # vial 1 only gets every other row
+        vials = [0, 1] if t % 2 else [0]
+        buffer.append(vials, t, [10.0 * t, 100.0 * t])
+    assert buffer.count(0) == 4 and buffer.count(1) == 4
+    assert buffer.tail(0, 4).tolist() == [[7, 70], [8, 80], [9, 90],
+                                          [10, 100]]
+    assert buffer.tail(0, 2).tolist() == [[9, 90], [10, 100]]
+    assert buffer.tail(1, 3)[:, 0].tolist() == [5, 7, 9]
+    assert buffer.tail(0, 5).size == 0
+
+
+def test_tail_all():
+    buffer = VialRingBuffer(3, 3)
+    for t in range(1, 6):
+        buffer.append([0, 1] if t < 5 else [0], t, [t, -t, 0])
+    rows, ready = buffer.tail_all(3)
+    assert ready.tolist() == [True, True, False]
+    assert rows[0, :, 1].tolist() == [3, 4, 5]
+    assert rows[1, :, 1].tolist() == [-2, -3, -4]
+    assert np.isnan(rows[2]).all()
+
+
+def test_load_extend_restore():
+    buffer = VialRingBuffer(1, 4)
+    buffer.load(0, [[t, t] for t in range(6)])
+    assert buffer.tail(0, 4)[:, 0].tolist() == [2, 3, 4, 5]
+    buffer.extend(0, [[6, 6], [7, 7]])
+    assert buffer.tail(0, 4)[:, 0].tolist() == [4, 5, 6, 7]
+    restored = VialRingBuffer(1, 4)
+    assert restored.restore(buffer.snapshot())
+    restored.append([0], 8, [8])
+    assert restored.tail(0, 4)[:, 0].tolist() == [5, 6, 7, 8]
+    assert not VialRingBuffer(2, 4).restore(buffer.snapshot())
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from rolling_median import RollingMedian, sorted_mad, sorted_median
+
+
+@pytest.mark.parametrize('size', range(1, 12))
+def test_sorted_median_and_mad(size):
+    rng = np.random.RandomState(size)
+    for values in [rng.normal(size=size), rng.randint(0, 4, size) * 1.0]:
+        values = sorted(values.tolist())
+        median = np.median(values)
+        assert sorted_median(values) == median
+        assert sorted_mad(values, median) == \
+            np.median(np.abs(np.array(values) - median))
+
+
+@pytest.mark.parametrize('window', [1, 4, 7])
+def test_same_as_np_median(window):
+    rng = np.random.RandomState(window)
+    data = rng.lognormal(-2, 0.5, (40, 3))
+    # repeated values
+    data[10:15, 1] = 0.2
+    rolling = RollingMedian(3, window)
+    for row, values in enumerate(data):
+        rolling.append(range(3), values)
+        ready = rolling.ready()
+        assert ready.tolist() == [row + 1 >= window] * 3
+        if not ready.all():
+            assert np.isnan(rolling.median()).all()
+            continue
+        last = data[row + 1 - window:row + 1]
+        median = np.median(last, axis=0)
+        assert np.array_equal(rolling.median(), median)
+        assert np.array_equal(rolling.mad(),
+                              np.median(np.abs(last - median), axis=0))
+        assert np.array_equal(rolling.last(), values)
+
+
+def test_nan_in_window():
+    rolling = RollingMedian(2, 3)
+    rolling.append([0, 1], [1.0, 1.0])
+    rolling.append([0, 1], [np.nan, 2.0])
+    rolling.append([0, 1], [3.0, 3.0])
+    assert np.isnan(rolling.median()[0]) and rolling.median()[1] == 2.0
+    # the NaN leaves the window
+    rolling.append([0, 1], [5.0, 4.0])
+    assert np.isnan(rolling.median()[0])
+    rolling.append([0, 1], [7.0, 5.0])
+    assert rolling.median().tolist() == [5.0, 4.0]
+
+
+def test_load_and_outliers():
+    rolling = RollingMedian(2, 5)
+    rolling.load(0, [9.0, 0.30, 0.31, 0.29, 0.30, 0.31])
+    rolling.load(1, [0.30, 0.31, 0.29, 0.30, 0.9])
+    assert rolling.median().tolist() == [0.30, 0.30]
+    assert rolling.outliers().tolist() == [False, True]